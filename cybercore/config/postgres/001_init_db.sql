@@ -17,9 +17,103 @@ CREATE TABLE IF NOT EXISTS app_user (
   active         BOOLEAN NOT NULL DEFAULT TRUE,
   created_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
   updated_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
-  last_auth_at   TIMESTAMPTZ
+  last_auth_at   TIMESTAMPTZ,
+  keycloak_id    TEXT                     -- Keycloak user ID, set by the Keycloak sync
 );
 CREATE UNIQUE INDEX IF NOT EXISTS ux_app_user_email_lower ON app_user (lower(email));
+-- Databases created before the Keycloak sync get the column here; CREATE TABLE above skips them
+ALTER TABLE app_user ADD COLUMN IF NOT EXISTS keycloak_id TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_app_user_keycloak_id ON app_user (keycloak_id) WHERE keycloak_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_app_user_updated_at ON app_user (updated_at);
+CREATE INDEX IF NOT EXISTS idx_app_user_username_lower ON app_user (lower(username));  -- Keycloak lowercases usernames
+
+-- Keep updated_at current so incremental Keycloak syncs can use it as a watermark; the sync's own
+-- keycloak_id write-back and last_auth_at login stamps are not changes and leave it alone
+CREATE OR REPLACE FUNCTION app_user_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+  NEW.updated_at := now();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_app_user_touch_updated_at ON app_user;
+CREATE TRIGGER trg_app_user_touch_updated_at
+  BEFORE UPDATE ON app_user
+  FOR EACH ROW
+  WHEN ((OLD.username, OLD.email, OLD.first_name, OLD.last_name, OLD.auth_provider, OLD.password_hash,
+         OLD.password_alg, OLD.status, OLD.active, OLD.created_at)
+        IS DISTINCT FROM (NEW.username, NEW.email, NEW.first_name, NEW.last_name, NEW.auth_provider, NEW.password_hash,
+                          NEW.password_alg, NEW.status, NEW.active, NEW.created_at))
+  EXECUTE FUNCTION app_user_touch_updated_at();
+
+-- === Hard-deleted users (so incremental syncs can remove them downstream) ===
+CREATE TABLE IF NOT EXISTS app_user_tombstone (
+  user_id     UUID NOT NULL,
+  username    TEXT NOT NULL,
+  keycloak_id TEXT,                       -- so users linked without sync state can still be removed
+  deleted_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+ALTER TABLE app_user_tombstone ADD COLUMN IF NOT EXISTS keycloak_id TEXT;
+CREATE INDEX IF NOT EXISTS idx_app_user_tombstone_deleted_at ON app_user_tombstone (deleted_at);
+
+CREATE OR REPLACE FUNCTION app_user_record_tombstone() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO app_user_tombstone (user_id, username, keycloak_id)
+  VALUES (OLD.user_id, OLD.username, OLD.keycloak_id);
+  RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_app_user_record_tombstone ON app_user;
+CREATE TRIGGER trg_app_user_record_tombstone
+  AFTER DELETE ON app_user
+  FOR EACH ROW
+  EXECUTE FUNCTION app_user_record_tombstone();
+
+-- === Keycloak sync state (written by infrastructure/authentication/scripts/keycloak-integration.py) ===
+-- No FK to app_user: rows must outlive hard deletes until Keycloak has been told
+CREATE TABLE IF NOT EXISTS keycloak_sync_state (
+  realm         TEXT NOT NULL,
+  user_id       UUID NOT NULL,
+  keycloak_id   TEXT NOT NULL,
+  content_hash  TEXT NOT NULL,
+  synced_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (realm, user_id)
+);
+
+-- Users whose push keeps failing: each one holds the push watermark back until attempts
+-- reaches SYNC_MAX_ATTEMPTS, then it is dead-lettered; cleared once the user is pushed
+CREATE TABLE IF NOT EXISTS keycloak_sync_failure (
+  realm         TEXT NOT NULL,
+  user_id       UUID NOT NULL,
+  attempts      INTEGER NOT NULL DEFAULT 0,
+  last_error    TEXT,
+  updated_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (realm, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS keycloak_sync_watermark (
+  realm       TEXT NOT NULL,
+  direction   TEXT NOT NULL CHECK (direction IN ('push','pull')),
+  high_water  TIMESTAMPTZ NOT NULL,
+  updated_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (realm, direction)
+);
+
+-- Work leases for sharded syncs (SYNC_MODE=sharded): one row per user_id hash bucket of a run,
+-- claimed with FOR UPDATE SKIP LOCKED; an expired lease can be claimed by another worker
+CREATE TABLE IF NOT EXISTS keycloak_sync_lease (
+  realm         TEXT NOT NULL,
+  run_id        TEXT NOT NULL,
+  bucket        INTEGER NOT NULL,
+  status        TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending','leased','done','failed')),
+  owner         TEXT,
+  leased_until  TIMESTAMPTZ,
+  attempts      INTEGER NOT NULL DEFAULT 0,
+  stats         JSONB,
+  updated_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (realm, run_id, bucket)
+);
 
 -- === Groups (text key) ===
 CREATE TABLE IF NOT EXISTS app_group (
@@ -35,6 +129,49 @@ CREATE TABLE IF NOT EXISTS user_group (
   PRIMARY KEY (user_id, group_key)
 );
 
+-- === Change notifications for the Keycloak sync daemon (keycloak-integration.py daemon) ===
+-- Payload: {"table": ..., "op": ..., "user_id": ...}; app_user updates only notify when a
+-- column pushed to Keycloak changed, so the daemon's own keycloak_id write-back stays quiet.
+-- The channel is the cyberhub.keycloak_sync_channel setting (default keycloak_sync) and has
+-- to match the daemon's DAEMON_CHANNEL, e.g.
+--   ALTER DATABASE cyberhub_core SET cyberhub.keycloak_sync_channel = 'keycloak_sync_staging';
+CREATE OR REPLACE FUNCTION keycloak_sync_notify() RETURNS trigger AS $$
+DECLARE
+  changed_user UUID;
+  channel TEXT := COALESCE(NULLIF(current_setting('cyberhub.keycloak_sync_channel', true), ''), 'keycloak_sync');
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    changed_user := OLD.user_id;
+  ELSE
+    changed_user := NEW.user_id;
+  END IF;
+  PERFORM pg_notify(channel, json_build_object(
+    'table', TG_TABLE_NAME, 'op', TG_OP, 'user_id', changed_user
+  )::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_app_user_notify_keycloak ON app_user;
+CREATE TRIGGER trg_app_user_notify_keycloak
+  AFTER INSERT OR DELETE ON app_user
+  FOR EACH ROW
+  EXECUTE FUNCTION keycloak_sync_notify();
+
+DROP TRIGGER IF EXISTS trg_app_user_notify_keycloak_update ON app_user;
+CREATE TRIGGER trg_app_user_notify_keycloak_update
+  AFTER UPDATE ON app_user
+  FOR EACH ROW
+  WHEN ((OLD.username, OLD.email, OLD.first_name, OLD.last_name, OLD.active, OLD.status)
+        IS DISTINCT FROM (NEW.username, NEW.email, NEW.first_name, NEW.last_name, NEW.active, NEW.status))
+  EXECUTE FUNCTION keycloak_sync_notify();
+
+DROP TRIGGER IF EXISTS trg_user_group_notify_keycloak ON user_group;
+CREATE TRIGGER trg_user_group_notify_keycloak
+  AFTER INSERT OR UPDATE OR DELETE ON user_group
+  FOR EACH ROW
+  EXECUTE FUNCTION keycloak_sync_notify();
+
 -- === Modules (text key) ===
 CREATE TABLE IF NOT EXISTS module (
   key     TEXT PRIMARY KEY,                -- 'cyberlabs','crucible','forge','university','library','wiki'
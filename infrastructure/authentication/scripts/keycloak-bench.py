@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+"""
+CyberCore Keycloak Integration Benchmarks
+Measures the user sync pipeline of keycloak-integration.py
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import resource
+import threading
+import subprocess
+import importlib.util
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILE = os.path.join(
+    SCRIPT_DIR, '..', '..', '..', 'cybercore', 'config', 'postgres', '001_init_db.sql'
+)
+
+# Seeded app_user rows for the sync benchmark; every third user is in a module group
+SEED_USERS_SQL = """
+    INSERT INTO app_user (username, email, first_name, last_name)
+    SELECT 'bench_user_' || g, 'bench_user_' || g || '@cybercore.local', 'Bench', 'User ' || g
+    FROM generate_series(1, %s) AS g
+"""
+SEED_GROUPS_SQL = """
+    INSERT INTO user_group (user_id, group_key)
+    SELECT user_id, (ARRAY['cyberlabs', 'crucible', 'forge'])[1 + abs(hashtext(username)) % 3]
+    FROM app_user
+    WHERE abs(hashtext(email)) % 3 = 0
+"""
+
+# Realms and the app_group keys routed to them for the multi-realm mode
+BENCH_REALMS = 'cybercore=*,cyberlabs=cyberlabs+forge'
+
+# Synthetic export rows, so the memory benchmark needs no seeded tables
+SYNTHETIC_USERS_QUERY = """
+    SELECT gen_random_uuid() AS user_id,
+           'bench_user_' || g AS username,
+           'bench_user_' || g || '@cybercore.local' AS email,
+           'Bench' AS first_name,
+           'User ' || g AS last_name,
+           TRUE AS active,
+           'active' AS status,
+           'keycloak' AS auth_provider
+    FROM generate_series(1, %s) AS g
+"""
+
+class FakeKeycloak:
+    """In-process fake of the Keycloak endpoints used by keycloak-integration.py
+    
+    Faults are injected per request: a fixed latency plus jitter, a random
+    error_rate answered with error_status, and a capacity above which
+    concurrent requests are shed with 429 and Retry-After.
+    """
+    
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, capacity: int = 0, retry_after: Optional[float] = None,
+                 token_lifetime: int = 300):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.token_lifetime = token_lifetime
+        
+        self.users: Dict[str, Dict] = {}
+        self.realms: Dict[str, Dict] = {}
+        self.components: Dict[str, Dict] = {}
+        self.clients: Dict[str, Dict] = {}
+        self.groups: Dict[str, Dict] = {}
+        self.admin_events: List[Dict] = []
+        self.requests: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.latencies: List[float] = []
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+    
+    def start(self) -> str:
+        """Serve on a free localhost port and return the base URL"""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_port}"
+    
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+    
+    def _handler_class(self):
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; with Nagle on, delayed ACKs
+            # would add ~40ms to every keep-alive response
+            disable_nagle_algorithm = True
+            
+            def log_message(self, format, *args):
+                pass
+            
+            def do_GET(self):
+                fake._handle(self, 'GET')
+            
+            def do_POST(self):
+                fake._handle(self, 'POST')
+            
+            def do_PUT(self):
+                fake._handle(self, 'PUT')
+            
+            def do_DELETE(self):
+                fake._handle(self, 'DELETE')
+        
+        return Handler
+    
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        started = time.monotonic()
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw = handler.rfile.read(length) if length else b''
+        parsed = urlparse(handler.path)
+        route = re.sub(r'/[0-9a-f-]{36}', '/{id}', parsed.path)
+        
+        with self._lock:
+            self.in_flight += 1
+            shed = self.capacity and self.in_flight > self.capacity
+            self.requests[f"{method} {route}"] += 1
+        
+        try:
+            if shed:
+                status, body, headers = 429, {'error': 'too many requests'}, {}
+                if self.retry_after is not None:
+                    headers['Retry-After'] = str(self.retry_after)
+            else:
+                delay = self.latency + random.uniform(0, self.jitter)
+                if delay:
+                    time.sleep(delay)
+                if self.error_rate and random.random() < self.error_rate and not route.endswith('/token'):
+                    status, body, headers = self.error_status, {'error': 'injected'}, {}
+                else:
+                    status, body, headers = self._route(method, route, parsed, raw)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        
+        data = json.dumps(body).encode() if body is not None else b''
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+        
+        with self._lock:
+            self.statuses[status] += 1
+            self.latencies.append(time.monotonic() - started)
+    
+    def _route(self, method: str, route: str, parsed, raw: bytes):
+        body = json.loads(raw) if raw and raw[:1] in (b'{', b'[') else None
+        
+        if route.endswith('/protocol/openid-connect/token'):
+            return 200, {
+                'access_token': uuid.uuid4().hex,
+                'expires_in': self.token_lifetime,
+                'refresh_token': uuid.uuid4().hex,
+                'refresh_expires_in': self.token_lifetime * 6
+            }, {}
+        if route in ('/', '/health/ready'):
+            return 200, {'status': 'UP'}, {}
+        
+        if route == '/admin/realms' and method == 'POST':
+            with self._lock:
+                if body['realm'] in self.realms:
+                    return 409, {'errorMessage': 'Conflict detected'}, {}
+                self.realms[body['realm']] = dict(body, id=str(uuid.uuid4()))
+            return 201, None, {}
+        
+        match = re.match(r'/admin/realms/([^/]+)(/.*)?$', route)
+        if not match:
+            return 404, {'error': 'not found'}, {}
+        realm, rest = match.group(1), match.group(2) or ''
+        
+        if rest == '':
+            return self._realm(realm, method, body)
+        if rest.startswith('/components') or rest.startswith('/clients'):
+            return self._config_entities(realm, method, parsed, body)
+        if rest == '/partialImport' and method == 'POST':
+            return 200, self._partial_import(body or {}), {}
+        if rest == '/users' and method == 'POST':
+            with self._lock:
+                username = body['username'].lower()
+                if username in self.users:
+                    return 409, {'errorMessage': 'User exists with same username'}, {}
+                user_id = str(uuid.uuid4())
+                self.users[username] = dict(body, id=user_id, username=username)
+            return 201, None, {'Location': f"/admin/realms/{realm}/users/{user_id}"}
+        if rest == '/users' and method == 'GET':
+            query = parse_qs(parsed.query)
+            first = int(query.get('first', ['0'])[0])
+            count = int(query.get('max', ['100'])[0])
+            with self._lock:
+                if 'username' in query:
+                    match = self.users.get(query['username'][0].lower())
+                    users = [match] if match else []
+                else:
+                    users = sorted(self.users.values(), key=lambda user: user['username'])
+            return 200, users[first:first + count], {}
+        if rest == '/users/count' and method == 'GET':
+            return 200, len(self.users), {}
+        if rest == '/users/{id}' and method == 'GET':
+            user_id = parsed.path.rsplit('/', 1)[-1]
+            with self._lock:
+                user = next((u for u in self.users.values() if u['id'] == user_id), None)
+            return (200, user, {}) if user else (404, {'error': 'User not found'}, {})
+        if rest == '/users/{id}' and method in ('PUT', 'DELETE'):
+            return 204, None, {}
+        if rest.startswith('/groups') or rest.startswith('/users/{id}/groups'):
+            return self._groups(method, parsed, body)
+        if rest == '/admin-events' and method == 'GET':
+            query = parse_qs(parsed.query)
+            first = int(query.get('first', ['0'])[0])
+            count = int(query.get('max', ['100'])[0])
+            with self._lock:
+                events = sorted(self.admin_events, key=lambda event: -event['time'])
+            return 200, events[first:first + count], {}
+        if method == 'GET':
+            return 200, ({'realm': realm} if not rest else []), {}
+        return (201 if method == 'POST' else 204), None, {}
+    
+    def _realm(self, realm: str, method: str, body: Optional[Dict]):
+        """Realm representation; realms other than ones POSTed exist with defaults"""
+        with self._lock:
+            current = self.realms.setdefault(realm, {'id': str(uuid.uuid4()), 'realm': realm, 'enabled': True})
+            if method == 'GET':
+                return 200, dict(current), {}
+            if method == 'PUT':
+                current.update(body or {})
+                return 204, None, {}
+        return 405, None, {}
+    
+    def _config_entities(self, realm: str, method: str, parsed, body: Optional[Dict]):
+        """Components and clients, with stored credentials masked on read like Keycloak does"""
+        kind = 'components' if parsed.path.split('/')[4] == 'components' else 'clients'
+        store = self.components if kind == 'components' else self.clients
+        entity_id = parsed.path.rstrip('/').split('/')[5] if parsed.path.count('/') > 4 else None
+        with self._lock:
+            if method == 'GET':
+                query = parse_qs(parsed.query)
+                entities = [json.loads(json.dumps(e)) for e in store.values() if e['realm'] == realm]
+                if 'clientId' in query:
+                    entities = [e for e in entities if e.get('clientId') == query['clientId'][0]]
+                for entity in entities:
+                    entity.pop('realm')
+                    for key in ('password', 'bindCredential'):
+                        if key in entity.get('config', {}):
+                            entity['config'][key] = ['**********']
+                return 200, entities, {}
+            if method == 'POST':
+                if kind == 'clients' and any(e['realm'] == realm and e.get('clientId') == body.get('clientId')
+                                             for e in store.values()):
+                    return 409, {'errorMessage': 'Client already exists'}, {}
+                entity_id = str(uuid.uuid4())
+                store[entity_id] = dict(body, id=entity_id, realm=realm)
+                return 201, None, {'Location': f"/admin/realms/{realm}/{kind}/{entity_id}"}
+            if method == 'PUT' and entity_id in store:
+                config = dict(store[entity_id].get('config', {}))
+                for key, value in (body or {}).get('config', {}).items():
+                    if value != ['**********']:
+                        config[key] = value
+                store[entity_id] = dict(body, id=entity_id, realm=realm, config=config)
+                return 204, None, {}
+        return 404, {'error': 'not found'}, {}
+    
+    def _groups(self, method: str, parsed, body: Optional[Dict]):
+        """Top-level groups and their members"""
+        parts = parsed.path.rstrip('/').split('/')[4:]
+        query = parse_qs(parsed.query)
+        with self._lock:
+            if parts[0] == 'users' and len(parts) == 3:
+                return 200, [{'id': g['id'], 'name': g['name'], 'path': f"/{g['name']}"}
+                             for g in self.groups.values() if parts[1] in g['members']], {}
+            if parts[0] == 'users':
+                # /users/{id}/groups/{group_id}
+                group = next((g for g in self.groups.values() if g['id'] == parts[3]), None)
+                if group is None:
+                    return 404, {'error': 'Group not found'}, {}
+                if method == 'PUT':
+                    group['members'].add(parts[1])
+                elif method == 'DELETE':
+                    group['members'].discard(parts[1])
+                return 204, None, {}
+            if len(parts) == 1 and method == 'GET':
+                return 200, [{'id': g['id'], 'name': g['name'], 'path': f"/{g['name']}"}
+                             for g in self.groups.values()], {}
+            if len(parts) == 1 and method == 'POST':
+                if body['name'] in self.groups:
+                    return 409, {'errorMessage': 'Top level group named already exists'}, {}
+                group_id = str(uuid.uuid4())
+                self.groups[body['name']] = {'id': group_id, 'name': body['name'], 'members': set()}
+                return 201, None, {'Location': f"{parsed.path}/{group_id}"}
+            if len(parts) == 3 and parts[2] == 'members' and method == 'GET':
+                group = next((g for g in self.groups.values() if g['id'] == parts[1]), None)
+                if group is None:
+                    return 404, {'error': 'Group not found'}, {}
+                first = int(query.get('first', ['0'])[0])
+                count = int(query.get('max', ['100'])[0])
+                by_id = {u['id']: u for u in self.users.values()}
+                members = [by_id[m] for m in sorted(group['members']) if m in by_id]
+                return 200, members[first:first + count], {}
+        return 404, {'error': 'not found'}, {}
+    
+    def _partial_import(self, body: Dict) -> Dict:
+        policy = body.get('ifResourceExists', 'FAIL')
+        results, counts = [], Counter()
+        with self._lock:
+            for group in body.get('groups', []):
+                if group['name'] not in self.groups:
+                    self.groups[group['name']] = {'id': group.get('id') or str(uuid.uuid4()),
+                                                  'name': group['name'], 'members': set()}
+            for user in body.get('users', []):
+                username = user['username'].lower()
+                existing = self.users.get(username)
+                if existing and policy == 'SKIP':
+                    action, user_id = 'SKIPPED', existing['id']
+                elif existing and policy == 'OVERWRITE':
+                    action, user_id = 'OVERWRITTEN', existing['id']
+                    self.users[username] = dict(user, id=user_id, username=username)
+                else:
+                    action, user_id = 'ADDED', user.get('id') or str(uuid.uuid4())
+                    self.users[username] = dict(user, id=user_id, username=username)
+                for path in user.get('groups', []) if action != 'SKIPPED' else []:
+                    group = self.groups.get(path.lstrip('/'))
+                    if group:
+                        group['members'].add(user_id)
+                counts[action] += 1
+                results.append({'action': action, 'resourceType': 'USER',
+                                'resourceName': username, 'id': user_id})
+        return {'added': counts['ADDED'], 'skipped': counts['SKIPPED'],
+                'overwritten': counts['OVERWRITTEN'], 'results': results}
+    
+    def reset(self, existing_users: List[Dict] = ()):
+        """Forget all state and counters; existing_users are already in the realm (409 on create)"""
+        with self._lock:
+            self.users = {user['username'].lower(): dict(user, id=str(uuid.uuid4()))
+                          for user in existing_users}
+            self.realms.clear()
+            self.components.clear()
+            self.clients.clear()
+            self.groups.clear()
+            self.admin_events.clear()
+        self.reset_counters()
+    
+    def reset_counters(self):
+        """Clear request, status and latency counters only"""
+        with self._lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.latencies = []
+    
+    def latency_percentiles(self) -> Dict[str, float]:
+        """p50/p99 server-side request latency in milliseconds"""
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return {'p50_ms': 0.0, 'p99_ms': 0.0}
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        return {'p50_ms': round(pick(0.50) * 1000, 2), 'p99_ms': round(pick(0.99) * 1000, 2)}
+
+def synthetic_users(count: int) -> List[Dict]:
+    """In-memory rows shaped like the app_user export"""
+    return [{
+        'user_id': str(uuid.uuid4()),
+        'username': f'bench_user_{index}',
+        'email': f'bench_user_{index}@cybercore.local',
+        'first_name': 'Bench',
+        'last_name': f'User {index}',
+        'active': True,
+        'status': 'active',
+        'auth_provider': 'keycloak'
+    } for index in range(count)]
+
+def load_integration():
+    """Import keycloak-integration.py (the hyphenated name is not importable directly)"""
+    spec = importlib.util.spec_from_file_location(
+        'keycloak_integration', os.path.join(SCRIPT_DIR, 'keycloak-integration.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB
+    
+    VmHWM starts over at exec, unlike ru_maxrss, which a worker inherits from
+    the (possibly much larger) benchmark process that forked it.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def rss_worker(strategy: str, count: int):
+    """Export count synthetic users with one strategy and print the peak RSS as JSON"""
+    module = load_integration()
+    integration = module.KeycloakIntegration()
+    conn = integration._connect_db(readonly=True)
+    baseline = peak_rss_mb()
+    started = time.monotonic()
+
+    if strategy == 'fetchall':
+        # The pre-streaming behaviour: every row in memory before any push
+        with conn.cursor(cursor_factory=module.psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(SYNTHETIC_USERS_QUERY, (count,))
+            users = cursor.fetchall()
+    else:
+        users = integration._iter_rows(conn, SYNTHETIC_USERS_QUERY, (count,))
+
+    exported = 0
+    for chunk in module._chunked(users, integration.sync_batch_size):
+        payload = [integration._build_keycloak_user(user) for user in chunk]
+        exported += len(json.dumps(payload))
+
+    conn.close()
+    print(json.dumps({
+        'strategy': strategy,
+        'users': count,
+        'seconds': round(time.monotonic() - started, 3),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'payload_bytes': exported
+    }))
+
+def bench_rss(counts: List[int], strategies: List[str]) -> List[Dict]:
+    """Run each strategy/count pair in a fresh process so peak RSS is not shared"""
+    results = []
+    for count in counts:
+        for strategy in strategies:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '_rss-worker',
+                 '--strategy', strategy, '--count', str(count)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{strategy:>9} {count:>8} users: peak RSS {result['peak_rss_mb']:>8.1f} MiB "
+                  f"({result['seconds']:.2f}s)", file=sys.stderr)
+    return results
+
+def bench_faults(args) -> Dict:
+    """Create users one request each against a fake Keycloak that injects faults"""
+    fake = FakeKeycloak(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, capacity=args.capacity, retry_after=args.retry_after
+    )
+    os.environ['KC_SERVER'] = fake.start()
+    os.environ['SYNC_DEAD_LETTER_FILE'] = args.dead_letter_file
+    
+    module = load_integration()
+    integration = module.KeycloakIntegration()
+    integration.get_admin_token()
+    
+    outcomes: Counter = Counter()
+    started = time.monotonic()
+    for user, response, error in integration.client.map_concurrent(
+            integration._create_keycloak_user, synthetic_users(args.users)):
+        if error or response.status_code != 201:
+            outcomes['failed'] += 1
+            integration.dead_letters.add(integration.realm_name, user, error or response.status_code)
+        else:
+            outcomes['created'] += 1
+    elapsed = time.monotonic() - started
+    integration.client.close()
+    fake.stop()
+    
+    return {
+        'benchmark': 'faults',
+        'users': args.users,
+        'seconds': round(elapsed, 3),
+        'throughput_per_s': round(args.users / elapsed, 1) if elapsed else None,
+        'created': outcomes['created'],
+        'dead_lettered': outcomes['failed'],
+        'client_retries': integration.client.retries,
+        'limiter_decreases': integration.limiter.decreases,
+        'final_concurrency': int(integration.limiter.limit),
+        'final_rate_per_s': round(integration.limiter.rate, 1),
+        'server_statuses': dict(fake.statuses),
+        **fake.latency_percentiles()
+    }
+
+def sync_worker(mode: str) -> None:
+    """Run one sync (or realm reconciliation) against KC_SERVER and print timing and peak RSS as JSON"""
+    module = load_integration()
+    integration = module.KeycloakIntegration()
+    integration.get_admin_token()
+    baseline = peak_rss_mb()
+    started = time.monotonic()
+    
+    if mode == 'realm':
+        # Cold reconciliation creates everything, the warm one should write nothing
+        integration._desired_realm = lambda: {
+            'realm': integration.realm_name, 'enabled': True, 'displayName': 'CyberCore',
+            'groups': [{'name': key} for key in ('cyberlabs', 'crucible', 'forge', 'university', 'library', 'cyberwiki')]
+        }
+        ok = all(integration._apply_changes(integration.plan()) for _ in range(2))
+        stats = {'writes': integration.reconciler.writes}
+    elif mode == 'groups':
+        ok = integration.sync_groups()
+        stats = integration.last_group_stats
+    elif mode == 'multi-realm':
+        integration.realm_groups = module._parse_realm_groups(BENCH_REALMS)
+        ok = integration.sync_realms()
+        stats = dict(integration.last_sync_stats, realms=integration.realm_results)
+    else:
+        integration.sync_mode = mode
+        ok = integration.sync_postgres_users()
+        stats = {key: value for key, value in integration.last_sync_stats.items() if key != 'chunks'}
+    
+    elapsed = time.monotonic() - started
+    integration.client.close()
+    print(json.dumps({
+        'mode': mode,
+        'ok': bool(ok),
+        'seconds': round(elapsed, 3),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stats': stats
+    }, default=str))
+
+def bench_database() -> str:
+    return os.getenv('DB_NAME', 'cyberhub_core')
+
+def seed_database(count: int, schema_file: str):
+    """Apply 001_init_db.sql and fill app_user/user_group with count users"""
+    import psycopg2
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'), port=os.getenv('DB_PORT', '5432'),
+        dbname=bench_database(), user=os.getenv('DB_USER', 'cyberhub'),
+        password=os.getenv('DB_PASS', 'cyberpass')
+    )
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        with open(schema_file) as f:
+            cursor.execute(f.read())
+        cursor.execute("""
+            TRUNCATE app_user, app_user_tombstone, keycloak_sync_state, keycloak_sync_watermark,
+                     keycloak_sync_failure, keycloak_sync_lease CASCADE
+        """)
+        cursor.execute(SEED_USERS_SQL, (count,))
+        cursor.execute(SEED_GROUPS_SQL)
+        cursor.execute("ANALYZE app_user")
+    conn.close()
+
+def reset_sync_state():
+    """Unlink every user so each mode starts from a realm nobody has synced to"""
+    import psycopg2
+    conn = psycopg2.connect(
+        host=os.getenv('DB_HOST', 'localhost'), port=os.getenv('DB_PORT', '5432'),
+        dbname=bench_database(), user=os.getenv('DB_USER', 'cyberhub'),
+        password=os.getenv('DB_PASS', 'cyberpass')
+    )
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("UPDATE app_user SET keycloak_id = NULL WHERE keycloak_id IS NOT NULL")
+        cursor.execute("""
+            TRUNCATE keycloak_sync_state, keycloak_sync_watermark, keycloak_sync_failure, keycloak_sync_lease
+        """)
+    conn.close()
+
+def bench_sync(args) -> Dict:
+    """Every sync mode at every user count against a seeded PostgreSQL and a fake Keycloak"""
+    fake = FakeKeycloak(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status
+    )
+    env = dict(
+        os.environ,
+        KC_SERVER=fake.start(),
+        KC_RATE_LIMIT=str(args.rate_limit),
+        SYNC_DEAD_LETTER_FILE=args.dead_letter_file,
+        SYNC_ID_CACHE_FILE=''
+    )
+    results = []
+    
+    for count in args.counts:
+        seed_database(count, args.schema)
+        # The same users pre-exist in Keycloak for every mode, so 409/SKIP paths are exercised
+        existing = [{'username': f'bench_user_{index}', 'email': f'bench_user_{index}@cybercore.local',
+                     'enabled': True} for index in range(1, int(count * args.conflict_rate) + 1)]
+        for mode in args.modes:
+            reset_sync_state()
+            fake.reset(existing)
+            if mode == 'groups':
+                # Group sync needs linked users; link them with a bulk run first
+                subprocess.run([sys.executable, os.path.abspath(__file__), '_sync-worker', '--mode', 'bulk'],
+                               env=env, check=True, capture_output=True)
+                fake.reset_counters()
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '_sync-worker', '--mode', mode],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            requests_sent = sum(fake.requests.values())
+            result.update({
+                'users': count,
+                # Realm reconciliation does not scale with users, so it has no user throughput
+                'throughput_users_per_s': round(count / result['seconds'], 1)
+                if result['seconds'] and mode != 'realm' else None,
+                'requests': requests_sent,
+                'server_statuses': dict(fake.statuses),
+                **fake.latency_percentiles()
+            })
+            results.append(result)
+            print(f"{mode:>11} {count:>8} users: {result['seconds']:8.2f}s "
+                  f"{result['throughput_users_per_s'] or 0:>9.1f} users/s  p50 {result['p50_ms']:.1f}ms "
+                  f"p99 {result['p99_ms']:.1f}ms  peak RSS {result['peak_rss_mb']:.1f} MiB", file=sys.stderr)
+    
+    fake.stop()
+    return {
+        'benchmark': 'sync',
+        'config': {
+            'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+            'conflict_rate': args.conflict_rate, 'rate_limit': args.rate_limit
+        },
+        'results': results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rss = subparsers.add_parser('rss', help='peak RSS of the user export against user count')
+    rss.add_argument('--counts', default='1000,10000,100000,500000',
+                     help='comma-separated user counts (default: %(default)s)')
+    rss.add_argument('--strategies', default='fetchall,stream',
+                     help='comma-separated export strategies (default: %(default)s)')
+    rss.add_argument('--output', help='write results as JSON to this file')
+
+    faults = subparsers.add_parser('faults', help='retry and AIMD behaviour against a faulty fake Keycloak')
+    faults.add_argument('--users', type=int, default=2000)
+    faults.add_argument('--latency', type=float, default=0.005, help='seconds added to every request')
+    faults.add_argument('--jitter', type=float, default=0.01, help='random extra latency in seconds')
+    faults.add_argument('--error-rate', type=float, default=0.05, help='fraction of requests that fail')
+    faults.add_argument('--error-status', type=int, default=503)
+    faults.add_argument('--capacity', type=int, default=4, help='concurrent requests before shedding with 429')
+    faults.add_argument('--retry-after', type=float, default=None, help='Retry-After seconds on shed requests')
+    faults.add_argument('--dead-letter-file', default='bench-dead-letter.jsonl')
+    faults.add_argument('--output', help='write results as JSON to this file')
+    
+    sync = subparsers.add_parser('sync', help='throughput, latency and peak RSS of every sync mode (needs DB_* env '
+                                 'naming a dedicated bench database: its user tables are truncated)')
+    sync.add_argument('--counts', default='1000,10000,100000',
+                      help='comma-separated user counts to seed (default: %(default)s)')
+    sync.add_argument('--modes', default='bulk,single,incremental,sharded,multi-realm,groups,realm',
+                      help='comma-separated sync modes (default: %(default)s)')
+    sync.add_argument('--latency', type=float, default=0.002, help='seconds added to every request')
+    sync.add_argument('--jitter', type=float, default=0.002, help='random extra latency in seconds')
+    sync.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    sync.add_argument('--error-status', type=int, default=503)
+    sync.add_argument('--conflict-rate', type=float, default=0.1,
+                      help='fraction of users that already exist in Keycloak (409 / SKIP)')
+    sync.add_argument('--rate-limit', type=float, default=5000, help='KC_RATE_LIMIT for the sync under test')
+    sync.add_argument('--schema', default=SCHEMA_FILE, help='schema applied before seeding (default: 001_init_db.sql)')
+    sync.add_argument('--dead-letter-file', default='bench-dead-letter.jsonl')
+    sync.add_argument('--output', help='write results as JSON to this file')
+    sync.add_argument('--i-know-this-truncates', action='store_true',
+                      help='run even though DB_NAME does not look like a bench database')
+    
+    sync_worker_parser = subparsers.add_parser('_sync-worker')
+    sync_worker_parser.add_argument('--mode', required=True)
+    
+    worker = subparsers.add_parser('_rss-worker')
+    worker.add_argument('--strategy', choices=['fetchall', 'stream'], required=True)
+    worker.add_argument('--count', type=int, required=True)
+
+    args = parser.parse_args()
+    # Journal and dead letters of throwaway runs stay in the working directory
+    os.environ.setdefault('SYNC_STATE_DIR', os.getcwd())
+
+    if args.command == '_rss-worker':
+        rss_worker(args.strategy, args.count)
+        return
+    if args.command == '_sync-worker':
+        sync_worker(args.mode)
+        return
+
+    if args.command == 'faults':
+        output = json.dumps(bench_faults(args), indent=2)
+    elif args.command == 'sync':
+        # Seeding truncates app_user and the sync tables, so never touch a real database by accident
+        if 'bench' not in bench_database() and not args.i_know_this_truncates:
+            parser.error(f"sync truncates app_user in DB_NAME={bench_database()}; point DB_NAME at a "
+                         f"database whose name contains 'bench' or pass --i-know-this-truncates")
+        args.counts = [int(count) for count in args.counts.split(',')]
+        args.modes = args.modes.split(',')
+        output = json.dumps(bench_sync(args), indent=2)
+    else:
+        results = bench_rss(
+            [int(count) for count in args.counts.split(',')],
+            args.strategies.split(',')
+        )
+        output = json.dumps({'benchmark': 'rss', 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+CyberCore Keycloak Integration CLI
+Runs keycloak-integration.py commands from its cached bytecode, for callers
+such as n8n hooks that start it once per event
+"""
+
+import os
+import sys
+import importlib.util
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == "__main__":
+    # Imported rather than executed, so the compiled module is reused from __pycache__
+    spec = importlib.util.spec_from_file_location(
+        'keycloak_integration', os.path.join(SCRIPT_DIR, 'keycloak-integration.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.exit(module.main(sys.argv[1:]))
@@ -4,15 +4,33 @@ CyberCore Keycloak Integration Script
 Configures Keycloak with PostgreSQL user federation and optional LDAP
 """
 
+from __future__ import annotations
+
 import os
 import sys
 import json
+import hashlib
+import itertools
 import time
 import logging
-import requests
-from typing import Dict, Optional, List
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import random
+import argparse
+import copy
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, Optional, List, Tuple
+
+# The keycloak_sync package ships next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from keycloak_sync import (
+    AdaptiveLimiter, DaemonMixin, DeadLetterQueue, KeycloakAdminClient, KeycloakIdCache,
+    KeycloakIdWriter, Metrics, PartitionedRows, PrefetchedRows, RealmReconciler, RetryPolicy,
+    SetupGraph, SetupStep, SnapshotMixin, SyncJournal, TokenError, TokenManager
+)
+from keycloak_sync._lazy import socket, subprocess, uuid, psycopg2, requests
+from keycloak_sync.rows import _chunked
 
 # Configure logging
 logging.basicConfig(
@@ -21,16 +39,42 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class KeycloakIntegration:
+def _parse_realm_groups(spec: str) -> Dict[str, Optional[set]]:
+    """Parse "realm=group+group,realm2=*" into realm -> group keys (None means every user)"""
+    realms: Dict[str, Optional[set]] = {}
+    for entry in spec.split(','):
+        realm, _, groups = entry.strip().partition('=')
+        if not realm.strip():
+            continue
+        keys = {key.strip() for key in groups.split('+') if key.strip()}
+        realms[realm.strip()] = None if not keys or '*' in keys else keys
+    return realms
+
+class KeycloakIntegration(SnapshotMixin, DaemonMixin):
+    SYNC_MODES = ('bulk', 'single', 'incremental', 'sharded')
+    
     def __init__(self):
         # Keycloak configuration
         self.kc_server = os.getenv('KC_SERVER', 'http://localhost:8080')
         self.kc_admin_user = os.getenv('KC_ADMIN_USER', 'admin')
         self.kc_admin_pass = os.getenv('KC_ADMIN_PASS', 'admin')
+        # Setting KC_CLIENT_SECRET switches to a service-account client-credentials grant
+        self.kc_auth_realm = os.getenv('KC_AUTH_REALM', 'master')
+        self.kc_client_id = os.getenv('KC_CLIENT_ID', 'admin-cli')
+        self.kc_client_secret = os.getenv('KC_CLIENT_SECRET', '')
+        self.kc_token_refresh_skew = float(os.getenv('KC_TOKEN_REFRESH_SKEW', '30'))
+        # Readiness probing: exponential backoff from READY_INITIAL_DELAY up to
+        # READY_MAX_DELAY seconds, giving up after KC_READY_TIMEOUT seconds
+        self.kc_health_url = os.getenv('KC_HEALTH_URL', '')
+        self.ready_timeout = float(os.getenv('KC_READY_TIMEOUT', '150'))
+        self.ready_initial_delay = float(os.getenv('READY_INITIAL_DELAY', '0.05'))
+        self.ready_max_delay = float(os.getenv('READY_MAX_DELAY', '2'))
+        self.readiness: Dict[str, Dict] = {}
         self.realm_name = os.getenv('REALM_NAME', 'cybercore')
         # If running in container, use container name
         if os.path.exists('/.dockerenv'):
             self.kc_server = os.getenv('KC_SERVER', 'http://keycloak:8080')
+        self.kc_health_url = self.kc_health_url or f"{self.kc_server.rstrip('/')}/health/ready"
         
         # PostgreSQL configuration
         self.db_host = os.getenv('DB_HOST', 'cybercore-postgres')
@@ -47,68 +91,266 @@ class KeycloakIntegration:
         self.ldap_bind_pw = os.getenv('LDAP_BIND_PW', '')
         self.ldap_type = os.getenv('LDAP_TYPE', 'activedirectory')
         
+        # User sync configuration
+        # 'bulk' pushes users through the realm partialImport endpoint in chunks,
+        # 'single' sends one POST per user, 'incremental' only pushes rows that
+        # changed since the last run (see keycloak_sync_state), 'sharded' splits
+        # bulk mode across leased hash buckets
+        self.sync_mode = os.getenv('SYNC_MODE', 'bulk').lower()
+        if self.sync_mode not in self.SYNC_MODES:
+            raise ValueError(f"SYNC_MODE must be one of {', '.join(self.SYNC_MODES)}, not {self.sync_mode!r}")
+        self.sync_batch_size = int(os.getenv('SYNC_BATCH_SIZE', '500'))
+        # Rows fetched per round trip from the server-side export cursor
+        self.sync_fetch_size = int(os.getenv('SYNC_FETCH_SIZE', '2000'))
+        # partialImport policy for users that already exist: SKIP, OVERWRITE or FAIL
+        self.sync_if_exists = os.getenv('SYNC_IF_EXISTS', 'SKIP').upper()
+        # Incremental runs re-read this many seconds before the stored watermark
+        # to catch transactions that committed late; content hashes dedupe them
+        self.sync_watermark_overlap = int(os.getenv('SYNC_WATERMARK_OVERLAP', '60'))
+        # A failing user holds the incremental watermark back for this many runs,
+        # then goes to the dead-letter file so one bad row cannot pin it
+        self.sync_max_attempts = int(os.getenv('SYNC_MAX_ATTEMPTS', '3'))
+        # Keycloak ID write-back is flushed every N links or T seconds
+        self.sync_write_batch = int(os.getenv('SYNC_WRITE_BATCH', '1000'))
+        self.sync_write_interval = float(os.getenv('SYNC_WRITE_INTERVAL', '2'))
+        # Sharded mode: SYNC_WORKERS processes (plus any started elsewhere with the
+        # same SYNC_RUN_ID and the shard-worker command) lease SYNC_SHARDS hash buckets of
+        # app_user.user_id from keycloak_sync_lease and bulk sync them independently
+        self.sync_shards = max(1, int(os.getenv('SYNC_SHARDS', '64')))
+        self.sync_workers = max(1, int(os.getenv('SYNC_WORKERS', '4')))
+        self.sync_run_id = os.getenv('SYNC_RUN_ID', '')
+        self.sync_lease_ttl = float(os.getenv('SYNC_LEASE_TTL', '300'))
+        self.sync_lease_attempts = int(os.getenv('SYNC_LEASE_ATTEMPTS', '3'))
+        # Multi-realm fan-out: "realm=group+group,..." pushes members of those
+        # app_group keys to each realm ("realm" or "realm=*" takes every user)
+        self.realm_groups = _parse_realm_groups(os.getenv('SYNC_REALMS', ''))
+        self.realm_results: Dict[str, Dict] = {}
+        # Reverse sync pages through Keycloak users this many at a time
+        self.sync_pull_page_size = int(os.getenv('SYNC_PULL_PAGE_SIZE', '500'))
+        # The ID cache, bulk journal and dead-letter file default to SYNC_STATE_DIR, which
+        # has to be a persistent volume: losing them after a restart re-posts every user
+        self.sync_state_dir = os.getenv('SYNC_STATE_DIR', '/var/lib/keycloak-sync')
+        # Username -> Keycloak ID cache consulted before creating users;
+        # an empty SYNC_ID_CACHE_FILE disables it
+        self.sync_id_cache_file = self._state_file('SYNC_ID_CACHE_FILE', 'keycloak-id-cache.sqlite')
+        self.sync_id_cache_ttl = float(os.getenv('SYNC_ID_CACHE_TTL', '3600'))
+        self.id_cache: Optional[KeycloakIdCache] = None
+        # Daemon mode: LISTEN on DAEMON_CHANNEL, wait DAEMON_DEBOUNCE seconds of quiet
+        # (at most DAEMON_MAX_DELAY after the first event) before pushing a batch.
+        # The triggers notify the channel named by the cyberhub.keycloak_sync_channel
+        # database setting, so a non-default DAEMON_CHANNEL needs that set to match
+        self.daemon_channel = os.getenv('DAEMON_CHANNEL', 'keycloak_sync')
+        self.daemon_debounce = float(os.getenv('DAEMON_DEBOUNCE', '0.2'))
+        self.daemon_max_delay = float(os.getenv('DAEMON_MAX_DELAY', '1.0'))
+        self.daemon_stats = {'batches': 0, 'events': 0, 'failed_batches': 0, 'max_latency_s': 0.0, 'last_latency_s': 0.0}
+        self._stopping = threading.Event()
+        # Run instrumentation; METRICS_FILE (empty disables) receives the Prometheus
+        # text format at the end of a run and after every daemon batch
+        self.metrics = Metrics()
+        self.metrics_file = os.getenv('METRICS_FILE', '')
+        # Bulk chunks are journaled here so an interrupted run can be resumed
+        # (empty disables)
+        self.sync_journal_file = self._state_file('SYNC_JOURNAL_FILE', 'keycloak-sync-journal.jsonl')
+        self.journal = SyncJournal(self.sync_journal_file) if self.sync_journal_file else None
+        # Users skipped after retries are recorded here for replay
+        self.dead_letters = DeadLetterQueue(self._state_file('SYNC_DEAD_LETTER_FILE', 'keycloak-dead-letter.jsonl'))
+        self.last_sync_stats: Dict = {}
+        self.last_pull_stats: Dict = {}
+        self.last_group_stats: Dict = {}
+        self._group_ids: Optional[Dict[str, str]] = None
+        self._prefetched_users: Optional[PrefetchedRows] = None
+        
+        # Admin API client
+        self.kc_concurrency = int(os.getenv('KC_CONCURRENCY', '8'))
+        self.kc_timeout = float(os.getenv('KC_TIMEOUT', '10'))
+        # Read timeout for partialImport chunks, which Keycloak commits as a whole;
+        # timing out a chunk that is still being written only to resend it wastes the work
+        self.kc_import_timeout = float(os.getenv('KC_IMPORT_TIMEOUT', '120'))
+        self.retry_policy = RetryPolicy(
+            max_attempts=int(os.getenv('KC_RETRY_ATTEMPTS', '5')),
+            base_delay=float(os.getenv('KC_RETRY_BASE_DELAY', '0.2')),
+            max_delay=float(os.getenv('KC_RETRY_MAX_DELAY', '10'))
+        )
+        self.limiter = AdaptiveLimiter(
+            self.kc_concurrency,
+            max_rate=float(os.getenv('KC_RATE_LIMIT', '200')),
+            target_latency=float(os.getenv('KC_TARGET_LATENCY', '1.0'))
+        )
+        self.client = KeycloakAdminClient(
+            self.kc_server, self.kc_concurrency, self.kc_timeout,
+            retry_policy=self.retry_policy, limiter=self.limiter, metrics=self.metrics
+        )
+        self.token_manager = TokenManager(
+            self.client,
+            realm=self.kc_auth_realm,
+            client_id=self.kc_client_id,
+            client_secret=self.kc_client_secret,
+            username=self.kc_admin_user,
+            password=self.kc_admin_pass,
+            refresh_skew=self.kc_token_refresh_skew
+        )
+        
+        self.reconciler = RealmReconciler(self.client, self.realm_name)
+        self.setup_graph: Optional[SetupGraph] = None
+        
         self.access_token = None
-        self.headers = {'Content-Type': 'application/json'}
         
-    def wait_for_keycloak(self, max_attempts: int = 30) -> bool:
-        """Wait for Keycloak to be ready"""
-        logger.info(f"Waiting for Keycloak at {self.kc_server}...")
+    def _state_file(self, env_var: str, name: str) -> str:
+        """Path from env_var if set, else name inside SYNC_STATE_DIR, which must already exist"""
+        path = os.getenv(env_var)
+        if path is not None:
+            return path
+        if not os.path.isdir(self.sync_state_dir):
+            raise ValueError(
+                f"SYNC_STATE_DIR {self.sync_state_dir} does not exist; mount a persistent volume there, "
+                f"point SYNC_STATE_DIR at one, or set {env_var} explicitly"
+            )
+        return os.path.join(self.sync_state_dir, name)
+    
+    def _poll_until_ready(self, name: str, probe: Callable[[], bool], deadline: float) -> bool:
+        """Call probe with exponential backoff until it succeeds, the deadline passes or a stop is requested"""
+        started = time.monotonic()
+        delay = self.ready_initial_delay
+        attempts = 0
         
-        for attempt in range(max_attempts):
+        while True:
+            attempts += 1
             try:
-                # If using localhost, add Host header for Traefik routing
-                headers = {}
-                if 'localhost' in self.kc_server:
-                    headers = {'Host': 'auth.localhost'}
-                
-                # Just check if Keycloak responds (redirects to /auth or /admin)
-                response = requests.get(f"{self.kc_server}", timeout=5, allow_redirects=False, headers=headers)
-                if response.status_code in [200, 302, 303]:
-                    logger.info("Keycloak is ready!")
+                if probe():
+                    elapsed = time.monotonic() - started
+                    self.readiness[name] = {'ready': True, 'seconds': round(elapsed, 3), 'attempts': attempts}
+                    logger.info(f"{name} is ready after {elapsed:.2f}s ({attempts} probes)")
                     return True
-            except requests.exceptions.RequestException as e:
-                logger.debug(f"Connection attempt failed: {e}")
+            except Exception as e:
+                logger.debug(f"{name} probe failed: {e}")
             
-            logger.info(f"Attempt {attempt + 1}/{max_attempts}...")
-            time.sleep(5)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set():
+                elapsed = time.monotonic() - started
+                self.readiness[name] = {'ready': False, 'seconds': round(elapsed, 3), 'attempts': attempts}
+                if self._stopping.is_set():
+                    logger.info(f"Stopped waiting for {name} after {elapsed:.1f}s")
+                else:
+                    logger.error(f"{name} not ready after {elapsed:.1f}s ({attempts} probes)")
+                return False
+            # Wakes as soon as SIGTERM/SIGINT sets the stop flag
+            if self._stopping.wait(min(delay * random.uniform(0.5, 1.0), remaining)):
+                continue
+            delay = min(delay * 2, self.ready_max_delay)
+    
+    def _probe_keycloak(self) -> bool:
+        """Check Keycloak's readiness endpoint, falling back to the root URL if health is not exposed"""
+        # If using localhost, add Host header for Traefik routing
+        headers = {}
+        if 'localhost' in self.kc_server:
+            headers = {'Host': 'auth.localhost'}
+        
+        # Probes bypass the admin client so boot-time failures do not throttle the limiter
+        if self.kc_health_url:
+            response = self.client.session.get(self.kc_health_url, timeout=2, headers=headers)
+            if response.status_code != 404:
+                return response.status_code == 200
+            logger.info(f"{self.kc_health_url} not found, probing {self.kc_server} instead")
+            self.kc_health_url = ''
+        
+        # Just check if Keycloak responds (redirects to /auth or /admin)
+        response = self.client.session.get(self.kc_server, timeout=2, allow_redirects=False, headers=headers)
+        return response.status_code in [200, 302, 303]
+    
+    def _probe_postgres(self) -> bool:
+        """Run SELECT 1 against the CyberCore database"""
+        conn = psycopg2.connect(
+            host=self.db_host,
+            port=self.db_port,
+            database=self.db_name,
+            user=self.db_user,
+            password=self.db_pass,
+            connect_timeout=2
+        )
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                return cursor.fetchone()[0] == 1
+        finally:
+            conn.close()
+    
+    def wait_for_keycloak(self, deadline: Optional[float] = None) -> bool:
+        """Wait for Keycloak to be ready"""
+        logger.info(f"Waiting for Keycloak at {self.kc_health_url or self.kc_server}...")
+        deadline = deadline or time.monotonic() + self.ready_timeout
+        return self._poll_until_ready('keycloak', self._probe_keycloak, deadline)
+    
+    def wait_for_postgres(self, deadline: Optional[float] = None) -> bool:
+        """Wait for PostgreSQL to accept queries"""
+        logger.info(f"Waiting for PostgreSQL at {self.db_host}:{self.db_port}...")
+        deadline = deadline or time.monotonic() + self.ready_timeout
+        return self._poll_until_ready('postgres', self._probe_postgres, deadline)
+    
+    def wait_for_services(self) -> bool:
+        """Probe Keycloak and PostgreSQL concurrently under one deadline"""
+        deadline = time.monotonic() + self.ready_timeout
+        with self.metrics.phase('readiness'), \
+                ThreadPoolExecutor(max_workers=2, thread_name_prefix='readiness') as pool:
+            keycloak = pool.submit(self.wait_for_keycloak, deadline)
+            postgres = pool.submit(self.wait_for_postgres, deadline)
+            ready = keycloak.result() and postgres.result()
         
-        logger.error(f"Keycloak failed to start after {max_attempts} attempts")
-        return False
+        self.readiness['time_to_ready_s'] = round(
+            max(probe['seconds'] for probe in self.readiness.values() if isinstance(probe, dict)), 3
+        )
+        return ready
+    
+    def start_user_prefetch(self):
+        """Begin streaming unsynced users on a background thread as soon as PostgreSQL answers"""
+        if self.sync_mode not in ('bulk', 'single') or self.realm_groups or self._prefetched_users is not None:
+            return
+        
+        def produce() -> Iterator[Dict]:
+            if not self.wait_for_postgres():
+                raise RuntimeError("PostgreSQL not ready for the user export")
+            conn = self._connect_db(readonly=True)
+            try:
+                yield from self._iter_unsynced_users(conn)
+            finally:
+                conn.close()
+        
+        self._prefetched_users = PrefetchedRows(produce, self.sync_fetch_size)
+    
+    def _take_unsynced_users(self, shard: Optional[Tuple[int, int]] = None) -> Iterable[Dict]:
+        """The prefetched user stream if run() started one, else a fresh stream that opens
+        its own read connection on first use"""
+        if self._prefetched_users is not None and shard is None:
+            users, self._prefetched_users = self._prefetched_users, None
+            return users
+        return self._stream_unsynced_users(shard)
+    
+    def _stream_unsynced_users(self, shard: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+        conn = self._connect_db(readonly=True)
+        try:
+            yield from self._iter_unsynced_users(conn, shard)
+        finally:
+            conn.close()
     
     def get_admin_token(self) -> bool:
-        """Get admin access token"""
-        logger.info("Getting admin token...")
-        
-        data = {
-            'username': self.kc_admin_user,
-            'password': self.kc_admin_pass,
-            'grant_type': 'password',
-            'client_id': 'admin-cli'
-        }
+        """Get admin access token and hand its lifecycle to the token manager"""
+        logger.info(f"Getting admin token ({self.token_manager.grant_type} grant)...")
         
         try:
-            response = requests.post(
-                f"{self.kc_server}/realms/master/protocol/openid-connect/token",
-                data=data
-            )
+            with self.metrics.phase('token'):
+                self.access_token = self.token_manager.token()
+            self.client.token_manager = self.token_manager
+            logger.info("Successfully obtained admin token")
+            return True
             
-            if response.status_code == 200:
-                self.access_token = response.json()['access_token']
-                self.headers['Authorization'] = f'Bearer {self.access_token}'
-                logger.info("Successfully obtained admin token")
-                return True
-            else:
-                logger.error(f"Failed to get admin token: {response.status_code}")
-                return False
-                
+        except TokenError as e:
+            logger.error(f"Failed to get admin token: {e}")
+            return False
         except Exception as e:
             logger.error(f"Error getting admin token: {e}")
             return False
     
-    def import_realm_config(self) -> bool:
-        """Import realm configuration from JSON file"""
-        logger.info(f"Importing realm configuration for {self.realm_name}...")
-        
+    def _desired_realm(self) -> Optional[Dict]:
+        """Realm representation from the JSON config file, if one is shipped"""
         realm_config_path = '/app/keycloak-realm-config.json'
         if not os.path.exists(realm_config_path):
             # Use the one we created
@@ -116,51 +358,63 @@ class KeycloakIntegration:
                 os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
                 'auth', 'keycloak-realm-config.json'
             )
-        
-        try:
-            with open(realm_config_path, 'r') as f:
-                realm_config = json.load(f)
-            
-            # Check if realm exists
-            check_response = requests.get(
-                f"{self.kc_server}/admin/realms/{self.realm_name}",
-                headers=self.headers
-            )
-            
-            if check_response.status_code == 200:
-                logger.info(f"Realm {self.realm_name} already exists, updating...")
-                # Update existing realm
-                response = requests.put(
-                    f"{self.kc_server}/admin/realms/{self.realm_name}",
-                    headers=self.headers,
-                    json=realm_config
-                )
-            else:
-                # Create new realm
-                response = requests.post(
-                    f"{self.kc_server}/admin/realms",
-                    headers=self.headers,
-                    json=realm_config
-                )
-            
-            if response.status_code in [201, 204]:
-                logger.info(f"Successfully imported realm {self.realm_name}")
-                return True
+        if not os.path.exists(realm_config_path):
+            return None
+        with open(realm_config_path, 'r') as f:
+            return json.load(f)
+    
+    def _apply_changes(self, changes: List[Dict]) -> bool:
+        """Apply planned changes, logging each; True if every write succeeded"""
+        ok = True
+        for change in changes:
+            label = f"{change['resource']} {change['name']}"
+            if change['action'] == 'noop':
+                logger.info(f"{label} is up to date")
+                continue
+            response = self.reconciler.apply(change)
+            if response.status_code in (200, 201, 204):
+                paths = ', '.join(path for path, _, _ in change['diff'][:5])
+                logger.info(f"{change['action'].capitalize()}d {label}" + (f" ({paths})" if paths else ''))
             else:
-                logger.error(f"Failed to import realm: {response.status_code}")
+                logger.error(f"Failed to {change['action']} {label}: {response.status_code}")
                 logger.error(response.text)
+                ok = False
+        return ok
+    
+    def plan(self) -> List[Dict]:
+        """Every change a run would make, without making it"""
+        self.reconciler.load()
+        changes = []
+        desired_realm = self._desired_realm()
+        if desired_realm is not None:
+            changes.extend(self.reconciler.plan_realm(desired_realm))
+        changes.append(self.reconciler.plan_component(self._postgres_storage_component()))
+        if self.ldap_enabled:
+            changes.append(self.reconciler.plan_component(self._ldap_component()))
+        changes.append(self.reconciler.plan_client(self._webhook_client()))
+        return changes
+    
+    def import_realm_config(self) -> bool:
+        """Reconcile the realm with the JSON config file"""
+        logger.info(f"Reconciling realm configuration for {self.realm_name}...")
+        
+        try:
+            realm_config = self._desired_realm()
+            if realm_config is None:
+                logger.error("No realm configuration file found")
                 return False
+            
+            self.reconciler.load()
+            return self._apply_changes(self.reconciler.plan_realm(realm_config))
                 
         except Exception as e:
             logger.error(f"Error importing realm config: {e}")
             return False
     
-    def configure_postgres_user_storage(self) -> bool:
-        """Configure PostgreSQL as a user storage provider"""
-        logger.info("Configuring PostgreSQL user storage provider...")
-        
+    def _postgres_storage_component(self) -> Dict:
+        """Desired PostgreSQL user storage component"""
         # Custom user storage provider configuration
-        storage_config = {
+        return {
             "name": "postgres-users",
             "providerId": "user-storage-jpa",
             "providerType": "org.keycloak.storage.UserStorageProvider",
@@ -184,27 +438,32 @@ class KeycloakIntegration:
                 "batchSizeForSync": ["1000"]
             }
         }
+    
+    def configure_postgres_user_storage(self) -> bool:
+        """Configure PostgreSQL as a user storage provider"""
+        logger.info("Configuring PostgreSQL user storage provider...")
         
         try:
-            response = requests.post(
-                f"{self.kc_server}/admin/realms/{self.realm_name}/components",
-                headers=self.headers,
-                json=storage_config
-            )
-            
-            if response.status_code in [201, 409]:
+            if self._apply_changes([self.reconciler.plan_component(self._postgres_storage_component())]):
                 logger.info("PostgreSQL user storage provider configured")
-                return True
             else:
-                logger.warning(f"Could not configure PostgreSQL storage: {response.status_code}")
                 # This might fail if custom provider is not available, continue anyway
-                return True
+                logger.warning("Could not configure PostgreSQL storage")
+            return True
                 
         except Exception as e:
             logger.warning(f"Error configuring PostgreSQL storage: {e}")
             # Continue even if this fails
             return True
     
+    def _ldap_component(self) -> Dict:
+        """Desired LDAP federation component for the configured directory type"""
+        if self.ldap_type == 'activedirectory':
+            return self._get_ad_config()
+        elif self.ldap_type == 'openldap':
+            return self._get_openldap_config()
+        return self._get_generic_ldap_config()
+    
     def configure_ldap_federation(self) -> bool:
         """Configure LDAP user federation if enabled"""
         if not self.ldap_enabled:
@@ -213,28 +472,11 @@ class KeycloakIntegration:
         
         logger.info(f"Configuring LDAP federation ({self.ldap_type})...")
         
-        # Determine LDAP configuration based on type
-        if self.ldap_type == 'activedirectory':
-            ldap_config = self._get_ad_config()
-        elif self.ldap_type == 'openldap':
-            ldap_config = self._get_openldap_config()
-        else:
-            ldap_config = self._get_generic_ldap_config()
-        
         try:
-            response = requests.post(
-                f"{self.kc_server}/admin/realms/{self.realm_name}/components",
-                headers=self.headers,
-                json=ldap_config
-            )
-            
-            if response.status_code in [201, 409]:
+            if self._apply_changes([self.reconciler.plan_component(self._ldap_component())]):
                 logger.info("LDAP federation configured successfully")
                 return True
-            else:
-                logger.error(f"Failed to configure LDAP: {response.status_code}")
-                logger.error(response.text)
-                return False
+            return False
                 
         except Exception as e:
             logger.error(f"Error configuring LDAP: {e}")
@@ -347,80 +589,1704 @@ class KeycloakIntegration:
             }
         }
     
+    def _connect_db(self, readonly: bool = False):
+        """Open a connection to the CyberCore PostgreSQL database"""
+        conn = psycopg2.connect(
+            host=self.db_host,
+            port=self.db_port,
+            database=self.db_name,
+            user=self.db_user,
+            password=self.db_pass
+        )
+        if readonly:
+            conn.set_session(readonly=True)
+        return conn
+    
+    def _iter_rows(self, conn, query: str, params=None, name: str = 'kc_user_export') -> Iterator[Dict]:
+        """Stream query results from a named server-side cursor, sync_fetch_size rows per round trip
+        
+        The cursor lives in the transaction of conn, so writes that commit must
+        go through a different connection while the generator is being consumed.
+        """
+        with conn.cursor(name=name, cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            while True:
+                with self.metrics.phase('postgres_fetch'):
+                    rows = cursor.fetchmany(self.sync_fetch_size)
+                if not rows:
+                    break
+                yield from rows
+    
+    def _iter_unsynced_users(self, conn, shard: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+        """Stream active users that are not yet linked to Keycloak, optionally only
+        those in hash bucket shard = (bucket, buckets)"""
+        if shard is None:
+            bucket_filter, params = '', None
+        else:
+            bucket_filter = "AND (hashtext(user_id::text) & 2147483647) %% %(buckets)s = %(bucket)s"
+            params = {'bucket': shard[0], 'buckets': shard[1]}
+        return self._iter_rows(conn, f"""
+            SELECT user_id, username, email, first_name, last_name, 
+                   active, status, auth_provider
+            FROM app_user 
+            WHERE active = TRUE AND status = 'active'
+              AND keycloak_id IS NULL
+              {bucket_filter}
+            ORDER BY user_id
+        """, params)
+    
+    def _build_keycloak_user(self, user: Dict) -> Dict:
+        """Build a Keycloak user representation from a PostgreSQL row"""
+        return {
+            "username": user['username'],
+            "email": user.get('email') or f"{user['username']}@cybercore.local",
+            "emailVerified": True,
+            "enabled": user['active'],
+            "firstName": user.get('first_name') or '',
+            "lastName": user.get('last_name') or '',
+            "attributes": {
+                "postgres_id": [str(user['user_id'])],
+                "auth_provider": [user.get('auth_provider') or 'postgres']
+            }
+        }
+    
     def sync_postgres_users(self) -> bool:
         """Sync existing PostgreSQL users to Keycloak"""
+        if self.sync_mode == 'sharded':
+            return self.sync_postgres_users_sharded()
+        self._load_id_cache()
+        if self.sync_mode == 'bulk':
+            return self.sync_postgres_users_bulk()
+        if self.sync_mode == 'incremental':
+            return self.sync_postgres_users_incremental()
+        
         logger.info("Syncing PostgreSQL users to Keycloak...")
         
+        write_conn = writer = None
         try:
-            # Connect to PostgreSQL
-            conn = psycopg2.connect(
-                host=self.db_host,
-                port=self.db_port,
-                database=self.db_name,
-                user=self.db_user,
-                password=self.db_pass
-            )
+            # Users are streamed from one connection and written back on another
+            write_conn = self._connect_db()
+            writer = self._id_writer(write_conn)
+            
+            users = self._link_cached_users(self._take_unsynced_users(), writer)
+            
+            # Create users in Keycloak concurrently; write-back stays on this thread
+            results = self.client.map_concurrent(self._create_keycloak_user, users)
+            
+            for user, response, error in results:
+                if error:
+                    logger.warning(f"Failed to sync user {user['username']}: {error}")
+                    self.dead_letters.add(self.realm_name, user, error)
+                elif response.status_code == 201:
+                    # Get the created user's ID
+                    location = response.headers.get('Location')
+                    if location:
+                        self._link_user(writer, user, location.split('/')[-1])
+                        logger.info(f"Synced user {user['username']}")
+                elif response.status_code == 409:
+                    # Created behind the cache's back; look the ID up so the row gets linked
+                    keycloak_id = self._find_keycloak_id(user['username'])
+                    if keycloak_id:
+                        self._link_user(writer, user, keycloak_id)
+                    logger.info(f"User {user['username']} already exists in Keycloak")
+                else:
+                    logger.warning(f"Failed to sync user {user['username']}: {response.status_code}")
+                    self.dead_letters.add(self.realm_name, user, response.status_code)
+            
+            writer.close()
+            self._log_write_failures(writer)
+            logger.info("User sync completed")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error syncing users: {e}")
+            if writer is not None:
+                # Keep the links of users that were created before the failure
+                try:
+                    writer.close()
+                except Exception as flush_error:
+                    logger.warning(f"Could not store pending Keycloak IDs: {flush_error}")
+            return False
+        finally:
+            if write_conn is not None:
+                write_conn.close()
+    
+    def _id_writer(self, conn) -> KeycloakIdWriter:
+        """Batched Keycloak ID write-back on conn"""
+        return KeycloakIdWriter(conn, self.sync_write_batch, self.sync_write_interval, self.metrics)
+    
+    def _log_write_failures(self, writer: KeycloakIdWriter):
+        """Report links that could not be written back"""
+        for user_id, reason in writer.failed.items():
+            logger.warning(f"Could not store Keycloak ID for user {user_id}: {reason}")
+    
+    def _create_keycloak_user(self, user: Dict) -> requests.Response:
+        """POST a single user to the realm"""
+        return self.client.post(
+            f"/admin/realms/{self.realm_name}/users",
+            json=self._build_keycloak_user(user)
+        )
+    
+    def _load_id_cache(self):
+        """Open the Keycloak ID cache, refilling it from one user listing when it has expired"""
+        if not self.sync_id_cache_file or self.id_cache is not None:
+            return
+        try:
+            cache = KeycloakIdCache(self.sync_id_cache_file, self.realm_name, self.sync_id_cache_ttl)
+            if not cache.fresh():
+                started = time.monotonic()
+                count = cache.refresh(self._iter_keycloak_users({'pages': 0}, brief=True))
+                logger.info(f"Cached {count} Keycloak user IDs in {time.monotonic() - started:.2f}s")
+            self.id_cache = cache
+        except Exception as e:
+            logger.warning(f"Keycloak ID cache unavailable, creating users without it: {e}")
+    
+    def _link_cached_users(self, users: Iterable[Dict], writer: KeycloakIdWriter, stats: Optional[Dict] = None) -> Iterator[Dict]:
+        """Link users the cache already knows and pass the rest on for creation"""
+        for user in users:
+            keycloak_id = self.id_cache.lookup(user['username'], user.get('email')) if self.id_cache else None
+            if keycloak_id:
+                writer.add(user['user_id'], keycloak_id)
+                if stats is not None:
+                    stats['cached'] += 1
+            else:
+                yield user
+    
+    def _link_user(self, writer: KeycloakIdWriter, user: Dict, keycloak_id: str):
+        writer.add(user['user_id'], keycloak_id)
+        if self.id_cache:
+            self.id_cache.put_many([(user['username'], user.get('email'), keycloak_id)])
+    
+    def _find_keycloak_id(self, username: str) -> Optional[str]:
+        """Keycloak ID of an existing user by exact username"""
+        response = self.client.get(
+            f"/admin/realms/{self.realm_name}/users",
+            params={'username': username, 'exact': 'true', 'briefRepresentation': 'true'}
+        )
+        if response.status_code != 200:
+            return None
+        matches = [user for user in response.json() if user['username'] == username.lower()]
+        return matches[0]['id'] if matches else None
+    
+    def sync_postgres_users_bulk(self, shard: Optional[Tuple[int, int]] = None) -> bool:
+        """Sync PostgreSQL users to Keycloak in chunks via partialImport"""
+        logger.info(
+            f"Bulk syncing PostgreSQL users to Keycloak "
+            f"(batch size {self.sync_batch_size}, ifResourceExists={self.sync_if_exists})"
+            + (f" for bucket {shard[0]}/{shard[1]}..." if shard else "...")
+        )
+        
+        stats = {'chunks': [], 'total': 0, 'added': 0, 'skipped': 0, 'overwritten': 0,
+                 'linked': 0, 'cached': 0, 'recovered': 0, 'failed': 0, 'write_failed': 0}
+        started = time.monotonic()
+        # Sharded buckets are re-leased instead of journaled
+        journal = self.journal if shard is None else None
+        
+        try:
+            # Without a prefetched stream the read connection opens once users are pulled
+            write_conn = self._connect_db()
+            writer = self._id_writer(write_conn)
+            
+            users = self._take_unsynced_users(shard)
+            if journal:
+                recovered = self._recover_from_journal(write_conn, writer, stats)
+                journal.start(self.realm_name)
+                if recovered:
+                    # A stream opened before recovery may still list the recovered users
+                    users = (user for user in users if str(user['user_id']) not in recovered)
+            if self.sync_if_exists != 'OVERWRITE':
+                # Existing users only need linking unless they are to be overwritten
+                users = self._link_cached_users(users, writer, stats)
+            chunks = enumerate(_chunked(users, self.sync_batch_size), start=1)
+            if journal:
+                chunks = journal.attempts(chunks)
+            unwritten: List[int] = []
+            
+            # Chunks are imported concurrently; linking runs on this thread
+            for (number, chunk), result, error in self.client.map_concurrent(
+                    lambda item: self._import_user_chunk(item[1]), chunks):
+                if error:
+                    # No response, so the chunk stays in doubt in the journal
+                    logger.warning(f"partialImport failed for chunk: {error}")
+                    chunk_stats, links = self._failed_chunk_stats(chunk), []
+                else:
+                    chunk_stats, links = result
+                    if journal:
+                        journal.append('confirm', chunk=number, links=links)
+                        unwritten.append(number)
+                
+                link_started = time.monotonic()
+                for user_id, keycloak_id in links:
+                    writer.add(user_id, keycloak_id)
+                if journal and unwritten and not writer.pending:
+                    # Everything confirmed so far has been committed to app_user
+                    journal.append('written', chunks=unwritten)
+                    unwritten = []
+                self._cache_links(chunk, links)
+                self._dead_letter_unlinked(chunk, links, error or chunk_stats.get('error'))
+                chunk_stats['seconds'] += time.monotonic() - link_started
+                chunk_stats['chunk'] = len(stats['chunks']) + 1
+                stats['chunks'].append(chunk_stats)
+                
+                for key in ('added', 'skipped', 'overwritten', 'linked', 'failed'):
+                    stats[key] += chunk_stats[key]
+                stats['total'] += chunk_stats['size']
+                
+                logger.info(
+                    f"Chunk {chunk_stats['chunk']}: {chunk_stats['size']} users "
+                    f"(added {chunk_stats['added']}, skipped {chunk_stats['skipped']}, "
+                    f"overwritten {chunk_stats['overwritten']}, linked {chunk_stats['linked']}, "
+                    f"failed {chunk_stats['failed']}) in {chunk_stats['seconds']:.2f}s"
+                )
             
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                # Get all active users
+            writer.close()
+            stats['write_failed'] = len(writer.failed)
+            self._log_write_failures(writer)
+            write_conn.close()
+            if journal:
+                journal.clear()
+            
+        except Exception as e:
+            logger.error(f"Error bulk syncing users: {e}")
+            if journal:
+                journal.close()
+                logger.info(f"Progress is kept in {journal.path}; the next bulk run resumes from it")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_sync_stats = stats
+        
+        logger.info(
+            f"Bulk user sync completed: {stats['total'] + stats['cached']} users in {len(stats['chunks'])} chunks "
+            f"(added {stats['added']}, skipped {stats['skipped']}, linked {stats['linked']}, "
+            f"linked from cache {stats['cached']}, recovered {stats['recovered']}, "
+            f"failed {stats['failed']}) in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0 and stats['write_failed'] == 0
+    
+    def _recover_from_journal(self, conn, writer: KeycloakIdWriter, stats: Dict) -> set:
+        """Finish what an interrupted bulk run left behind, returning the user IDs it covered
+        
+        Confirmed chunks that were not written back are linked straight from the
+        journal. Users of in-doubt chunks that are still unlinked are sent again
+        as SKIP partialImports, which create the missing ones and return the IDs
+        of those that made it, so nothing surfaces as a conflict.
+        """
+        state = self.journal.load()
+        if not state or not state['attempted']:
+            return set()
+        if state['realm'] != self.realm_name:
+            logger.warning(f"Ignoring sync journal {self.journal.path} of realm {state['realm']}")
+            return set()
+        
+        started = time.monotonic()
+        links = [link for number, chunk_links in state['confirmed'].items()
+                 if number not in state['written'] for link in chunk_links]
+        in_doubt = [user_id for number, user_ids in state['attempted'].items()
+                    if number not in state['confirmed'] for user_id in user_ids]
+        covered = {user_id for user_id, _ in links} | set(in_doubt)
+        
+        for user_id, keycloak_id in links:
+            writer.add(user_id, keycloak_id)
+        
+        requests_sent = 0
+        if in_doubt:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute("""
-                    SELECT id, username, email, first_name, last_name, 
+                    SELECT user_id, username, email, first_name, last_name,
                            active, status, auth_provider
-                    FROM users 
-                    WHERE active = TRUE AND status = 'active'
-                """)
-                users = cursor.fetchall()
+                    FROM app_user
+                    WHERE user_id = ANY(%s::uuid[]) AND keycloak_id IS NULL
+                    ORDER BY user_id
+                """, (in_doubt,))
+                unlinked = cursor.fetchall()
+            conn.commit()
+            
+            def reconcile(chunk: List[Dict]) -> Tuple[Dict, List[Tuple]]:
+                return self._import_user_chunk(chunk, if_exists='SKIP')
+            
+            for chunk, result, error in self.client.map_concurrent(reconcile, _chunked(unlinked, self.sync_batch_size)):
+                requests_sent += 1
+                chunk_links = [] if error else result[1]
+                for user_id, keycloak_id in chunk_links:
+                    writer.add(user_id, keycloak_id)
+                links.extend(chunk_links)
+                # Left for the main pass, which will see them unlinked
+                covered.difference_update(str(user['user_id']) for user in chunk if error)
+        
+        writer.flush()
+        stats['recovered'] = len(links)
+        logger.info(
+            f"Resumed from {self.journal.path}: linked {len(links)} users "
+            f"({len(in_doubt)} in doubt, reconciled in {requests_sent} requests) "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+        return covered
+    
+    def sync_postgres_users_sharded(self) -> bool:
+        """Bulk sync split into hash buckets leased by SYNC_WORKERS processes
+        
+        This process works through buckets itself while SYNC_WORKERS - 1 copies of
+        the script run shard-worker on the same run ID; the result is read back
+        from the lease table once they have all exited.
+        """
+        run_id = self.sync_run_id or uuid.uuid4().hex
+        logger.info(
+            f"Sharded sync {run_id}: {self.sync_shards} buckets over {self.sync_workers} local workers..."
+        )
+        started = time.monotonic()
+        workers: List[subprocess.Popen] = []
+        # Refilled once here so the workers started below find it fresh
+        self._load_id_cache()
+        
+        try:
+            self._seed_leases(run_id)
+            env = dict(os.environ, SYNC_RUN_ID=run_id, SYNC_MODE='sharded')
+            for _ in range(self.sync_workers - 1):
+                workers.append(
+                    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'shard-worker'], env=env)
+                )
+            self._work_leases(run_id)
+            exit_codes = [worker.wait() for worker in workers]
+            stats = self._lease_summary(run_id)
+        except Exception as e:
+            logger.error(f"Error in sharded sync: {e}")
+            return False
+        finally:
+            # Workers still running here were orphaned by an error; their leases expire
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.terminate()
+                    try:
+                        worker.wait(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        worker.kill()
+                        worker.wait()
+        
+        stats['workers'] = self.sync_workers
+        stats['seconds'] = round(time.monotonic() - started, 3)
+        self.last_sync_stats = stats
+        logger.info(
+            f"Sharded sync completed: {stats['done']}/{self.sync_shards} buckets done "
+            f"({stats['failed_buckets']} failed, {stats['pending']} unfinished), "
+            f"{stats['total']} users (added {stats['added']}, linked {stats['linked']}, "
+            f"failed {stats['failed']}) in {stats['seconds']:.2f}s"
+        )
+        if any(exit_codes):
+            logger.warning(f"Shard worker exit codes: {exit_codes}")
+        return stats['done'] == self.sync_shards and stats['failed'] == 0
+    
+    def run_shard_worker(self) -> bool:
+        """Entry point for shard-worker: lease buckets of SYNC_RUN_ID until none are left"""
+        if not self.sync_run_id:
+            logger.error("shard-worker needs SYNC_RUN_ID")
+            return False
+        if not self.wait_for_services() or not self.get_admin_token():
+            return False
+        self._load_id_cache()
+        try:
+            self._seed_leases(self.sync_run_id)
+            return self._work_leases(self.sync_run_id)
+        finally:
+            self.client.close()
+            self.write_metrics()
+    
+    def _seed_leases(self, run_id: str):
+        """Create the run's buckets (idempotent, so any worker may start a run) and prune old runs"""
+        conn = self._connect_db()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM keycloak_sync_lease WHERE realm = %s AND run_id <> %s "
+                    "AND updated_at < now() - interval '7 days'",
+                    (self.realm_name, run_id)
+                )
+                cursor.execute("""
+                    INSERT INTO keycloak_sync_lease (realm, run_id, bucket)
+                    SELECT %s, %s, bucket FROM generate_series(0, %s - 1) AS bucket
+                    ON CONFLICT DO NOTHING
+                """, (self.realm_name, run_id, self.sync_shards))
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def _work_leases(self, run_id: str) -> bool:
+        """Claim buckets one at a time with FOR UPDATE SKIP LOCKED and bulk sync each
+        
+        The lease is renewed in the background while a bucket is processed; a
+        failed bucket is released for another attempt (up to sync_lease_attempts)
+        and an expired lease, e.g. of a worker that died, can be claimed again.
+        """
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        params = {'realm': self.realm_name, 'run_id': run_id, 'owner': owner,
+                  'ttl': self.sync_lease_ttl, 'attempts': self.sync_lease_attempts}
+        conn = self._connect_db()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        all_ok = True
+        
+        try:
+            while True:
+                with conn.cursor() as cursor:
+                    cursor.execute(self._CLAIM_LEASE_SQL, params)
+                    row = cursor.fetchone()
+                if row is None:
+                    return all_ok
+                bucket, buckets = row
+                params['bucket'] = bucket
+                
+                renewing = threading.Event()
+                
+                def renew(lease: Dict):
+                    # psycopg2 connections are not safe to share between threads, so the
+                    # heartbeat keeps its own and reconnects after a failed renewal
+                    renew_conn = None
+                    try:
+                        while not renewing.wait(self.sync_lease_ttl / 3):
+                            try:
+                                if renew_conn is None or renew_conn.closed:
+                                    renew_conn = self._connect_db()
+                                    renew_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                                with renew_conn.cursor() as cursor:
+                                    cursor.execute(
+                                        "UPDATE keycloak_sync_lease "
+                                        "SET leased_until = now() + make_interval(secs => %(ttl)s), updated_at = now() "
+                                        "WHERE realm = %(realm)s AND run_id = %(run_id)s AND bucket = %(bucket)s "
+                                        "AND owner = %(owner)s", lease
+                                    )
+                                    if cursor.rowcount == 0:
+                                        logger.warning(f"Lease on bucket {lease['bucket']} was lost to another worker")
+                            except Exception as e:
+                                logger.warning(f"Could not renew the lease on bucket {lease['bucket']}: {e}")
+                                if renew_conn is not None:
+                                    renew_conn.close()
+                                    renew_conn = None
+                    finally:
+                        if renew_conn is not None:
+                            renew_conn.close()
+                
+                heartbeat = threading.Thread(target=renew, args=(dict(params),), daemon=True, name='lease-renew')
+                heartbeat.start()
+                try:
+                    ok = self.sync_postgres_users_bulk(shard=(bucket, buckets))
+                finally:
+                    renewing.set()
+                    heartbeat.join()
+                
+                stats = {key: value for key, value in self.last_sync_stats.items() if key != 'chunks'}
+                with conn.cursor() as cursor:
+                    cursor.execute(self._FINISH_LEASE_SQL, dict(params, ok=ok, stats=json.dumps(stats)))
+                if not ok:
+                    all_ok = False
+                    logger.warning(f"Bucket {bucket} failed, released for another attempt")
+        finally:
+            conn.close()
+    
+    def _lease_summary(self, run_id: str) -> Dict:
+        """Bucket states and summed user counts of one sharded run"""
+        conn = self._connect_db(readonly=True)
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT count(*) FILTER (WHERE status = 'done') AS done,
+                           count(*) FILTER (WHERE status = 'failed') AS failed_buckets,
+                           count(*) FILTER (WHERE status IN ('pending', 'leased')) AS pending,
+                           coalesce(sum((stats->>'total')::int), 0) AS total,
+                           coalesce(sum((stats->>'added')::int), 0) AS added,
+                           coalesce(sum((stats->>'skipped')::int), 0) AS skipped,
+                           coalesce(sum((stats->>'linked')::int), 0) AS linked,
+                           coalesce(sum((stats->>'failed')::int), 0) AS failed
+                    FROM keycloak_sync_lease
+                    WHERE realm = %s AND run_id = %s
+                """, (self.realm_name, run_id))
+                return {'run_id': run_id, 'buckets': self.sync_shards,
+                        **{key: int(value) for key, value in cursor.fetchone().items()}}
+        finally:
+            conn.close()
+    
+    # Next claimable bucket: pending, or leased by a worker whose lease ran out.
+    # Expired leases that used up their attempts are marked failed on the way,
+    # so a crashing bucket cannot stay 'leased' and keep the run from finishing
+    _CLAIM_LEASE_SQL = """
+        WITH exhausted AS (
+            UPDATE keycloak_sync_lease
+            SET status = 'failed', owner = NULL, leased_until = NULL, updated_at = now()
+            WHERE realm = %(realm)s AND run_id = %(run_id)s
+              AND status = 'leased' AND leased_until < now() AND attempts >= %(attempts)s
+        )
+        UPDATE keycloak_sync_lease AS l
+        SET status = 'leased', owner = %(owner)s, attempts = l.attempts + 1,
+            leased_until = now() + make_interval(secs => %(ttl)s), updated_at = now()
+        WHERE (l.realm, l.run_id, l.bucket) = (
+            SELECT realm, run_id, bucket FROM keycloak_sync_lease
+            WHERE realm = %(realm)s AND run_id = %(run_id)s
+              AND (status = 'pending' OR (status = 'leased' AND leased_until < now()))
+              AND attempts < %(attempts)s
+            ORDER BY bucket
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING l.bucket, (SELECT count(*) FROM keycloak_sync_lease
+                             WHERE realm = %(realm)s AND run_id = %(run_id)s)
+    """
+    
+    _FINISH_LEASE_SQL = """
+        UPDATE keycloak_sync_lease
+        SET status = CASE WHEN %(ok)s THEN 'done'
+                          WHEN attempts >= %(attempts)s THEN 'failed'
+                          ELSE 'pending' END,
+            owner = CASE WHEN %(ok)s THEN owner END,
+            leased_until = NULL, stats = %(stats)s::jsonb, updated_at = now()
+        WHERE realm = %(realm)s AND run_id = %(run_id)s AND bucket = %(bucket)s AND owner = %(owner)s
+    """
+    
+    def _cache_links(self, chunk: List[Dict], links: List[Tuple]):
+        if not self.id_cache or not links:
+            return
+        by_id = {str(user['user_id']): user for user in chunk}
+        self.id_cache.put_many(
+            (by_id[user_id]['username'], by_id[user_id].get('email'), keycloak_id)
+            for user_id, keycloak_id in links
+        )
+    
+    def _dead_letter_unlinked(self, chunk: List[Dict], links: List[Tuple], error=None):
+        """Record every user of a chunk that did not come back with a Keycloak ID"""
+        if len(links) == len(chunk):
+            return
+        linked = {user_id for user_id, _ in links}
+        for user in chunk:
+            if str(user['user_id']) not in linked:
+                self.dead_letters.add(self.realm_name, user, error or 'not returned by partialImport')
+    
+    def _failed_chunk_stats(self, chunk: List[Dict]) -> Dict:
+        """Chunk statistics for a chunk that could not be imported at all"""
+        return {'size': len(chunk), 'added': 0, 'skipped': 0, 'overwritten': 0,
+                'linked': 0, 'failed': len(chunk), 'seconds': 0.0}
+    
+    def _import_user_chunk(self, chunk: List[Dict], if_exists: Optional[str] = None) -> Tuple[Dict, List[Tuple]]:
+        """Push one chunk of users through partialImport and collect the returned IDs"""
+        chunk_started = time.monotonic()
+        chunk_stats = {'size': len(chunk), 'added': 0, 'skipped': 0,
+                       'overwritten': 0, 'linked': 0, 'failed': 0}
+        
+        # Keycloak lowercases usernames, so match results case-insensitively
+        by_username = {user['username'].lower(): user for user in chunk}
+        
+        response = self.client.post(
+            f"/admin/realms/{self.realm_name}/partialImport",
+            json={
+                "ifResourceExists": if_exists or self.sync_if_exists,
+                "users": [self._build_keycloak_user(user) for user in chunk]
+            },
+            timeout=(self.kc_timeout, self.kc_import_timeout)
+        )
+        
+        if response.status_code != 200:
+            logger.warning(f"partialImport failed for chunk: {response.status_code}")
+            logger.warning(response.text)
+            chunk_stats = self._failed_chunk_stats(chunk)
+            chunk_stats['seconds'] = time.monotonic() - chunk_started
+            chunk_stats['error'] = f"partialImport returned {response.status_code}"
+            return chunk_stats, []
+        
+        result = response.json()
+        chunk_stats['added'] = result.get('added', 0)
+        chunk_stats['skipped'] = result.get('skipped', 0)
+        chunk_stats['overwritten'] = result.get('overwritten', 0)
+        
+        # Skipped and overwritten results carry the existing user's ID as well,
+        # so every user in the chunk can be linked in one pass
+        links = []
+        for item in result.get('results', []):
+            if item.get('resourceType') != 'USER' or not item.get('id'):
+                continue
+            user = by_username.get((item.get('resourceName') or '').lower())
+            if user:
+                links.append((str(user['user_id']), item['id']))
+        
+        chunk_stats['linked'] = len(links)
+        chunk_stats['failed'] = len(chunk) - len(links)
+        chunk_stats['seconds'] = time.monotonic() - chunk_started
+        return chunk_stats, links
+    
+    def _content_hash(self, keycloak_user: Dict) -> str:
+        """Stable hash of the fields pushed to Keycloak for one user"""
+        encoded = json.dumps(keycloak_user, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+    
+    def sync_postgres_users_incremental(self) -> bool:
+        """Push only users created, changed, suspended or deleted since the last run"""
+        logger.info("Incrementally syncing PostgreSQL users to Keycloak...")
+        
+        stats = {'created': 0, 'changed': 0, 'suspended': 0, 'deleted': 0,
+                 'unchanged': 0, 'failed': 0, 'dead_lettered': 0}
+        started = time.monotonic()
+        
+        try:
+            read_conn = self._connect_db(readonly=True)
+            write_conn = self._connect_db()
+            
+            with write_conn.cursor() as cursor:
+                watermark = self._load_watermark(cursor, 'push')
+            logger.info(f"Pushing changes since {watermark or 'the beginning'}")
+            
+            since = "'-infinity'::timestamptz" if watermark is None else \
+                "%(watermark)s::timestamptz - make_interval(secs => %(overlap)s)"
+            params = {'realm': self.realm_name, 'watermark': watermark,
+                      'overlap': self.sync_watermark_overlap}
+            
+            # Rows touched since the watermark with their last pushed state,
+            # then hard-deleted users that had been pushed. Users linked by a
+            # bulk or single sync have no sync state yet but carry their
+            # Keycloak ID on app_user (and on the tombstone once deleted)
+            rows = itertools.chain(
+                self._iter_rows(read_conn, f"""
+                    SELECT u.user_id, u.username, u.email, u.first_name, u.last_name,
+                           u.active, u.status, u.auth_provider, u.updated_at,
+                           COALESCE(s.keycloak_id, u.keycloak_id) AS keycloak_id, s.content_hash
+                    FROM app_user u
+                    LEFT JOIN keycloak_sync_state s
+                      ON s.realm = %(realm)s AND s.user_id = u.user_id
+                    WHERE u.updated_at >= {since}
+                    ORDER BY u.updated_at
+                """, params, name='kc_user_delta'),
+                self._iter_rows(read_conn, f"""
+                    SELECT t.user_id, t.deleted_at AS updated_at,
+                           COALESCE(s.keycloak_id, t.keycloak_id) AS keycloak_id
+                    FROM app_user_tombstone t
+                    LEFT JOIN keycloak_sync_state s
+                      ON s.realm = %(realm)s AND s.user_id = t.user_id
+                    WHERE t.deleted_at >= {since}
+                      AND COALESCE(s.keycloak_id, t.keycloak_id) IS NOT NULL
+                """, params, name='kc_user_tombstones')
+            )
+            
+            marks = self._push_user_rows(rows, write_conn, stats)
+            
+            # Failed rows hold the watermark back so the next run retries them
+            new_watermark = marks['failed'] or marks['processed'] or watermark
+            if new_watermark is not None:
+                with write_conn.cursor() as cursor:
+                    self._save_watermark(cursor, 'push', new_watermark)
+            write_conn.commit()
+            read_conn.close()
+            write_conn.close()
+            
+        except Exception as e:
+            logger.error(f"Error incrementally syncing users: {e}")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_sync_stats = stats
+        
+        logger.info(
+            f"Incremental user sync completed: created {stats['created']}, changed {stats['changed']}, "
+            f"suspended {stats['suspended']}, deleted {stats['deleted']}, "
+            f"unchanged {stats['unchanged']}, failed {stats['failed']} "
+            f"(dead-lettered {stats['dead_lettered']}) in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0
+    
+    def sync_selected_users(self, selectors: List[str]) -> bool:
+        """Push just the named users, by user ID or username, ignoring the watermark
+        
+        Meant for per-event hooks: no ID cache refill and no scan of app_user,
+        only the matching rows (and tombstones of deleted ones) are pushed.
+        """
+        logger.info(f"Syncing {len(selectors)} selected users to Keycloak...")
+        
+        stats = {'created': 0, 'changed': 0, 'suspended': 0, 'deleted': 0,
+                 'unchanged': 0, 'failed': 0, 'dead_lettered': 0}
+        started = time.monotonic()
+        params = {'realm': self.realm_name, 'selectors': list(selectors),
+                  'usernames': [selector.lower() for selector in selectors]}
+        
+        try:
+            read_conn = self._connect_db(readonly=True)
+            write_conn = self._connect_db()
+            
+            # Users linked by an earlier bulk sync have no sync state yet but
+            # carry their Keycloak ID on app_user and app_user_tombstone
+            rows = itertools.chain(
+                self._iter_rows(read_conn, """
+                    SELECT u.user_id, u.username, u.email, u.first_name, u.last_name,
+                           u.active, u.status, u.auth_provider, u.updated_at,
+                           COALESCE(s.keycloak_id, u.keycloak_id) AS keycloak_id, s.content_hash
+                    FROM app_user u
+                    LEFT JOIN keycloak_sync_state s
+                      ON s.realm = %(realm)s AND s.user_id = u.user_id
+                    WHERE u.user_id::text = ANY(%(selectors)s) OR lower(u.username) = ANY(%(usernames)s)
+                """, params, name='kc_user_selected'),
+                self._iter_rows(read_conn, """
+                    SELECT DISTINCT ON (t.user_id) t.user_id, t.deleted_at AS updated_at,
+                           COALESCE(s.keycloak_id, t.keycloak_id) AS keycloak_id
+                    FROM app_user_tombstone t
+                    LEFT JOIN keycloak_sync_state s
+                      ON s.realm = %(realm)s AND s.user_id = t.user_id
+                    WHERE (t.user_id::text = ANY(%(selectors)s) OR lower(t.username) = ANY(%(usernames)s))
+                      AND COALESCE(s.keycloak_id, t.keycloak_id) IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM app_user u WHERE u.user_id = t.user_id)
+                    ORDER BY t.user_id, t.deleted_at DESC
+                """, params, name='kc_user_selected_tombstones')
+            )
+            
+            marks = self._push_user_rows(rows, write_conn, stats)
+            write_conn.commit()
+            read_conn.close()
+            write_conn.close()
+            
+        except Exception as e:
+            logger.error(f"Error syncing selected users: {e}")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_sync_stats = stats
+        
+        if marks['processed'] is None:
+            logger.warning(f"No app_user rows match {', '.join(selectors)}")
+        logger.info(
+            f"Selected user sync completed: created {stats['created']}, changed {stats['changed']}, "
+            f"suspended {stats['suspended']}, deleted {stats['deleted']}, "
+            f"unchanged {stats['unchanged']}, failed {stats['failed']} "
+            f"(dead-lettered {stats['dead_lettered']}) in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0 and marks['processed'] is not None
+    
+    def _push_user_rows(self, rows: Iterable[Dict], write_conn, stats: Dict) -> Dict:
+        """Push app_user rows joined to their keycloak_sync_state and record the result
+        
+        Returns the newest processed updated_at and the oldest updated_at of a
+        failure that will be retried; the caller commits write_conn.
+        """
+        marks = {'processed': None, 'failed': None}
+        state_upserts, state_deletes, recreates, failures = [], [], [], []
+        writer = self._id_writer(write_conn)
+        
+        def record_failure(user, reason):
+            logger.warning(f"Failed to push change for {user.get('username', user['user_id'])}: {reason}")
+            stats['failed'] += 1
+            failures.append((user, reason))
+        
+        def record_creates(chunk, result, error):
+            linked = dict(result[1]) if not error else {}
+            self._cache_links(chunk, list(linked.items()))
+            for user in chunk:
+                keycloak_id = linked.get(str(user['user_id']))
+                if keycloak_id:
+                    stats['created'] += 1
+                    writer.add(user['user_id'], keycloak_id)
+                    state_upserts.append((self.realm_name, str(user['user_id']), keycloak_id, user['new_hash']))
+                else:
+                    record_failure(user, error or 'not imported')
+        
+        actions = self._plan_incremental_actions(rows, stats, marks)
+        with write_conn.cursor() as cursor:
+            # Creates go out as partialImport chunks, changes and deletes as
+            # single requests, all through the same bounded pool
+            for (kind, payload), result, error in self.client.map_concurrent(self._apply_incremental_action, actions):
+                if kind == 'create':
+                    record_creates(payload, result, error)
+                else:
+                    user = payload
+                    status = None if error else result.status_code
+                    if user['action'] == 'delete' and status in (204, 404):
+                        stats['deleted'] += 1
+                        state_deletes.append(str(user['user_id']))
+                    elif user['action'] == 'update' and status == 204:
+                        stats['suspended' if not user['keycloak_user']['enabled'] else 'changed'] += 1
+                        if user.get('cached'):
+                            writer.add(user['user_id'], user['keycloak_id'])
+                        state_upserts.append((self.realm_name, str(user['user_id']), user['keycloak_id'], user['new_hash']))
+                    elif user['action'] == 'update' and status == 404:
+                        # Removed from Keycloak behind our back, create it again
+                        recreates.append(user)
+                    else:
+                        record_failure(user, error or status)
                 
-                for user in users:
-                    # Skip if user already has a Keycloak ID
-                    if user.get('keycloak_id'):
-                        continue
-                    
-                    # Create user in Keycloak
-                    keycloak_user = {
-                        "username": user['username'],
-                        "email": user.get('email', f"{user['username']}@cybercore.local"),
-                        "emailVerified": True,
-                        "enabled": user['active'],
-                        "firstName": user.get('first_name', ''),
-                        "lastName": user.get('last_name', ''),
-                        "attributes": {
-                            "postgres_id": [str(user['id'])],
-                            "auth_provider": [user.get('auth_provider', 'postgres')]
-                        }
-                    }
-                    
-                    response = requests.post(
-                        f"{self.kc_server}/admin/realms/{self.realm_name}/users",
-                        headers=self.headers,
-                        json=keycloak_user
+                # Keep state memory bounded on large first runs
+                if len(state_upserts) + len(state_deletes) >= self.sync_batch_size:
+                    self._save_sync_state(cursor, state_upserts, state_deletes)
+                    write_conn.commit()
+                    state_upserts, state_deletes = [], []
+            
+            recreate_chunks = (('create', chunk) for chunk in _chunked(recreates, self.sync_batch_size))
+            for (_, chunk), result, error in self.client.map_concurrent(self._apply_incremental_action, recreate_chunks):
+                record_creates(chunk, result, error)
+            
+            writer.close()
+            self._log_write_failures(writer)
+            self._save_sync_state(cursor, state_upserts, state_deletes)
+            self._record_push_failures(cursor, failures, stats, marks)
+        return marks
+    
+    def _record_push_failures(self, cursor, failures: List[Tuple[Dict, object]], stats: Dict, marks: Dict):
+        """Count failed attempts per user: below sync_max_attempts the user holds the
+        watermark back for a retry, at the limit it is dead-lettered and left behind"""
+        by_user = {}
+        for user, reason in failures:
+            user_id = str(user['user_id'])
+            if user_id not in by_user or user['updated_at'] < by_user[user_id][0]['updated_at']:
+                by_user[user_id] = (user, reason)
+        if not by_user:
+            return
+        
+        rows = psycopg2.extras.execute_values(
+            cursor,
+            """
+            INSERT INTO keycloak_sync_failure (realm, user_id, attempts, last_error)
+            VALUES %s
+            ON CONFLICT (realm, user_id) DO UPDATE
+            SET attempts = keycloak_sync_failure.attempts + 1,
+                last_error = EXCLUDED.last_error,
+                updated_at = now()
+            RETURNING user_id::text, attempts
+            """,
+            [(self.realm_name, user_id, str(reason)) for user_id, (_, reason) in by_user.items()],
+            template="(%s, %s::uuid, 1, %s)",
+            page_size=1000,
+            fetch=True
+        )
+        for user_id, attempts in rows:
+            user, reason = by_user[user_id]
+            if attempts >= self.sync_max_attempts:
+                self.dead_letters.add(self.realm_name, user, reason, user.get('action', 'create'))
+                stats['dead_lettered'] += 1
+            elif marks['failed'] is None or user['updated_at'] < marks['failed']:
+                marks['failed'] = user['updated_at']
+    
+    def _plan_incremental_actions(self, rows: Iterable[Dict], stats: Dict, marks: Dict) -> Iterator[Tuple[str, object]]:
+        """Classify streamed delta rows into ('change', user) and ('create', chunk) actions"""
+        pending_creates = []
+        
+        for user in rows:
+            if marks['processed'] is None or user['updated_at'] > marks['processed']:
+                marks['processed'] = user['updated_at']
+            
+            # Tombstone rows only carry the ID
+            if 'username' not in user:
+                user['action'] = 'delete'
+                yield 'change', user
+                continue
+            
+            keycloak_user = self._build_keycloak_user(user)
+            keycloak_user['enabled'] = bool(user['active']) and user['status'] == 'active'
+            user['keycloak_user'] = keycloak_user
+            user['new_hash'] = self._content_hash(keycloak_user)
+            
+            if user['status'] == 'deleted':
+                if user['keycloak_id']:
+                    user['action'] = 'delete'
+                    yield 'change', user
+                else:
+                    stats['unchanged'] += 1
+            elif not user['keycloak_id']:
+                cached_id = self.id_cache.lookup(user['username'], user.get('email')) if self.id_cache else None
+                if cached_id:
+                    # Never pushed from here but already in Keycloak: link and update instead of creating
+                    user.update(keycloak_id=cached_id, cached=True, action='update')
+                    yield 'change', user
+                # Never pushed: only active accounts are created
+                elif keycloak_user['enabled']:
+                    pending_creates.append(user)
+                    if len(pending_creates) >= self.sync_batch_size:
+                        yield 'create', pending_creates
+                        pending_creates = []
+                else:
+                    stats['unchanged'] += 1
+            elif user['new_hash'] != user['content_hash']:
+                user['action'] = 'update'
+                yield 'change', user
+            else:
+                stats['unchanged'] += 1
+        
+        if pending_creates:
+            yield 'create', pending_creates
+    
+    def _apply_incremental_action(self, action: Tuple[str, object]):
+        """Worker side of the incremental sync: import a chunk or push one change"""
+        kind, payload = action
+        if kind == 'create':
+            return self._import_user_chunk(payload)
+        return self._push_user_change(payload)
+    
+    def _push_user_change(self, user: Dict) -> requests.Response:
+        """Update or delete a user that already exists in Keycloak"""
+        path = f"/admin/realms/{self.realm_name}/users/{user['keycloak_id']}"
+        if user['action'] == 'delete':
+            return self.client.delete(path)
+        return self.client.put(path, json=user['keycloak_user'])
+    
+    def _save_sync_state(self, cursor, upserts: List[Tuple], deletes: List[str]):
+        """Record pushed content hashes and forget deleted users"""
+        if upserts:
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                INSERT INTO keycloak_sync_state (realm, user_id, keycloak_id, content_hash)
+                VALUES %s
+                ON CONFLICT (realm, user_id) DO UPDATE
+                SET keycloak_id = EXCLUDED.keycloak_id,
+                    content_hash = EXCLUDED.content_hash,
+                    synced_at = now()
+                """,
+                upserts,
+                template="(%s, %s::uuid, %s, %s)",
+                page_size=1000
+            )
+        if deletes:
+            cursor.execute(
+                "DELETE FROM keycloak_sync_state WHERE realm = %s AND user_id = ANY(%s::uuid[])",
+                (self.realm_name, deletes)
+            )
+        self._clear_push_failures(cursor, [upsert[1] for upsert in upserts] + deletes)
+    
+    def _clear_push_failures(self, cursor, user_ids: List[str]):
+        """Reset the attempt count of users that were pushed"""
+        if user_ids:
+            cursor.execute(
+                "DELETE FROM keycloak_sync_failure WHERE realm = %s AND user_id = ANY(%s::uuid[])",
+                (self.realm_name, user_ids)
+            )
+    
+    def _load_watermark(self, cursor, direction: str):
+        cursor.execute(
+            "SELECT high_water FROM keycloak_sync_watermark "
+            "WHERE realm = %s AND direction = %s",
+            (self.realm_name, direction)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def _save_watermark(self, cursor, direction: str, high_water):
+        cursor.execute("""
+            INSERT INTO keycloak_sync_watermark (realm, direction, high_water)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (realm, direction) DO UPDATE
+            SET high_water = EXCLUDED.high_water, updated_at = now()
+        """, (self.realm_name, direction, high_water))
+    
+    def for_realm(self, realm: str) -> 'KeycloakIntegration':
+        """Shallow copy bound to another realm
+        
+        The copy shares the admin client (connection pool, worker pool and
+        limiter), token manager, metrics and dead-letter file; realm state and
+        run results are its own.
+        """
+        other = copy.copy(self)
+        other.realm_name = realm
+        other.reconciler = RealmReconciler(self.client, realm)
+        other.id_cache = None
+        other.journal = None
+        other.setup_graph = None
+        other.last_sync_stats, other.last_pull_stats, other.last_group_stats = {}, {}, {}
+        other.realm_results = {}
+        other._group_ids = None
+        other._prefetched_users = None
+        return other
+    
+    def sync_realms(self) -> bool:
+        """Read active users once and push each configured realm's share of them concurrently
+        
+        Users are routed to every realm whose groups they belong to and that has no
+        keycloak_sync_state row for them yet; links are recorded per realm there.
+        """
+        realms = self.realm_groups
+        logger.info(f"Fanning users out to {len(realms)} realms: {', '.join(realms)}")
+        started = time.monotonic()
+        
+        def produce() -> Iterator[Dict]:
+            conn = self._connect_db(readonly=True)
+            try:
+                yield from self._iter_rows(conn, """
+                    SELECT u.user_id, u.username, u.email, u.first_name, u.last_name,
+                           u.active, u.status, u.auth_provider,
+                           ARRAY(SELECT g.group_key FROM user_group g
+                                 WHERE g.user_id = u.user_id) AS groups,
+                           ARRAY(SELECT s.realm FROM keycloak_sync_state s
+                                 WHERE s.user_id = u.user_id AND s.realm = ANY(%(realms)s)) AS synced_realms
+                    FROM app_user u
+                    WHERE u.active = TRUE AND u.status = 'active'
+                    ORDER BY u.user_id
+                """, {'realms': list(realms)}, name='kc_realm_export')
+            finally:
+                conn.close()
+        
+        def route(user: Dict) -> List[str]:
+            return [
+                realm for realm, groups in realms.items()
+                if realm not in user['synced_realms'] and (groups is None or not groups.isdisjoint(user['groups']))
+            ]
+        
+        partition = PartitionedRows(produce, route, realms, self.sync_fetch_size)
+        
+        def push(realm: str) -> Tuple['KeycloakIntegration', bool]:
+            target = self.for_realm(realm)
+            try:
+                ok = target._sync_realm_users(partition.stream(realm), link_app_user=realm == self.realm_name)
+            finally:
+                partition.close(realm)
+            return target, ok
+        
+        with ThreadPoolExecutor(max_workers=len(realms), thread_name_prefix='realm') as pool:
+            results = list(pool.map(push, realms))
+        
+        self.realm_results = {target.realm_name: dict(target.last_sync_stats, ok=ok) for target, ok in results}
+        self.last_sync_stats = {
+            'realms': len(realms),
+            'read': partition.rows,
+            'failed_realms': sum(1 for _, ok in results if not ok),
+            'seconds': round(time.monotonic() - started, 3)
+        }
+        for realm, result in self.realm_results.items():
+            logger.info(
+                f"Realm {realm}: {result.get('total', 0)} users (added {result.get('added', 0)}, "
+                f"linked {result.get('linked', 0)}, failed {result.get('failed', 0)}) "
+                f"in {result.get('seconds', 0):.2f}s" + ('' if result['ok'] else ' - FAILED')
+            )
+        logger.info(
+            f"Multi-realm sync read {partition.rows} users once for {len(realms)} realms "
+            f"in {self.last_sync_stats['seconds']:.2f}s"
+        )
+        return self.last_sync_stats['failed_realms'] == 0
+    
+    def _sync_realm_users(self, users: Iterable[Dict], link_app_user: bool = False) -> bool:
+        """Import one realm's share of the export, creating the realm if it is missing
+        
+        Links go to keycloak_sync_state for this realm with the content hash an
+        incremental run would compute; link_app_user also writes app_user.keycloak_id.
+        """
+        stats = {'total': 0, 'added': 0, 'skipped': 0, 'overwritten': 0, 'linked': 0, 'failed': 0}
+        started = time.monotonic()
+        
+        try:
+            if not self._apply_changes(self.reconciler.plan_realm({'realm': self.realm_name, 'enabled': True})):
+                stats['error'] = 'realm not available'
+                return False
+            
+            write_conn = self._connect_db()
+            try:
+                writer = self._id_writer(write_conn) if link_app_user else None
+                chunks = _chunked(users, self.sync_batch_size)
+                with write_conn.cursor() as cursor:
+                    for chunk, result, error in self.client.map_concurrent(self._import_user_chunk, chunks):
+                        if error:
+                            logger.warning(f"partialImport failed for chunk in realm {self.realm_name}: {error}")
+                            chunk_stats, links = self._failed_chunk_stats(chunk), []
+                        else:
+                            chunk_stats, links = result
+                        
+                        by_id = {str(user['user_id']): user for user in chunk}
+                        self._save_sync_state(cursor, [
+                            (self.realm_name, user_id, keycloak_id,
+                             self._content_hash(self._build_keycloak_user(by_id[user_id])))
+                            for user_id, keycloak_id in links
+                        ], [])
+                        write_conn.commit()
+                        if writer:
+                            for user_id, keycloak_id in links:
+                                writer.add(user_id, keycloak_id)
+                        self._dead_letter_unlinked(chunk, links, error or chunk_stats.get('error'))
+                        
+                        for key in ('added', 'skipped', 'overwritten', 'linked', 'failed'):
+                            stats[key] += chunk_stats[key]
+                        stats['total'] += chunk_stats['size']
+                if writer:
+                    writer.close()
+                    stats['write_failed'] = len(writer.failed)
+                    self._log_write_failures(writer)
+            finally:
+                write_conn.close()
+            
+        except Exception as e:
+            logger.error(f"Error syncing users to realm {self.realm_name}: {e}")
+            stats['error'] = str(e)
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_sync_stats = stats
+        
+        return stats['failed'] == 0 and not stats.get('write_failed')
+    
+    def sync_groups(self) -> bool:
+        """Push app_group/user_group to Keycloak groups, sending only membership adds and removes
+        
+        Membership on both sides is indexed in memory by Keycloak user ID. Only
+        members linked to an app_user row are ever removed, so accounts that
+        exist only in Keycloak keep their groups.
+        """
+        logger.info("Syncing module groups to Keycloak...")
+        stats = {'groups_created': 0, 'added': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+        started = time.monotonic()
+        
+        try:
+            conn = self._connect_db(readonly=True)
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT key, label FROM app_group ORDER BY key")
+                labels = dict(cursor.fetchall())
+                cursor.execute("""
+                    SELECT g.group_key, u.keycloak_id
+                    FROM user_group g
+                    JOIN app_user u ON u.user_id = g.user_id
+                    WHERE u.keycloak_id IS NOT NULL
+                """)
+                desired: Dict[str, set] = {key: set() for key in labels}
+                for group_key, keycloak_id in cursor.fetchall():
+                    desired[group_key].add(keycloak_id)
+                cursor.execute("SELECT keycloak_id FROM app_user WHERE keycloak_id IS NOT NULL")
+                linked = {row[0] for row in cursor.fetchall()}
+            conn.close()
+            
+            group_ids = self._ensure_groups(labels, stats)
+            
+            def members(group_key: str) -> set:
+                return {member['id'] for member in self._iter_group_members(group_ids[group_key])}
+            
+            operations = []
+            for group_key, current, error in self.client.map_concurrent(members, list(group_ids)):
+                if error:
+                    raise error
+                adds = desired[group_key] - current
+                removes = (current & linked) - desired[group_key]
+                stats['unchanged'] += len(desired[group_key] & current)
+                operations.extend(('PUT', keycloak_id, group_key) for keycloak_id in adds)
+                operations.extend(('DELETE', keycloak_id, group_key) for keycloak_id in removes)
+            
+            def apply(operation: Tuple[str, str, str]) -> requests.Response:
+                method, keycloak_id, group_key = operation
+                return self.client.request(
+                    method, f"/admin/realms/{self.realm_name}/users/{keycloak_id}/groups/{group_ids[group_key]}"
+                )
+            
+            for (method, keycloak_id, group_key), response, error in self.client.map_concurrent(apply, operations):
+                if error is None and response.status_code == 204:
+                    stats['added' if method == 'PUT' else 'removed'] += 1
+                else:
+                    stats['failed'] += 1
+                    logger.warning(
+                        f"Failed to {'add' if method == 'PUT' else 'remove'} {keycloak_id} "
+                        f"{'to' if method == 'PUT' else 'from'} {group_key}: {error or response.status_code}"
                     )
-                    
-                    if response.status_code == 201:
-                        # Get the created user's ID
-                        location = response.headers.get('Location')
-                        if location:
-                            keycloak_id = location.split('/')[-1]
-                            
-                            # Update PostgreSQL with Keycloak ID
-                            cursor.execute(
-                                "UPDATE users SET keycloak_id = %s WHERE id = %s",
-                                (keycloak_id, user['id'])
-                            )
-                            conn.commit()
-                            logger.info(f"Synced user {user['username']}")
-                    elif response.status_code == 409:
-                        logger.info(f"User {user['username']} already exists in Keycloak")
+            
+        except Exception as e:
+            logger.error(f"Error syncing groups: {e}")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_group_stats = stats
+        
+        logger.info(
+            f"Group sync completed: {len(group_ids)} groups ({stats['groups_created']} created), "
+            f"added {stats['added']}, removed {stats['removed']}, unchanged {stats['unchanged']}, "
+            f"failed {stats['failed']} in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0
+    
+    def _ensure_groups(self, labels: Dict[str, str], stats: Dict) -> Dict[str, str]:
+        """Create missing module groups, returning app_group key -> Keycloak group ID"""
+        existing = self._keycloak_groups()
+        missing = [key for key in labels if key not in existing]
+        
+        def create(group_key: str) -> requests.Response:
+            return self.client.post(f"/admin/realms/{self.realm_name}/groups", json={
+                'name': group_key,
+                'attributes': {'label': [labels[group_key] or group_key]}
+            })
+        
+        refetch = False
+        for group_key, response, error in self.client.map_concurrent(create, missing):
+            if error is None and response.status_code == 201:
+                existing[group_key] = response.headers['Location'].rsplit('/', 1)[-1]
+                stats['groups_created'] += 1
+            elif error is None and response.status_code == 409:
+                refetch = True
+            else:
+                raise RuntimeError(f"Could not create group {group_key}: {error or response.status_code}")
+        if refetch:
+            existing = self._keycloak_groups()
+        return {key: existing[key] for key in labels}
+    
+    def push_user_groups(self, user_ids: List[str]) -> bool:
+        """Bring the module groups of specific users in line with user_group"""
+        conn = self._connect_db(readonly=True)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT key, label FROM app_group")
+                labels = dict(cursor.fetchall())
+                cursor.execute("""
+                    SELECT u.keycloak_id, array_remove(array_agg(g.group_key), NULL)
+                    FROM app_user u
+                    LEFT JOIN user_group g ON g.user_id = u.user_id
+                    WHERE u.user_id = ANY(%s::uuid[]) AND u.keycloak_id IS NOT NULL
+                    GROUP BY u.keycloak_id
+                """, (user_ids,))
+                desired = {keycloak_id: set(keys) for keycloak_id, keys in cursor.fetchall()}
+        finally:
+            conn.close()
+        
+        if self._group_ids is None or set(labels) - set(self._group_ids):
+            self._group_ids = self._ensure_groups(labels, {'groups_created': 0})
+        names = {group_id: key for key, group_id in self._group_ids.items()}
+        
+        def apply(keycloak_id: str) -> Tuple[int, int, int]:
+            response = self.client.get(f"/admin/realms/{self.realm_name}/users/{keycloak_id}/groups")
+            response.raise_for_status()
+            current = {names[group['id']] for group in response.json() if group['id'] in names}
+            done = failed = 0
+            for method, keys in (('PUT', desired[keycloak_id] - current), ('DELETE', current - desired[keycloak_id])):
+                for key in keys:
+                    result = self.client.request(
+                        method, f"/admin/realms/{self.realm_name}/users/{keycloak_id}/groups/{self._group_ids[key]}"
+                    )
+                    if result.status_code == 204:
+                        done += 1
                     else:
-                        logger.warning(f"Failed to sync user {user['username']}: {response.status_code}")
+                        failed += 1
+            return done, failed
+        
+        ok = True
+        for keycloak_id, result, error in self.client.map_concurrent(apply, list(desired)):
+            if error or result[1]:
+                ok = False
+                logger.warning(f"Failed to update groups of {keycloak_id}: {error or f'{result[1]} requests failed'}")
+        return ok
+    
+    def _keycloak_groups(self) -> Dict[str, str]:
+        """Top-level realm groups as name -> group id"""
+        groups, first = {}, 0
+        while True:
+            response = self.client.get(
+                f"/admin/realms/{self.realm_name}/groups",
+                params={'first': first, 'max': self.sync_pull_page_size, 'briefRepresentation': 'true'}
+            )
+            response.raise_for_status()
+            page = response.json()
+            groups.update((group['name'], group['id']) for group in page)
+            if len(page) < self.sync_pull_page_size:
+                return groups
+            first += len(page)
+    
+    def _iter_group_tree(self, groups: List[Dict], parent_path: str = '') -> Iterator[Dict]:
+        """Every group in groups and, depth first, all of their subgroups
+        
+        Keycloak 23+ leaves subGroups empty in listings and only reports
+        subGroupCount; those children are fetched and filled in, so the
+        representations written to a snapshot carry the whole tree.
+        """
+        for group in groups:
+            group.setdefault('path', f"{parent_path}/{group['name']}")
+            if not group.get('subGroups') and group.get('subGroupCount'):
+                group['subGroups'], first = [], 0
+                while True:
+                    response = self.client.get(
+                        f"/admin/realms/{self.realm_name}/groups/{group['id']}/children",
+                        params={'first': first, 'max': self.sync_pull_page_size, 'briefRepresentation': 'false'}
+                    )
+                    response.raise_for_status()
+                    page = response.json()
+                    group['subGroups'].extend(page)
+                    if len(page) < self.sync_pull_page_size:
+                        break
+                    first += len(page)
+            yield group
+            yield from self._iter_group_tree(group.get('subGroups') or [], group['path'])
+    
+    def _iter_group_members(self, group_id: str) -> Iterator[Dict]:
+        """Page through the members of one Keycloak group"""
+        first = 0
+        while True:
+            response = self.client.get(
+                f"/admin/realms/{self.realm_name}/groups/{group_id}/members",
+                params={'first': first, 'max': self.sync_pull_page_size, 'briefRepresentation': 'true'}
+            )
+            response.raise_for_status()
+            page = response.json()
+            yield from page
+            if len(page) < self.sync_pull_page_size:
+                return
+            first += len(page)
+    
+    def _iter_keycloak_users(self, stats: Dict, brief: bool = False) -> Iterator[Dict]:
+        """Every realm user, pages fetched concurrently (pulls are order-independent)"""
+        base = f"/admin/realms/{self.realm_name}/users"
+        response = self.client.get(f"{base}/count")
+        response.raise_for_status()
+        total = int(response.json())
+        # One page past the count picks up users created while paging
+        offsets = range(0, total + self.sync_pull_page_size, self.sync_pull_page_size)
+        
+        def fetch_page(first: int) -> List[Dict]:
+            page = self.client.get(base, params={
+                'first': first, 'max': self.sync_pull_page_size, 'briefRepresentation': str(brief).lower()
+            })
+            page.raise_for_status()
+            return page.json()
+        
+        for first, page, error in self.client.map_concurrent(fetch_page, offsets):
+            if error:
+                raise error
+            stats['pages'] += 1
+            yield from page
+    
+    def _keycloak_user_events(self, since) -> Tuple[Dict[str, str], List[Tuple[str, str, str]], Optional[int]]:
+        """Latest USER operation per Keycloak ID and group membership changes since a watermark
+        
+        Returns ({keycloak_id: operation}, [(operation, keycloak_id, group_id)], newest event time in ms).
+        """
+        since_ms = int((since.timestamp() - self.sync_watermark_overlap) * 1000)
+        users: Dict[str, str] = {}
+        memberships: List[Tuple[str, str, str]] = []
+        newest, first = None, 0
+        while True:
+            response = self.client.get(f"/admin/realms/{self.realm_name}/admin-events", params={
+                'resourceTypes': ['USER', 'GROUP_MEMBERSHIP'],
+                'dateFrom': time.strftime('%Y-%m-%d', time.gmtime(since_ms / 1000)),
+                'first': first, 'max': self.sync_pull_page_size
+            })
+            response.raise_for_status()
+            page = response.json()
+            # Events come newest first, so the first operation seen per user wins
+            for event in page:
+                if event.get('time', 0) < since_ms:
+                    continue
+                newest = max(newest or 0, event['time'])
+                parts = (event.get('resourcePath') or '').split('/')
+                if len(parts) < 2 or parts[0] != 'users':
+                    continue
+                if event.get('resourceType') == 'GROUP_MEMBERSHIP' and len(parts) >= 4:
+                    memberships.append((event['operationType'], parts[1], parts[3]))
+                elif event.get('resourceType') == 'USER' and len(parts) == 2:
+                    users.setdefault(parts[1], event['operationType'])
+            if len(page) < self.sync_pull_page_size:
+                break
+            first += len(page)
+        # Oldest first, so a later remove overrides an earlier add
+        memberships.reverse()
+        return users, memberships, newest
+    
+    def pull_keycloak_users(self, full: bool = False) -> bool:
+        """Mirror Keycloak users, including LDAP-federated ones, into app_user and user_group
+        
+        The first run (or full=True) pages through every realm user; later runs
+        only fetch users named in admin events since the 'pull' watermark.
+        """
+        stats = {'pages': 0, 'fetched': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0,
+                 'skipped': 0, 'failed': 0, 'deleted': 0, 'memberships': 0}
+        started = time.monotonic()
+        
+        try:
+            conn = self._connect_db()
+            with conn.cursor() as cursor:
+                since = None if full else self._load_watermark(cursor, 'pull')
+                cursor.execute("SELECT now()")
+                run_started = cursor.fetchone()[0]
+            conn.commit()
+            
+            if since is not None:
+                realm = self.client.get(f"/admin/realms/{self.realm_name}")
+                realm.raise_for_status()
+                if not realm.json().get('adminEventsEnabled'):
+                    logger.warning("Admin events are disabled for the realm, falling back to a full pull")
+                    since = None
+            
+            if since is None:
+                logger.info("Pulling all Keycloak users...")
+                users = self._iter_keycloak_users(stats)
+                deleted_ids, membership_events, high_water = [], None, run_started
+            else:
+                logger.info(f"Pulling Keycloak user changes since {since}")
+                operations, membership_events, newest = self._keycloak_user_events(since)
+                changed = [kc_id for kc_id, operation in operations.items() if operation != 'DELETE']
+                deleted_ids = [kc_id for kc_id, operation in operations.items() if operation == 'DELETE']
+                users = self._fetch_keycloak_users(changed, deleted_ids)
+                high_water = since if newest is None else \
+                    datetime.fromtimestamp(newest / 1000, tz=timezone.utc)
+            
+            for batch in _chunked(users, self.sync_write_batch):
+                stats['fetched'] += len(batch)
+                self._upsert_app_users(conn, batch, stats)
             
+            with conn.cursor() as cursor:
+                if deleted_ids:
+                    # Soft delete, and unlink so a re-created Keycloak user can link again
+                    cursor.execute("""
+                        UPDATE app_user
+                        SET status = 'deleted', active = FALSE, keycloak_id = NULL
+                        WHERE keycloak_id = ANY(%s)
+                    """, (deleted_ids,))
+                    stats['deleted'] = cursor.rowcount
+                stats['memberships'] = self._pull_group_memberships(cursor, membership_events)
+                self._save_watermark(cursor, 'pull', high_water)
+            conn.commit()
             conn.close()
-            logger.info("User sync completed")
+            
+        except Exception as e:
+            logger.error(f"Error pulling Keycloak users: {e}")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_pull_stats = stats
+        
+        logger.info(
+            f"Pull completed: {stats['fetched']} users fetched (inserted {stats['inserted']}, "
+            f"updated {stats['updated']}, unchanged {stats['unchanged']}, skipped {stats['skipped']}, "
+            f"failed {stats['failed']}, deleted {stats['deleted']}, group memberships {stats['memberships']}) "
+            f"in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0
+    
+    def _fetch_keycloak_users(self, keycloak_ids: List[str], deleted_ids: List[str]) -> Iterator[Dict]:
+        """Full representations of the given users; ones gone since their event count as deleted"""
+        def fetch(keycloak_id: str) -> requests.Response:
+            return self.client.get(f"/admin/realms/{self.realm_name}/users/{keycloak_id}")
+        
+        for keycloak_id, response, error in self.client.map_concurrent(fetch, keycloak_ids):
+            if error:
+                raise error
+            if response.status_code == 404:
+                deleted_ids.append(keycloak_id)
+                continue
+            response.raise_for_status()
+            yield response.json()
+    
+    def _app_user_row(self, kc_user: Dict) -> Optional[Dict]:
+        """app_user values for a Keycloak user, or None if it cannot be stored (no email)"""
+        if not kc_user.get('email'):
+            return None
+        postgres_id = ((kc_user.get('attributes') or {}).get('postgres_id') or [None])[0]
+        try:
+            postgres_id = str(uuid.UUID(postgres_id)) if postgres_id else None
+        except ValueError:
+            postgres_id = None
+        enabled = bool(kc_user.get('enabled', True))
+        return {
+            'postgres_id': postgres_id,
+            'username': kc_user['username'],
+            'email': kc_user['email'],
+            # The push side sends missing names as empty strings
+            'first_name': kc_user.get('firstName') or None,
+            'last_name': kc_user.get('lastName') or None,
+            'status': 'active' if enabled else 'inactive',
+            'active': enabled,
+            'keycloak_id': kc_user['id']
+        }
+    
+    def _upsert_app_users(self, conn, kc_users: List[Dict], stats: Dict):
+        """Multi-row INSERT ... ON CONFLICT (username) for one batch, row by row if the batch fails"""
+        rows = [row for row in map(self._app_user_row, kc_users) if row]
+        stats['skipped'] += len(kc_users) - len(rows)
+        if not rows:
+            return
+        
+        with conn.cursor() as cursor:
+            # Land users pushed from here (postgres_id attribute), linked earlier or
+            # case-folded by Keycloak on their existing row and username
+            cursor.execute("""
+                SELECT user_id::text, username, keycloak_id
+                FROM app_user
+                WHERE user_id = ANY(%s::uuid[]) OR keycloak_id = ANY(%s) OR lower(username) = ANY(%s)
+            """, ([r['postgres_id'] for r in rows if r['postgres_id']],
+                  [r['keycloak_id'] for r in rows],
+                  [r['username'].lower() for r in rows]))
+            by_id, by_keycloak_id, by_username = {}, {}, {}
+            for user_id, username, keycloak_id in cursor.fetchall():
+                by_id[user_id] = by_username[username.lower()] = username
+                if keycloak_id:
+                    by_keycloak_id[keycloak_id] = username
+            
+            values = {}
+            for row in rows:
+                username = by_id.get(row['postgres_id']) or by_keycloak_id.get(row['keycloak_id']) or \
+                    by_username.get(row['username'].lower()) or row['username']
+                # ON CONFLICT cannot touch one row twice in a statement
+                values[username] = (username, row['email'], row['first_name'], row['last_name'],
+                                    row['status'], row['active'], row['keycloak_id'])
+            values = list(values.values())
+            
+            failed = 0
+            try:
+                cursor.execute("SAVEPOINT pull_batch")
+                result = psycopg2.extras.execute_values(cursor, self._UPSERT_APP_USER_SQL, values,
+                                        template=self._UPSERT_APP_USER_TEMPLATE, page_size=len(values), fetch=True)
+                cursor.execute("RELEASE SAVEPOINT pull_batch")
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT pull_batch")
+                logger.warning(f"Batched app_user upsert failed ({str(e).strip()}), retrying row by row")
+                result, failed = [], 0
+                for value in values:
+                    cursor.execute("SAVEPOINT pull_row")
+                    try:
+                        result.extend(psycopg2.extras.execute_values(cursor, self._UPSERT_APP_USER_SQL, [value],
+                                                     template=self._UPSERT_APP_USER_TEMPLATE, fetch=True))
+                        cursor.execute("RELEASE SAVEPOINT pull_row")
+                    except psycopg2.Error as row_error:
+                        cursor.execute("ROLLBACK TO SAVEPOINT pull_row")
+                        failed += 1
+                        logger.warning(f"Could not pull {value[0]}: {str(row_error).strip()}")
+            self._save_pulled_sync_state(cursor, rows)
+        conn.commit()
+        
+        inserted = sum(1 for (was_inserted,) in result if was_inserted)
+        stats['inserted'] += inserted
+        stats['updated'] += len(result) - inserted
+        stats['failed'] += failed
+        stats['unchanged'] += len(values) - len(result) - failed
+    
+    def _save_pulled_sync_state(self, cursor, rows: List[Dict]):
+        """Record the content hash of pulled users so the push side does not send them back
+        
+        Users whose local status disagrees with Keycloak (say suspended here,
+        enabled there) are left without a new hash so the next push fixes them.
+        """
+        enabled = {row['keycloak_id']: row['active'] for row in rows}
+        cursor.execute("""
+            SELECT user_id, username, email, first_name, last_name, active, status, auth_provider, keycloak_id
+            FROM app_user
+            WHERE keycloak_id = ANY(%s)
+        """, (list(enabled),))
+        columns = [column.name for column in cursor.description]
+        upserts = []
+        for user in (dict(zip(columns, values)) for values in cursor.fetchall()):
+            keycloak_user = self._build_keycloak_user(user)
+            keycloak_user['enabled'] = bool(user['active']) and user['status'] == 'active'
+            if keycloak_user['enabled'] == enabled[user['keycloak_id']]:
+                upserts.append((self.realm_name, str(user['user_id']), user['keycloak_id'],
+                                self._content_hash(keycloak_user)))
+        self._save_sync_state(cursor, upserts, [])
+    
+    def _pull_group_memberships(self, cursor, membership_events: Optional[List[Tuple[str, str, str]]]) -> int:
+        """Add user_group rows for Keycloak groups named like app_group keys
+        
+        A full pull adds every member found and removes linked users who are no
+        longer members; an event-driven pull replays the membership adds and
+        removes since the watermark.
+        """
+        cursor.execute("SELECT key FROM app_group")
+        group_keys = {row[0] for row in cursor.fetchall()}
+        groups = {name: group_id for name, group_id in self._keycloak_groups().items() if name in group_keys}
+        
+        members: Dict[str, List[str]] = {}
+        if membership_events is None:
+            members = {name: [member['id'] for member in self._iter_group_members(group_id)]
+                       for name, group_id in groups.items()}
+            pairs = ((keycloak_id, name) for name, ids in members.items() for keycloak_id in ids)
+            removals = []
+        else:
+            names = {group_id: name for name, group_id in groups.items()}
+            latest = {}
+            for operation, keycloak_id, group_id in membership_events:
+                if group_id in names:
+                    latest[(keycloak_id, names[group_id])] = operation
+            pairs = (pair for pair, operation in latest.items() if operation != 'DELETE')
+            removals = [pair for pair, operation in latest.items() if operation == 'DELETE']
+        
+        changed = 0
+        for batch in _chunked(pairs, self.sync_write_batch):
+            changed += len(psycopg2.extras.execute_values(cursor, """
+                INSERT INTO user_group (user_id, group_key)
+                SELECT u.user_id, v.group_key
+                FROM (VALUES %s) AS v(keycloak_id, group_key)
+                JOIN app_user u ON u.keycloak_id = v.keycloak_id
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            """, batch, page_size=len(batch), fetch=True))
+        for batch in _chunked(removals, self.sync_write_batch):
+            changed += len(psycopg2.extras.execute_values(cursor, """
+                DELETE FROM user_group g
+                USING app_user u, (VALUES %s) AS v(keycloak_id, group_key)
+                WHERE u.keycloak_id = v.keycloak_id
+                  AND g.user_id = u.user_id AND g.group_key = v.group_key
+                RETURNING 1
+            """, batch, page_size=len(batch), fetch=True))
+        # Only users linked to Keycloak lose memberships, as on the push side
+        for name, ids in members.items():
+            cursor.execute("""
+                DELETE FROM user_group g
+                USING app_user u
+                WHERE g.user_id = u.user_id AND g.group_key = %s
+                  AND u.keycloak_id IS NOT NULL AND NOT u.keycloak_id = ANY(%s)
+            """, (name, ids))
+            changed += cursor.rowcount
+        return changed
+    
+    # Existing rows only change (and only bump updated_at) when a pulled value differs;
+    # status and active move between active and inactive but never override a local
+    # suspended/banned/deleted status
+    _UPSERT_APP_USER_SQL = """
+        INSERT INTO app_user AS u
+            (username, email, first_name, last_name, auth_provider, status, active, keycloak_id)
+        VALUES %s
+        ON CONFLICT (username) DO UPDATE SET
+            email = EXCLUDED.email,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            active = CASE WHEN u.status IN ('active', 'inactive') THEN EXCLUDED.active ELSE u.active END,
+            status = CASE
+                WHEN EXCLUDED.active AND u.status = 'inactive' THEN 'active'
+                WHEN NOT EXCLUDED.active AND u.status = 'active' THEN 'inactive'
+                ELSE u.status
+            END,
+            keycloak_id = EXCLUDED.keycloak_id
+        WHERE (u.email, u.first_name, u.last_name, u.active, u.keycloak_id)
+            IS DISTINCT FROM (EXCLUDED.email, EXCLUDED.first_name, EXCLUDED.last_name,
+                              CASE WHEN u.status IN ('active', 'inactive') THEN EXCLUDED.active ELSE u.active END,
+                              EXCLUDED.keycloak_id)
+        RETURNING (xmax = 0)
+    """
+    _UPSERT_APP_USER_TEMPLATE = "(%s, %s, %s, %s, 'keycloak', %s, %s, %s)"
+    
+    def replay_dead_letters(self) -> bool:
+        """Retry users recorded in the dead-letter file through partialImport"""
+        entries = [entry for entry in self.dead_letters.read() if entry.get('realm') == self.realm_name]
+        if not entries:
+            logger.info("No dead-lettered users to replay")
             return True
+        
+        others = [entry for entry in self.dead_letters.read() if entry.get('realm') != self.realm_name]
+        user_ids = sorted({entry['user_id'] for entry in entries})
+        logger.info(f"Replaying {len(user_ids)} dead-lettered users...")
+        
+        try:
+            read_conn = self._connect_db(readonly=True)
+            write_conn = self._connect_db()
+            writer = self._id_writer(write_conn)
+            
+            # Users deleted or deactivated since they failed are simply dropped
+            users = self._iter_rows(read_conn, """
+                SELECT user_id, username, email, first_name, last_name,
+                       active, status, auth_provider
+                FROM app_user
+                WHERE user_id = ANY(%s::uuid[])
+                  AND active = TRUE AND status = 'active'
+                ORDER BY user_id
+            """, (user_ids,), name='kc_dead_letter_replay')
+            
+            still_failing, replayed = [], []
+            chunks = _chunked(users, self.sync_batch_size)
+            for chunk, result, error in self.client.map_concurrent(self._import_user_chunk, chunks):
+                links = [] if error else result[1]
+                for user_id, keycloak_id in links:
+                    writer.add(user_id, keycloak_id)
+                replayed.extend(user_id for user_id, _ in links)
+                unlinked = {str(user['user_id']) for user in chunk} - {user_id for user_id, _ in links}
+                still_failing.extend(
+                    dict(entry, ts=time.time(), reason=str(error or 'not returned by partialImport'))
+                    for entry in entries if entry['user_id'] in unlinked
+                )
+            
+            writer.close()
+            self._log_write_failures(writer)
+            with write_conn.cursor() as cursor:
+                self._clear_push_failures(cursor, replayed)
+            write_conn.commit()
+            read_conn.close()
+            write_conn.close()
             
         except Exception as e:
-            logger.error(f"Error syncing users: {e}")
+            logger.error(f"Error replaying dead-lettered users: {e}")
             return False
+        
+        self.dead_letters.replace(others + still_failing)
+        logger.info(f"Replayed {len(replayed)} users, {len(still_failing)} still failing")
+        return not still_failing
     
     def configure_authentication_flow(self) -> bool:
         """Configure authentication flow to check PostgreSQL first, then LDAP"""
@@ -431,11 +2297,9 @@ class KeycloakIntegration:
         logger.info("Using default authentication flow with priority-based federation")
         return True
     
-    def create_webhook_client(self) -> bool:
-        """Create a client for webhook authentication"""
-        logger.info("Creating webhook client for N8N...")
-        
-        webhook_client = {
+    def _webhook_client(self) -> Dict:
+        """Desired webhook client for N8N"""
+        return {
             "clientId": "cybercore-webhooks",
             "name": "CyberCore Webhooks",
             "description": "Client for webhook authentication",
@@ -451,70 +2315,150 @@ class KeycloakIntegration:
             "protocol": "openid-connect",
             "fullScopeAllowed": True
         }
+    
+    def create_webhook_client(self) -> bool:
+        """Create or update the client for webhook authentication"""
+        logger.info("Reconciling webhook client for N8N...")
         
         try:
-            response = requests.post(
-                f"{self.kc_server}/admin/realms/{self.realm_name}/clients",
-                headers=self.headers,
-                json=webhook_client
-            )
-            
-            if response.status_code in [201, 409]:
+            if self._apply_changes([self.reconciler.plan_client(self._webhook_client())]):
                 logger.info("Webhook client created/exists")
-                return True
             else:
-                logger.warning(f"Could not create webhook client: {response.status_code}")
-                return True
+                logger.warning("Could not create webhook client")
+            return True
                 
         except Exception as e:
             logger.warning(f"Error creating webhook client: {e}")
             return True
     
+    def _setup_steps(self) -> List[SetupStep]:
+        """Setup graph: everything needs the realm, group membership needs synced users
+        and the auth flow needs the federation providers"""
+        federation = ['storage'] + (['ldap'] if self.ldap_enabled else [])
+        steps = [
+            SetupStep('realm', self._setup_realm,
+                      failure_message="Realm is not available, skipping the steps that need it"),
+            SetupStep('storage', self.configure_postgres_user_storage, ['realm'],
+                      "Failed to configure PostgreSQL storage, continuing..."),
+            SetupStep('sync', self._sync_users_step, ['realm'],
+                      "Failed to sync users, continuing..."),
+            SetupStep('groups', self.sync_groups, ['sync'],
+                      "Failed to sync groups, continuing..."),
+            SetupStep('auth_flow', self.configure_authentication_flow, ['realm'] + federation,
+                      "Failed to configure auth flow, continuing..."),
+            SetupStep('webhook', self.create_webhook_client, ['realm'],
+                      "Failed to create webhook client, continuing...")
+        ]
+        if self.ldap_enabled:
+            steps.insert(2, SetupStep('ldap', self.configure_ldap_federation, ['realm'],
+                                      "Failed to configure LDAP, continuing..."))
+        return steps
+    
+    def _setup_realm(self) -> bool:
+        """Reconcile the realm; an existing realm is enough for the dependent steps"""
+        if self.import_realm_config():
+            return True
+        logger.warning("Failed to import realm config, continuing...")
+        self.reconciler.ensure_loaded()
+        return self.reconciler.current_realm is not None
+    
+    def _sync_users_step(self) -> bool:
+        ok = self.sync_realms() if self.realm_groups else self.sync_postgres_users()
+        if self.dead_letters.count:
+            logger.warning(
+                f"{self.dead_letters.count} users were skipped and recorded in {self.dead_letters.path}; "
+                f"rerun with the replay command to retry them"
+            )
+        return ok
+    
+    def _stat_gauges(self, name: str, stats: Dict, **labels):
+        """Numeric entries of a stats dict as one gauge labelled by result"""
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'seconds':
+                self.metrics.set_gauge(name, value, result=key, **labels)
+        if 'seconds' in stats:
+            self.metrics.set_gauge(f"{name}_seconds", stats['seconds'], **labels)
+    
+    def write_metrics(self):
+        """Refresh the run gauges and write the Prometheus text file, if one is configured"""
+        self.metrics.set_gauge('last_run_timestamp_seconds', round(time.time(), 3), realm=self.realm_name)
+        if self.setup_graph is not None and self.setup_graph.finished is not None:
+            self.metrics.set_gauge('run_duration_seconds',
+                                   round(self.setup_graph.finished - self.setup_graph.started, 3))
+            for step in self.setup_graph.steps.values():
+                self.metrics.set_gauge('step_seconds', round(step.seconds, 3), step=step.name)
+                self.metrics.set_gauge('step_ok', int(step.status == 'ok'), step=step.name)
+        self._stat_gauges('sync_users', self.last_sync_stats)
+        self._stat_gauges('sync_groups', self.last_group_stats)
+        self._stat_gauges('pull_users', self.last_pull_stats)
+        for realm, result in self.realm_results.items():
+            self._stat_gauges('realm_sync_users', result, realm=realm)
+            self.metrics.set_gauge('realm_sync_ok', int(result['ok']), realm=realm)
+        if self.daemon_stats['batches'] or self.daemon_stats['failed_batches']:
+            self._stat_gauges('daemon', self.daemon_stats)
+        self.metrics.set_gauge('dead_letters', self.dead_letters.count)
+        
+        if not self.metrics_file:
+            return
+        try:
+            self.metrics.write_prometheus(self.metrics_file)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.metrics_file}: {e}")
+    
+    def run_summary(self, started_at: datetime) -> Dict:
+        """Per-run JSON document: where time went, what each step did and the HTTP traffic behind it"""
+        summary = {
+            'started_at': started_at.isoformat(),
+            'finished_at': datetime.now(timezone.utc).isoformat(),
+            'readiness': self.readiness,
+            'sync_mode': self.sync_mode,
+            'sync': {key: value for key, value in self.last_sync_stats.items() if key != 'chunks'},
+            'groups': self.last_group_stats,
+            'dead_letters': self.dead_letters.count,
+            'metrics': self.metrics.summary()
+        }
+        if self.realm_results:
+            summary['realms'] = self.realm_results
+        if self.setup_graph is not None:
+            summary.update(self.setup_graph.report())
+            summary['duration_s'] = round(self.setup_graph.finished - self.setup_graph.started, 3)
+        return summary
+    
     def run(self):
         """Run the complete Keycloak integration setup"""
         logger.info("Starting CyberCore Keycloak Integration...")
+        started_at = datetime.now(timezone.utc)
         
-        # Wait for Keycloak to be ready
-        if not self.wait_for_keycloak():
+        # Start reading users while Keycloak may still be booting
+        self.start_user_prefetch()
+        
+        # Wait for Keycloak and PostgreSQL to be ready
+        if not self.wait_for_services():
             sys.exit(1)
+        logger.info(f"Services ready in {self.readiness['time_to_ready_s']:.2f}s")
         
         # Get admin token
         if not self.get_admin_token():
             sys.exit(1)
         
-        # Import realm configuration
-        if not self.import_realm_config():
-            logger.warning("Failed to import realm config, continuing...")
-        
-        # Configure PostgreSQL user storage
-        if not self.configure_postgres_user_storage():
-            logger.warning("Failed to configure PostgreSQL storage, continuing...")
+        # Configure the realm and sync users, running independent steps concurrently
+        self.setup_graph = SetupGraph(self._setup_steps())
+        self.setup_graph.run()
         
-        # Configure LDAP if enabled
-        if self.ldap_enabled:
-            if not self.configure_ldap_federation():
-                logger.warning("Failed to configure LDAP, continuing...")
-        
-        # Sync existing PostgreSQL users
-        if not self.sync_postgres_users():
-            logger.warning("Failed to sync users, continuing...")
-        
-        # Configure authentication flow
-        if not self.configure_authentication_flow():
-            logger.warning("Failed to configure auth flow, continuing...")
-        
-        # Create webhook client
-        if not self.create_webhook_client():
-            logger.warning("Failed to create webhook client, continuing...")
+        self.client.close()
+        if self.id_cache:
+            self.id_cache.close()
         
         logger.info("=" * 50)
         logger.info("Keycloak Integration Complete!")
         logger.info(f"Access Keycloak at: {self.kc_server}")
         logger.info(f"Admin Console: {self.kc_server}/admin")
         logger.info(f"Realm: {self.realm_name}")
+        for line in self.setup_graph.summary():
+            logger.info(line)
         logger.info("=" * 50)
         
-        # Output configuration for other services
+        # Output configuration for other services, followed by the run summary
         config_output = {
             "keycloak_url": self.kc_server,
             "realm": self.realm_name,
@@ -523,9 +2467,110 @@ class KeycloakIntegration:
             "webhook_client_id": "cybercore-webhooks",
             "webhook_client_secret": "webhook-secret-change-me"
         }
+        config_output["run"] = self.run_summary(started_at)
+        self.write_metrics()
         
         print(json.dumps(config_output, indent=2))
 
-if __name__ == "__main__":
+def _bench(argv: List[str]) -> int:
+    """Hand over to keycloak-bench.py next to this script"""
+    bench = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keycloak-bench.py')
+    if not os.path.exists(bench):
+        logger.error(f"Benchmark harness not found at {bench}")
+        return 1
+    os.execv(sys.executable, [sys.executable, bench] + argv)
+
+def _run_steps(integration: KeycloakIntegration, steps: List[Callable[[], bool]], services: str = 'both') -> int:
+    """Wait for what the steps need, get a token and run them in order; exit status for the CLI"""
+    if services == 'keycloak':
+        ready = integration.wait_for_keycloak()
+    else:
+        ready = integration.wait_for_services()
+    ok = ready and integration.get_admin_token() and all(step() for step in steps)
+    integration.write_metrics()
+    integration.client.close()
+    if integration.id_cache:
+        integration.id_cache.close()
+    return 0 if ok else 1
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command line entry point; without a command the full setup pipeline runs
+    
+    Only argparse and the standard library load before a command is chosen;
+    requests and psycopg2 are imported by the first command that uses them.
+    """
+    parser = argparse.ArgumentParser(description="CyberCore Keycloak Integration")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.add_parser('run', help='full setup: realm, federation, user and group sync, webhook client (default)')
+    commands.add_parser('wait', help='wait until Keycloak and PostgreSQL answer, then exit')
+    commands.add_parser('realm', help='reconcile the realm with its JSON config')
+    commands.add_parser('federation', help='configure PostgreSQL storage, LDAP (if enabled) and the auth flow')
+    sync = commands.add_parser('sync', help='push PostgreSQL users to Keycloak using SYNC_MODE')
+    sync.add_argument('--user', action='append', metavar='ID_OR_USERNAME', default=[],
+                      help='push only this user (repeatable); skips the full scan and the watermark')
+    commands.add_parser('groups', help='sync user_group memberships to Keycloak groups')
+    commands.add_parser('webhook', help='create or update the N8N webhook client')
+    commands.add_parser('plan', help='print the realm, component and client changes a run would make')
+    pull = commands.add_parser('pull', help='mirror Keycloak users into app_user and user_group')
+    pull.add_argument('--full', action='store_true',
+                      help='page through every user instead of admin events since the last pull')
+    commands.add_parser('daemon', help='stay running and push app_user/user_group changes as PostgreSQL notifies them')
+    commands.add_parser('replay', help='retry users recorded in the dead-letter file')
+    snapshot = commands.add_parser('snapshot', help='export or restore the realm, its users and their app_user links')
+    snapshot.add_argument('action', choices=['export', 'import'])
+    snapshot.add_argument('path', metavar='PATH', help='.ndjson.gz, or .ndjson.zst with the zstandard package')
+    commands.add_parser('shard-worker', help='lease and sync user buckets of the sharded run SYNC_RUN_ID')
+    commands.add_parser('bench', add_help=False, help='run keycloak-bench.py with the remaining arguments')
+    args, extra = parser.parse_known_args(argv)
+    
+    if args.command == 'bench':
+        return _bench(extra)
+    if extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    
     integration = KeycloakIntegration()
-    integration.run()
\ No newline at end of file
+    if args.command in (None, 'run'):
+        integration.run()
+        return 0
+    if args.command == 'wait':
+        return 0 if integration.wait_for_services() else 1
+    if args.command == 'realm':
+        return _run_steps(integration, [integration._setup_realm], 'keycloak')
+    if args.command == 'federation':
+        steps = [integration.configure_postgres_user_storage]
+        if integration.ldap_enabled:
+            steps.append(integration.configure_ldap_federation)
+        steps.append(integration.configure_authentication_flow)
+        return _run_steps(integration, steps, 'keycloak')
+    if args.command == 'sync':
+        if args.user:
+            return _run_steps(integration, [lambda: integration.sync_selected_users(args.user)])
+        return _run_steps(integration, [integration._sync_users_step])
+    if args.command == 'groups':
+        return _run_steps(integration, [integration.sync_groups])
+    if args.command == 'webhook':
+        return _run_steps(integration, [integration.create_webhook_client], 'keycloak')
+    if args.command == 'plan':
+        if not (integration.wait_for_keycloak() and integration.get_admin_token()):
+            return 1
+        changes = integration.plan()
+        print(RealmReconciler.format_plan(changes))
+        integration.client.close()
+        return 0
+    if args.command == 'pull':
+        return _run_steps(integration, [lambda: integration.pull_keycloak_users(full=args.full)])
+    if args.command == 'daemon':
+        integration.run_daemon()
+        return 0
+    if args.command == 'replay':
+        return _run_steps(integration, [integration.replay_dead_letters])
+    if args.command == 'snapshot':
+        if args.action == 'export':
+            return _run_steps(integration, [lambda: integration.export_snapshot(args.path)])
+        return _run_steps(integration, [lambda: integration.import_snapshot(args.path)])
+    if args.command == 'shard-worker':
+        return 0 if integration.run_shard_worker() else 1
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+CyberCore Keycloak Integration - Components
+Building blocks of keycloak-integration.py, importable on their own for tests and tools
+"""
+
+from .client import KeycloakAdminClient
+from .daemon import DaemonMixin
+from .idcache import KeycloakIdCache, KeycloakIdWriter
+from .journal import DeadLetterQueue, SyncJournal
+from .limiter import AdaptiveLimiter
+from .metrics import Metrics
+from .reconciler import MASKED_SECRET, SECRET_KEYS, RealmReconciler
+from .retry import RetryPolicy
+from .rows import PartitionedRows, PrefetchedRows
+from .setup_graph import SetupGraph, SetupStep
+from .snapshot import SNAPSHOT_VERSION, SnapshotMixin
+from .token_manager import TokenError, TokenManager
+
+__all__ = [
+    'KeycloakAdminClient', 'DaemonMixin', 'KeycloakIdCache', 'KeycloakIdWriter',
+    'DeadLetterQueue', 'SyncJournal', 'AdaptiveLimiter', 'Metrics', 'MASKED_SECRET',
+    'SECRET_KEYS', 'RealmReconciler', 'RetryPolicy', 'PartitionedRows', 'PrefetchedRows',
+    'SetupGraph', 'SetupStep', 'SNAPSHOT_VERSION', 'SnapshotMixin', 'TokenError', 'TokenManager'
+]
@@ -0,0 +1,49 @@
+"""
+CyberCore Keycloak Integration - Lazy Imports
+Heavy and rarely needed modules, imported on first attribute access
+"""
+
+import importlib
+from typing import TYPE_CHECKING
+
+class _LazyModule:
+    """Stands in for a heavy module and imports it on first attribute access
+    
+    Commands that never talk HTTP or PostgreSQL then start without paying
+    for requests or psycopg2, and the stdlib modules only one code path needs
+    stay unloaded too; submodules such as psycopg2.extras resolve the same way.
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+    
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._name)
+        try:
+            value = getattr(module, attr)
+        except AttributeError:
+            value = importlib.import_module(f"{self._name}.{attr}")
+        setattr(self, attr, value)
+        return value
+
+if TYPE_CHECKING:
+    import email.utils
+    import gzip
+    import socket
+    import sqlite3
+    import subprocess
+    import uuid
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    import requests
+    import requests.adapters
+else:
+    email = _LazyModule('email')
+    gzip = _LazyModule('gzip')
+    socket = _LazyModule('socket')
+    sqlite3 = _LazyModule('sqlite3')
+    subprocess = _LazyModule('subprocess')
+    uuid = _LazyModule('uuid')
+    psycopg2 = _LazyModule('psycopg2')
+    requests = _LazyModule('requests')
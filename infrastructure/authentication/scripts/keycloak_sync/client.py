@@ -0,0 +1,181 @@
+"""
+CyberCore Keycloak Integration - Admin Client
+Pooled, rate limited and retrying access to the Keycloak admin REST API
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from ._lazy import requests
+from .limiter import AdaptiveLimiter
+from .metrics import Metrics
+from .retry import RetryPolicy
+from .token_manager import TokenManager
+
+logger = logging.getLogger(__name__)
+
+class KeycloakAdminClient:
+    """Keycloak admin REST client with a pooled session and bounded parallelism"""
+    
+    def __init__(self, server: str, concurrency: int = 8, timeout: float = 10.0,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 limiter: Optional[AdaptiveLimiter] = None,
+                 metrics: Optional[Metrics] = None):
+        self.server = server.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.headers: Dict[str, str] = {}
+        self.token_manager: Optional[TokenManager] = None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.limiter = limiter or AdaptiveLimiter(self.concurrency, max_rate=1000.0)
+        self.metrics = metrics or Metrics()
+        self.retries = 0
+        
+        # One keep-alive pool sized to the concurrency limit; pool_block makes
+        # extra callers wait for a free connection instead of opening new ones
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+    
+    @property
+    def session(self) -> requests.Session:
+        """Pooled session, created (and requests imported) on first use"""
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.concurrency, pool_block=True
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+        return self._session
+    
+    def request(self, method: str, path: str, authenticate: bool = True, retry: bool = True,
+                **kwargs) -> requests.Response:
+        """Send a request to the Keycloak server with the default timeout
+        
+        Authenticated requests carry the token manager's current token; a 401
+        invalidates that token and the request is retried once with a fresh one.
+        429/5xx responses and connection errors are retried per the retry policy.
+        """
+        url = path if path.startswith('http') else f"{self.server}{path}"
+        headers = dict(self.headers)
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs.setdefault('timeout', self.timeout)
+        use_token = authenticate and self.token_manager is not None
+        max_attempts = self.retry_policy.max_attempts if retry else 1
+        
+        attempt = 0
+        reauthenticated = False
+        while True:
+            if use_token:
+                access_token = self.token_manager.token()
+                headers['Authorization'] = f'Bearer {access_token}'
+            
+            try:
+                response = self._send(method, url, headers, kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                attempt += 1
+                if attempt >= max_attempts:
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logger.debug(f"{method} {path} failed ({e}), retry {attempt} in {delay:.2f}s")
+                self.retries += 1
+                self.metrics.record_retry(method, url)
+                time.sleep(delay)
+                continue
+            
+            if response.status_code == 401 and use_token and not reauthenticated:
+                reauthenticated = True
+                self.token_manager.invalidate(access_token)
+                continue
+            
+            if response.status_code in RetryPolicy.RETRY_STATUSES and attempt + 1 < max_attempts:
+                attempt += 1
+                delay = self.retry_policy.delay(attempt, response)
+                logger.debug(f"{method} {path} returned {response.status_code}, retry {attempt} in {delay:.2f}s")
+                self.retries += 1
+                self.metrics.record_retry(method, url)
+                time.sleep(delay)
+                continue
+            
+            return response
+    
+    def _send(self, method: str, url: str, headers: Dict, kwargs: Dict) -> requests.Response:
+        """One HTTP exchange under the adaptive limiter, recorded in the metrics"""
+        self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException:
+            elapsed = time.monotonic() - started
+            self.limiter.release(elapsed, overloaded=True)
+            self.metrics.record_request(method, url, None, elapsed)
+            raise
+        elapsed = time.monotonic() - started
+        self.limiter.release(elapsed, overloaded=response.status_code in (429, 503))
+        body = response.request.body
+        self.metrics.record_request(
+            method, url, response.status_code, elapsed,
+            bytes_sent=len(body) if body else 0,
+            bytes_received=len(response.content)
+        )
+        return response
+    
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+    
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+    
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+    
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+    
+    def map_concurrent(self, fn: Callable, items: Iterable) -> Iterator[Tuple]:
+        """Run fn over items on the worker pool, yielding (item, result, error) as each completes
+        
+        At most twice the concurrency limit is queued at once, so items can be
+        a lazy iterable of any size.
+        """
+        # Realm fan-out calls this from several threads; they share one pool
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency,
+                    thread_name_prefix='keycloak'
+                )
+        
+        pending = {}
+        
+        def drain(return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
+        
+        for item in items:
+            if len(pending) >= self.concurrency * 2:
+                yield from drain(FIRST_COMPLETED)
+            pending[self._executor.submit(fn, item)] = item
+        
+        while pending:
+            yield from drain(FIRST_COMPLETED)
+    
+    def close(self):
+        """Shut down the worker pool and close pooled connections"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
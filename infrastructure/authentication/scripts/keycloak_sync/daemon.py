@@ -0,0 +1,154 @@
+"""
+CyberCore Keycloak Integration - Sync Daemon
+Near-real-time push of app_user and user_group changes on PostgreSQL notifications
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import logging
+import select
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from ._lazy import psycopg2
+
+logger = logging.getLogger(__name__)
+
+class DaemonMixin:
+    """LISTEN/NOTIFY driven push loop of KeycloakIntegration (the daemon command)"""
+    
+    def run_daemon(self):
+        """Push app_user and user_group changes to Keycloak as PostgreSQL notifies them
+        
+        Notifications are coalesced for daemon_debounce seconds of quiet (capped at
+        daemon_max_delay) and pushed on a worker thread while listening continues;
+        events arriving during a push form the next batch.
+        """
+        logger.info(f"Starting Keycloak sync daemon on channel {self.daemon_channel}...")
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self._stopping.set())
+        
+        if not self.wait_for_services():
+            if self._stopping.is_set():
+                logger.info("Stopped before the services were ready")
+                return
+            sys.exit(1)
+        if not self.get_admin_token():
+            sys.exit(1)
+        # Users linked outside the incremental sync are updated, not re-created
+        self._load_id_cache()
+        
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='daemon-push')
+        in_flight = None
+        users: set = set()
+        group_users: set = set()
+        first_event = last_event = None
+        listen_conn = None
+        
+        while not self._stopping.is_set():
+            if listen_conn is None or listen_conn.closed:
+                listen_conn = self._listen()
+                if listen_conn is None:
+                    # Stopped while waiting to reconnect
+                    break
+                # Anything committed while nobody was listening is caught up by the watermark
+                users.add(None)
+                first_event = last_event = first_event or time.monotonic()
+            
+            # Wake for new notifications, the debounce deadline or a finished push
+            timeout = 1.0
+            if first_event is not None:
+                timeout = max(0.0, min(last_event + self.daemon_debounce, first_event + self.daemon_max_delay)
+                              - time.monotonic())
+            if in_flight is not None:
+                timeout = min(timeout, 0.05)
+            try:
+                if select.select([listen_conn], [], [], timeout)[0]:
+                    listen_conn.poll()
+                    while listen_conn.notifies:
+                        self._collect_notify(listen_conn.notifies.pop(0), users, group_users)
+                        last_event = time.monotonic()
+                        first_event = first_event or last_event
+                        self.daemon_stats['events'] += 1
+            except (psycopg2.Error, OSError) as e:
+                logger.warning(f"Lost the LISTEN connection ({e}), reconnecting...")
+                listen_conn = None
+                continue
+            
+            if in_flight is not None and in_flight.done():
+                in_flight = None
+            if first_event is None or in_flight is not None:
+                continue
+            now = time.monotonic()
+            if now - last_event < self.daemon_debounce and now - first_event < self.daemon_max_delay:
+                continue
+            
+            batch = (set(users), set(group_users), first_event)
+            users.clear()
+            group_users.clear()
+            first_event = last_event = None
+            in_flight = pool.submit(self._push_daemon_batch, *batch)
+        
+        logger.info("Stopping Keycloak sync daemon...")
+        pool.shutdown(wait=True)
+        if listen_conn is not None and not listen_conn.closed:
+            listen_conn.close()
+        if self.id_cache:
+            self.id_cache.close()
+        self.client.close()
+    
+    def _listen(self):
+        """Autocommit connection subscribed to the daemon channel, retried until it succeeds"""
+        delay = self.ready_initial_delay
+        while not self._stopping.is_set():
+            try:
+                conn = self._connect_db()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.daemon_channel}")
+                logger.info(f"Listening on {self.daemon_channel}")
+                return conn
+            except psycopg2.Error as e:
+                logger.warning(f"Could not LISTEN ({e}), retrying in {delay:.2f}s")
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.ready_max_delay)
+        return None
+    
+    def _collect_notify(self, notify, users: set, group_users: set):
+        try:
+            payload = json.loads(notify.payload)
+        except ValueError:
+            logger.warning(f"Ignoring malformed notification: {notify.payload!r}")
+            return
+        if payload.get('table') == 'user_group':
+            group_users.add(payload['user_id'])
+        else:
+            users.add(payload.get('user_id'))
+    
+    def _push_daemon_batch(self, users: set, group_users: set, first_event: float):
+        """One coalesced push: user changes first, so new users are linked before their groups
+        (user_group rows notify on their own, so group pushes only cover those users)"""
+        try:
+            ok = True
+            if users:
+                # The incremental sync reads only rows past the watermark (indexed), never a full scan
+                ok = self.sync_postgres_users_incremental()
+            if group_users:
+                ok = self.push_user_groups(sorted(group_users)) and ok
+            latency = time.monotonic() - first_event
+            self.daemon_stats['batches'] += 1
+            self.daemon_stats['max_latency_s'] = max(self.daemon_stats['max_latency_s'], round(latency, 3))
+            self.daemon_stats['last_latency_s'] = round(latency, 3)
+            if not ok:
+                self.daemon_stats['failed_batches'] += 1
+            logger.info(
+                f"Pushed {len(users - {None})} user and {len(group_users)} group membership changes "
+                f"{latency:.2f}s after the first event"
+            )
+        except Exception as e:
+            self.daemon_stats['failed_batches'] += 1
+            logger.error(f"Daemon push failed: {e}")
+        self.write_metrics()
@@ -0,0 +1,189 @@
+"""
+CyberCore Keycloak Integration - Keycloak ID Cache
+Username -> Keycloak ID cache and the batched app_user.keycloak_id writer
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import Dict, Iterable, Optional, List, Tuple
+
+from ._lazy import sqlite3, psycopg2
+from .metrics import Metrics
+from .rows import _chunked
+
+logger = logging.getLogger(__name__)
+
+class KeycloakIdCache:
+    """On-disk username/email -> Keycloak user ID index, backed by SQLite
+    
+    Filled from one paginated listing of the realm's users and trusted until
+    the listing is older than ttl seconds; users created in between are added
+    as they are linked.
+    """
+    
+    def __init__(self, path: str, realm: str, ttl: float = 3600.0):
+        self.path = path
+        self.realm = realm
+        self.ttl = ttl
+        self.hits = 0
+        self._lock = threading.Lock()
+        # Sharded workers on one host share the file; WAL lets them read while one writes
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS kc_user_id (
+                realm        TEXT NOT NULL,
+                username     TEXT NOT NULL,
+                email        TEXT,
+                keycloak_id  TEXT NOT NULL,
+                fetched_at   REAL NOT NULL,
+                PRIMARY KEY (realm, username)
+            ) WITHOUT ROWID;
+            DROP INDEX IF EXISTS idx_kc_user_id_email;
+            CREATE TABLE IF NOT EXISTS kc_user_id_listing (
+                realm       TEXT PRIMARY KEY,
+                fetched_at  REAL NOT NULL
+            );
+        """)
+    
+    def fresh(self) -> bool:
+        """True if the last full listing is younger than the TTL"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fetched_at FROM kc_user_id_listing WHERE realm = ?", (self.realm,)
+            ).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+    
+    def refresh(self, users: Iterable[Dict]) -> int:
+        """Replace the realm's entries with a complete listing of Keycloak users"""
+        fetched_at = time.time()
+        count = 0
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM kc_user_id WHERE realm = ?", (self.realm,))
+            for batch in _chunked(users, 1000):
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO kc_user_id VALUES (?, ?, ?, ?, ?)",
+                    [(self.realm, user['username'].lower(), (user.get('email') or '').lower() or None,
+                      user['id'], fetched_at) for user in batch]
+                )
+                count += len(batch)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kc_user_id_listing VALUES (?, ?)", (self.realm, fetched_at)
+            )
+        return count
+    
+    def lookup(self, username: str, email: Optional[str] = None) -> Optional[str]:
+        """Keycloak ID for a username; when both sides know an email it has to agree too
+        
+        There is no email-only fallback: an email can belong to a different
+        Keycloak account than the username does.
+        """
+        email = (email or '').lower() or None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT keycloak_id FROM kc_user_id WHERE realm = ? AND username = ? "
+                "AND (email IS NULL OR ? IS NULL OR email = ?)",
+                (self.realm, username.lower(), email, email)
+            ).fetchone()
+        if row is not None:
+            self.hits += 1
+        return row[0] if row else None
+    
+    def put_many(self, entries: Iterable[Tuple[str, Optional[str], str]]):
+        """Record (username, email, keycloak_id) for users linked during this run"""
+        fetched_at = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kc_user_id VALUES (?, ?, ?, ?, ?)",
+                [(self.realm, username.lower(), (email or '').lower() or None, keycloak_id, fetched_at)
+                 for username, email, keycloak_id in entries]
+            )
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class KeycloakIdWriter:
+    """Buffers (user_id, keycloak_id) links and writes them to app_user in set-based batches
+    
+    A batch is flushed every batch_size links or flush_interval seconds and
+    committed on its own, so a crash loses at most the unflushed batch.
+    """
+    
+    def __init__(self, conn, batch_size: int = 1000, flush_interval: float = 2.0,
+                 metrics: Optional[Metrics] = None):
+        self.conn = conn
+        self.metrics = metrics or Metrics()
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.pending: List[Tuple[str, str]] = []
+        self.written = 0
+        self.failed: Dict[str, str] = {}
+        self._last_flush = time.monotonic()
+    
+    def add(self, user_id, keycloak_id: str):
+        """Queue one link, flushing if the batch is full or old enough"""
+        self.pending.append((str(user_id), keycloak_id))
+        if len(self.pending) >= self.batch_size or \
+                time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        """Write all queued links in one UPDATE ... FROM (VALUES ...) and commit"""
+        self._last_flush = time.monotonic()
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        
+        try:
+            with self.metrics.phase('postgres_write_back'):
+                with self.conn.cursor() as cursor:
+                    updated = psycopg2.extras.execute_values(cursor, self._UPDATE_SQL, batch, page_size=len(batch), fetch=True)
+                self.conn.commit()
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            logger.warning(f"Batched Keycloak ID write-back failed ({e}), retrying row by row")
+            with self.metrics.phase('postgres_write_back'):
+                self._flush_rows(batch)
+            return
+        
+        found = {str(row[0]) for row in updated}
+        self.written += len(found)
+        for user_id, _ in batch:
+            if user_id not in found:
+                self.failed[user_id] = 'user not found'
+    
+    def _flush_rows(self, batch: List[Tuple[str, str]]):
+        """Fallback for a failed batch: one savepoint per row so failures stay per row"""
+        with self.conn.cursor() as cursor:
+            for user_id, keycloak_id in batch:
+                cursor.execute("SAVEPOINT link_row")
+                try:
+                    cursor.execute(
+                        "UPDATE app_user SET keycloak_id = %s WHERE user_id = %s::uuid",
+                        (keycloak_id, user_id)
+                    )
+                    if cursor.rowcount:
+                        self.written += 1
+                    else:
+                        self.failed[user_id] = 'user not found'
+                    cursor.execute("RELEASE SAVEPOINT link_row")
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT link_row")
+                    self.failed[user_id] = str(e).strip()
+        self.conn.commit()
+    
+    def close(self):
+        """Flush anything still queued"""
+        self.flush()
+    
+    _UPDATE_SQL = """
+        UPDATE app_user AS u
+        SET keycloak_id = v.keycloak_id
+        FROM (VALUES %s) AS v(user_id, keycloak_id)
+        WHERE u.user_id = v.user_id::uuid
+        RETURNING u.user_id
+    """
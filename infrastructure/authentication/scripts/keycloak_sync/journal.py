@@ -0,0 +1,124 @@
+"""
+CyberCore Keycloak Integration - Sync Journal
+Resume journal of bulk chunks and the dead-letter file of skipped users
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import threading
+from typing import Dict, Iterable, Iterator, Optional, List, Tuple
+
+class DeadLetterQueue:
+    """Append-only JSONL file of users a sync gave up on, for later replay"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def add(self, realm: str, user: Dict, reason, action: str = 'create'):
+        """Record one skipped user"""
+        entry = {
+            'ts': time.time(),
+            'realm': realm,
+            'action': action,
+            'user_id': str(user['user_id']),
+            'username': user.get('username'),
+            'reason': str(reason)
+        }
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.count += 1
+    
+    def read(self) -> List[Dict]:
+        """All recorded entries, oldest first"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    
+    def replace(self, entries: List[Dict]):
+        """Atomically rewrite the file with the entries that are still failing"""
+        with self._lock:
+            if not entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_path, self.path)
+
+class SyncJournal:
+    """Append-only, fsynced JSONL record of bulk sync chunks: attempted, confirmed and written back
+    
+    A chunk that was attempted but never confirmed is in doubt (the request may
+    or may not have reached Keycloak); one that was confirmed but not written
+    back has its Keycloak IDs in the journal and needs no request at all.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+    
+    def start(self, realm: str):
+        """Truncate the journal and begin a new run"""
+        self.close()
+        self._file = open(self.path, 'w')
+        self.append('start', realm=realm, ts=time.time())
+    
+    def append(self, op: str, **fields):
+        """Write one record and make it durable before returning"""
+        with self._lock:
+            self._file.write(json.dumps(dict(fields, op=op)) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+    
+    def attempts(self, numbered_chunks: Iterable[Tuple[int, List[Dict]]]) -> Iterator[Tuple[int, List[Dict]]]:
+        """Record each chunk as attempted just before it is handed out for sending"""
+        for number, chunk in numbered_chunks:
+            self.append('attempt', chunk=number, users=[str(user['user_id']) for user in chunk])
+            yield number, chunk
+    
+    def load(self) -> Optional[Dict]:
+        """State of an interrupted run, or None if there is no journal
+        
+        A torn last line (the process died mid-write) is ignored; its chunk
+        was never sent, or is still covered by an earlier record.
+        """
+        if not os.path.exists(self.path):
+            return None
+        state = {'realm': None, 'attempted': {}, 'confirmed': {}, 'written': set()}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                op = record.get('op')
+                if op == 'start':
+                    state['realm'] = record.get('realm')
+                elif op == 'attempt':
+                    state['attempted'][record['chunk']] = record['users']
+                elif op == 'confirm':
+                    state['confirmed'][record['chunk']] = record['links']
+                elif op == 'written':
+                    state['written'].update(record['chunks'])
+        return state
+    
+    def clear(self):
+        """Remove the journal after a run that finished"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,77 @@
+"""
+CyberCore Keycloak Integration - Adaptive Limiter
+AIMD rate and concurrency control for admin API requests
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveLimiter:
+    """Token-bucket rate limiter whose rate and concurrency adapt with AIMD
+    
+    Every request takes a token and an in-flight slot. Overload signals (429,
+    503, connection errors) or a latency spike (above both the target and three
+    times the running average) cut the rate and the concurrency limit by
+    DECREASE_FACTOR, at most once per latency window; each healthy response
+    grows them back additively up to the configured ceilings.
+    """
+    
+    DECREASE_FACTOR = 0.7
+    
+    def __init__(self, max_concurrency: int, max_rate: float, target_latency: float = 1.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_rate = max(1.0, max_rate)
+        self.target_latency = target_latency
+        self.limit = float(self.max_concurrency)
+        self.rate = self.max_rate
+        self.tokens = float(self.max_concurrency)
+        self.in_flight = 0
+        self.decreases = 0
+        self.avg_latency: Optional[float] = None
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+    
+    def acquire(self):
+        """Block until both an in-flight slot and a rate token are available"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            while True:
+                now = time.monotonic()
+                self.tokens = min(float(self.max_concurrency),
+                                  self.tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                self._cond.wait((1 - self.tokens) / self.rate)
+            self.in_flight += 1
+    
+    def release(self, latency: float, overloaded: bool):
+        """Return the slot and adjust rate and concurrency from the outcome"""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            spike = self.avg_latency is not None and \
+                latency > max(self.target_latency, 3 * self.avg_latency)
+            if not overloaded:
+                self.avg_latency = latency if self.avg_latency is None else \
+                    0.9 * self.avg_latency + 0.1 * latency
+            if overloaded or spike:
+                if now - self._last_decrease > max(latency, self.target_latency):
+                    self.limit = max(1.0, self.limit * self.DECREASE_FACTOR)
+                    self.rate = max(1.0, self.rate * self.DECREASE_FACTOR)
+                    self._last_decrease = now
+                    self.decreases += 1
+                    logger.debug(f"Backing off: concurrency {int(self.limit)}, rate {self.rate:.1f}/s")
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+            self._cond.notify_all()
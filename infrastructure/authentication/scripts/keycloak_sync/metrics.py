@@ -0,0 +1,175 @@
+"""
+CyberCore Keycloak Integration - Metrics
+Phase timers, per-endpoint request counters and Prometheus output
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, List, Tuple
+from urllib.parse import urlsplit
+
+class Metrics:
+    """Thread-safe run instrumentation: phase timers and per-endpoint request counters
+    
+    Exported as a JSON summary and in the Prometheus text format, so a
+    node_exporter textfile collector can pick the file up.
+    """
+    
+    PREFIX = 'keycloak_integration'
+    # Request latency histogram buckets in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # Path segments that are per-object IDs are folded into one endpoint
+    _ID_SEGMENT = re.compile(r'^(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)$', re.I)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases: Dict[str, Dict] = {}
+        self.endpoints: Dict[Tuple[str, str], Dict] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+    
+    @classmethod
+    def endpoint(cls, url: str) -> str:
+        """URL path with query string dropped and ID segments replaced by {id}"""
+        segments = urlsplit(url).path.rstrip('/').split('/')
+        return '/'.join('{id}' if cls._ID_SEGMENT.match(segment) else segment for segment in segments) or '/'
+    
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block as one occurrence of a phase"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.monotonic() - started)
+    
+    def record_phase(self, name: str, seconds: float):
+        with self._lock:
+            phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_s': 0.0})
+            phase['count'] += 1
+            phase['seconds'] += seconds
+            phase['max_s'] = max(phase['max_s'], seconds)
+    
+    def _endpoint_stats(self, method: str, url: str) -> Dict:
+        key = (method, self.endpoint(url))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = {
+                'requests': 0, 'retries': 0, 'status': {}, 'bytes_sent': 0, 'bytes_received': 0,
+                'seconds': 0.0, 'max_s': 0.0, 'buckets': [0] * len(self.BUCKETS)
+            }
+        return stats
+    
+    def record_request(self, method: str, url: str, status: Optional[int], seconds: float,
+                       bytes_sent: int = 0, bytes_received: int = 0):
+        """Count one HTTP exchange; status None means it failed without a response"""
+        status_class = f"{status // 100}xx" if status else 'error'
+        with self._lock:
+            stats = self._endpoint_stats(method, url)
+            stats['requests'] += 1
+            stats['status'][status_class] = stats['status'].get(status_class, 0) + 1
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['seconds'] += seconds
+            stats['max_s'] = max(stats['max_s'], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+    
+    def record_retry(self, method: str, url: str):
+        with self._lock:
+            self._endpoint_stats(method, url)['retries'] += 1
+    
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+    
+    def summary(self) -> Dict:
+        """Phases and endpoints as plain JSON-serialisable dicts"""
+        with self._lock:
+            phases = {
+                name: {'count': phase['count'], 'seconds': round(phase['seconds'], 3),
+                       'max_s': round(phase['max_s'], 3)}
+                for name, phase in self.phases.items()
+            }
+            endpoints = {}
+            for (method, path), stats in sorted(self.endpoints.items()):
+                endpoints[f"{method} {path}"] = {
+                    'requests': stats['requests'],
+                    'retries': stats['retries'],
+                    'status': dict(stats['status']),
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'seconds': round(stats['seconds'], 3),
+                    'mean_ms': round(stats['seconds'] / stats['requests'] * 1000, 2) if stats['requests'] else 0.0,
+                    'max_ms': round(stats['max_s'] * 1000, 2)
+                }
+        return {'phases': phases, 'endpoints': endpoints}
+    
+    @staticmethod
+    def _labels(**labels) -> str:
+        escaped = (
+            f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in labels.items()
+        )
+        return '{' + ','.join(escaped) + '}'
+    
+    def to_prometheus(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format"""
+        p = self.PREFIX
+        lines: List[str] = []
+        
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+        
+        with self._lock:
+            family('phase_seconds', 'summary', 'Time spent per run phase')
+            for name, phase in sorted(self.phases.items()):
+                labels = self._labels(phase=name)
+                lines.append(f"{p}_phase_seconds_sum{labels} {phase['seconds']:.6f}")
+                lines.append(f"{p}_phase_seconds_count{labels} {phase['count']}")
+            
+            endpoints = sorted(self.endpoints.items())
+            family('requests_total', 'counter', 'Keycloak admin API responses by status class')
+            for (method, path), stats in endpoints:
+                for status_class, count in sorted(stats['status'].items()):
+                    labels = self._labels(method=method, path=path, status=status_class)
+                    lines.append(f"{p}_requests_total{labels} {count}")
+            family('request_retries_total', 'counter', 'Keycloak admin API requests retried')
+            for (method, path), stats in endpoints:
+                lines.append(f"{p}_request_retries_total{self._labels(method=method, path=path)} {stats['retries']}")
+            family('request_bytes_total', 'counter', 'Keycloak admin API body bytes by direction')
+            for (method, path), stats in endpoints:
+                for direction in ('sent', 'received'):
+                    labels = self._labels(method=method, path=path, direction=direction)
+                    lines.append(f"{p}_request_bytes_total{labels} {stats['bytes_' + direction]}")
+            family('request_duration_seconds', 'histogram', 'Keycloak admin API request latency')
+            for (method, path), stats in endpoints:
+                for bound, count in zip(self.BUCKETS, stats['buckets']):
+                    labels = self._labels(method=method, path=path, le=bound)
+                    lines.append(f"{p}_request_duration_seconds_bucket{labels} {count}")
+                labels = self._labels(method=method, path=path, le='+Inf')
+                lines.append(f"{p}_request_duration_seconds_bucket{labels} {stats['requests']}")
+                labels = self._labels(method=method, path=path)
+                lines.append(f"{p}_request_duration_seconds_sum{labels} {stats['seconds']:.6f}")
+                lines.append(f"{p}_request_duration_seconds_count{labels} {stats['requests']}")
+            
+            described = set()
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in described:
+                    described.add(name)
+                    family(name, 'gauge', name.replace('_', ' ').capitalize())
+                lines.append(f"{p}_{name}{self._labels(**dict(labels)) if labels else ''} {value}")
+        return '\n'.join(lines) + '\n'
+    
+    def write_prometheus(self, path: str):
+        """Replace path atomically so a collector never reads a half-written file"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
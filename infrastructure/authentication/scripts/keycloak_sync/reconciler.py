@@ -0,0 +1,250 @@
+"""
+CyberCore Keycloak Integration - Realm Reconciler
+Plans and applies the realm, component and client changes a desired state needs
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, List, Tuple
+
+from ._lazy import requests
+
+if TYPE_CHECKING:
+    from .client import KeycloakAdminClient
+
+# Keycloak masks stored credentials with this value when reading them back
+MASKED_SECRET = '**********'
+
+# Representation keys whose values must not be printed in a plan
+SECRET_KEYS = ('secret', 'password', 'bindCredential', 'clientSecret')
+
+def _strip_masked(value):
+    """Copy of a representation without the masked secrets Keycloak returns on read"""
+    if isinstance(value, dict):
+        return {key: _strip_masked(item) for key, item in value.items()
+                if item != MASKED_SECRET and item != [MASKED_SECRET]}
+    if isinstance(value, list):
+        return [_strip_masked(item) for item in value]
+    return value
+
+def _strip_ids(value):
+    """Copy of a representation without server-assigned IDs, for restoring it next to the original"""
+    if isinstance(value, dict):
+        return {key: _strip_ids(item) for key, item in value.items() if key not in ('id', 'containerId')}
+    if isinstance(value, list):
+        return [_strip_ids(item) for item in value]
+    return value
+
+def _is_empty(value) -> bool:
+    return value in (None, '', [], [''], {})
+
+def _structural_diff(desired, current, path: str = '') -> List[Tuple[str, object, object]]:
+    """(path, current, desired) for every value in desired that current does not match
+    
+    Keys only present in current are left alone, masked secrets always match
+    and lists of scalars compare without regard to order. Lists of named
+    objects such as protocolMappers are matched by name, and server-assigned
+    IDs are ignored, so entries Keycloak has given an id do not show as drift.
+    """
+    if isinstance(desired, dict) and isinstance(current, dict):
+        changes = []
+        for key, value in desired.items():
+            sub_path = f"{path}.{key}" if path else key
+            if key not in current:
+                if not _is_empty(value):
+                    changes.append((sub_path, None, value))
+                continue
+            changes.extend(_structural_diff(value, current[key], sub_path))
+        return changes
+    if current == MASKED_SECRET or current == [MASKED_SECRET]:
+        return []
+    if isinstance(desired, list) and isinstance(current, list) and \
+            any(isinstance(v, dict) for v in desired + current):
+        if all(isinstance(v, dict) and 'name' in v for v in desired + current):
+            by_name = {entry['name']: entry for entry in current}
+            changes = []
+            for entry in desired:
+                sub_path = f"{path}[{entry['name']}]"
+                if entry['name'] not in by_name:
+                    changes.append((sub_path, None, entry))
+                    continue
+                changes.extend(_structural_diff(_strip_ids(entry), by_name[entry['name']], sub_path))
+            return changes
+        if sorted(map(json.dumps, _strip_ids(desired))) == sorted(map(json.dumps, _strip_ids(current))):
+            return []
+        return [(path, current, desired)]
+    if isinstance(desired, list) and isinstance(current, list) and \
+            all(not isinstance(v, (dict, list)) for v in desired + current):
+        if sorted(map(json.dumps, desired)) == sorted(map(json.dumps, current)):
+            return []
+    elif desired == current:
+        return []
+    return [(path, current, desired)]
+
+class RealmReconciler:
+    """Brings a realm, its components and clients to a desired state with as few writes as possible
+    
+    Current state is fetched once per run; every desired resource is planned
+    as a create, an update carrying only the drifted keys, or a no-op.
+    """
+    
+    # Realm keys holding collections that have their own endpoints; they are
+    # sent with a realm create and otherwise added through partialImport
+    REALM_COLLECTIONS = (
+        'users', 'clients', 'roles', 'groups', 'components', 'identityProviders',
+        'identityProviderMappers', 'clientScopes', 'authenticationFlows',
+        'authenticatorConfig', 'requiredActions', 'scopeMappings',
+        'clientScopeMappings', 'federatedUsers', 'defaultRole'
+    )
+    
+    def __init__(self, client: 'KeycloakAdminClient', realm: str):
+        self.client = client
+        self.realm = realm
+        self.current_realm: Optional[Dict] = None
+        self.components: List[Dict] = []
+        self.clients: List[Dict] = []
+        self.writes = 0
+        self._loaded = False
+        self._load_lock = threading.Lock()
+    
+    def load(self):
+        """Fetch the realm with its components and clients"""
+        base = f"/admin/realms/{self.realm}"
+        response = self.client.get(base)
+        self.components, self.clients = [], []
+        if response.status_code == 404:
+            self.current_realm = None
+        else:
+            response.raise_for_status()
+            self.current_realm = response.json()
+            components = self.client.get(f"{base}/components", params={'parent': self.current_realm.get('id')})
+            components.raise_for_status()
+            self.components = components.json()
+            clients = self.client.get(f"{base}/clients")
+            clients.raise_for_status()
+            self.clients = clients.json()
+        self._loaded = True
+    
+    def ensure_loaded(self):
+        with self._load_lock:
+            if not self._loaded:
+                self.load()
+    
+    def plan_realm(self, desired: Dict) -> List[Dict]:
+        """Changes for the realm settings plus any collection entries it is missing"""
+        self.ensure_loaded()
+        if self.current_realm is None:
+            return [self._change('realm', self.realm, 'create', [], 'POST', "/admin/realms", desired)]
+        
+        settings = {k: v for k, v in desired.items() if k not in self.REALM_COLLECTIONS and k != 'id'}
+        diff = _structural_diff(settings, self.current_realm)
+        changed_keys = sorted({path.split('.', 1)[0] for path, _, _ in diff})
+        payload = {key: settings[key] for key in changed_keys}
+        changes = [self._change(
+            'realm', self.realm, 'update' if diff else 'noop', diff,
+            'PUT', f"/admin/realms/{self.realm}", payload
+        )]
+        changes.extend(self.plan_client(c) for c in desired.get('clients', []))
+        changes.append(self._plan_missing_entries(desired))
+        return changes
+    
+    def plan_component(self, desired: Dict) -> Dict:
+        """Create or update a component matched by name and providerId"""
+        self.ensure_loaded()
+        name = desired['name']
+        current = next((c for c in self.components
+                        if c.get('name') == name and c.get('providerId') == desired.get('providerId')), None)
+        path = f"/admin/realms/{self.realm}/components"
+        if current is None:
+            return self._change('component', name, 'create', [], 'POST', path, desired)
+        diff = _structural_diff({k: v for k, v in desired.items() if k != 'id'}, current)
+        merged = dict(current, **{k: v for k, v in desired.items() if k not in ('id', 'config')})
+        merged['config'] = dict(current.get('config', {}), **desired.get('config', {}))
+        return self._change('component', name, 'update' if diff else 'noop', diff,
+                            'PUT', f"{path}/{current['id']}", merged)
+    
+    def plan_client(self, desired: Dict) -> Dict:
+        """Create or update a client matched by clientId"""
+        self.ensure_loaded()
+        client_id = desired['clientId']
+        current = next((c for c in self.clients if c.get('clientId') == client_id), None)
+        path = f"/admin/realms/{self.realm}/clients"
+        if current is None:
+            return self._change('client', client_id, 'create', [], 'POST', path, desired)
+        settings = {k: v for k, v in desired.items() if k != 'id'}
+        diff = _structural_diff(settings, current)
+        return self._change('client', client_id, 'update' if diff else 'noop', diff,
+                            'PUT', f"{path}/{current['id']}", dict(current, **settings))
+    
+    def _plan_missing_entries(self, desired: Dict) -> Dict:
+        """One SKIP partialImport for realm roles, groups and identity providers that do not exist yet"""
+        base = f"/admin/realms/{self.realm}"
+        wanted = {
+            'roles': (desired.get('roles', {}).get('realm', []), f"{base}/roles", 'name'),
+            'groups': (desired.get('groups', []), f"{base}/groups", 'name'),
+            'identityProviders': (desired.get('identityProviders', []), f"{base}/identity-provider/instances", 'alias')
+        }
+        payload: Dict = {'ifResourceExists': 'SKIP'}
+        diff = []
+        for kind, (entries, path, key) in wanted.items():
+            if not entries:
+                continue
+            response = self.client.get(path)
+            response.raise_for_status()
+            existing = {entry.get(key) for entry in response.json()}
+            missing = [entry for entry in entries if entry.get(key) not in existing]
+            if missing:
+                payload[kind] = {'realm': missing} if kind == 'roles' else missing
+                diff.extend((f"{kind}.{entry.get(key)}", None, 'missing') for entry in missing)
+        return self._change('realm', f"{self.realm} entries", 'create' if diff else 'noop', diff,
+                            'POST', f"{base}/partialImport", payload)
+    
+    def _change(self, resource: str, name: str, action: str, diff: List[Tuple],
+                method: str, path: str, payload: Dict) -> Dict:
+        return {
+            'resource': resource, 'name': name, 'action': action, 'diff': diff,
+            'method': method, 'path': path, 'payload': payload
+        }
+    
+    def apply(self, change: Dict) -> requests.Response:
+        """Send one planned change and keep the cached state in step with it"""
+        payload = change['payload']
+        if change['resource'] == 'component' and change['action'] == 'create' and self.current_realm:
+            payload = dict(payload, parentId=payload.get('parentId') or self.current_realm.get('id'))
+        response = self.client.request(change['method'], change['path'], json=payload)
+        if response.status_code not in (200, 201, 204):
+            return response
+        self.writes += 1
+        if change['resource'] == 'realm':
+            if change['action'] == 'create' and change['path'] == "/admin/realms":
+                # Refetch so the new realm's id, components and clients are known
+                self.load()
+            elif change['action'] == 'update':
+                self.current_realm.update(payload)
+            # A partialImport of missing entries touches none of the cached state
+        elif change['action'] == 'create':
+            created = dict(payload, id=response.headers.get('Location', '').rsplit('/', 1)[-1])
+            (self.components if change['resource'] == 'component' else self.clients).append(created)
+        elif change['action'] == 'update':
+            cache = self.components if change['resource'] == 'component' else self.clients
+            for i, entry in enumerate(cache):
+                if entry.get('id') == payload.get('id'):
+                    cache[i] = payload
+        return response
+    
+    @staticmethod
+    def format_plan(changes: List[Dict]) -> str:
+        """Human-readable diff, with secrets redacted"""
+        symbols = {'create': '+', 'update': '~', 'noop': '='}
+        lines = []
+        for change in changes:
+            lines.append(f"{symbols[change['action']]} {change['resource']} {change['name']}")
+            for path, before, after in change['diff']:
+                if path.rsplit('.', 1)[-1] in SECRET_KEYS:
+                    before, after = ('<secret>' if before is not None else None), '<secret>'
+                lines.append(f"    {path}: {json.dumps(before)} -> {json.dumps(after)}")
+        writes = sum(1 for c in changes if c['action'] != 'noop')
+        lines.append(f"{writes} change(s), {len(changes) - writes} resource(s) up to date")
+        return '\n'.join(lines)
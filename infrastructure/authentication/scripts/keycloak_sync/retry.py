@@ -0,0 +1,37 @@
+"""
+CyberCore Keycloak Integration - Retry Policy
+Backoff for transient Keycloak failures
+"""
+
+from __future__ import annotations
+
+import time
+import random
+from typing import Optional
+
+from ._lazy import email, requests
+
+class RetryPolicy:
+    """Jittered exponential backoff for transient Keycloak failures"""
+    
+    RETRY_STATUSES = (429, 502, 503, 504)
+    
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.2, max_delay: float = 10.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Seconds to wait before retry number attempt, honouring Retry-After"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay * 6)
+            except ValueError:
+                try:
+                    wait_until = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                    return min(max(0.0, wait_until - time.time()), self.max_delay * 6)
+                except (TypeError, ValueError):
+                    pass
+        # Full jitter spreads out workers that failed at the same moment
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
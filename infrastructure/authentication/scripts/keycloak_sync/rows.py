@@ -0,0 +1,105 @@
+"""
+CyberCore Keycloak Integration - Row Streaming
+Chunking and background-thread row streams shared by the sync paths
+"""
+
+from __future__ import annotations
+
+import itertools
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Iterator, Optional, List
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """Group an iterable into lists of at most size items without materializing it"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class PrefetchedRows:
+    """Runs a row generator on a background thread and hands rows over through a bounded queue
+    
+    Lets the PostgreSQL export start while Keycloak is still booting without
+    giving up the flat memory profile of the streaming cursor.
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, produce: Callable[[], Iterator[Dict]], maxsize: int):
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, maxsize))
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, args=(produce,), daemon=True, name='user-prefetch')
+        self._thread.start()
+    
+    def _run(self, produce: Callable[[], Iterator[Dict]]):
+        try:
+            for row in produce():
+                self._queue.put(row)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(self._DONE)
+    
+    def __iter__(self) -> Iterator[Dict]:
+        while True:
+            row = self._queue.get()
+            if row is self._DONE:
+                if self._error:
+                    raise self._error
+                return
+            yield row
+
+class PartitionedRows:
+    """Runs one row generator on a background thread and routes each row to per-key bounded queues
+    
+    Lets several consumers share a single PostgreSQL export at flat memory; a
+    consumer that gives up is closed so the producer never blocks on its queue.
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, produce: Callable[[], Iterator[Dict]], route: Callable[[Dict], Iterable[str]],
+                 keys: Iterable[str], maxsize: int):
+        self._queues = {key: queue.Queue(maxsize=max(1, maxsize)) for key in keys}
+        self._closed: set = set()
+        self._error: Optional[Exception] = None
+        self.rows = 0
+        self._thread = threading.Thread(target=self._run, args=(produce, route), daemon=True, name='user-partition')
+        self._thread.start()
+    
+    def _put(self, key: str, item):
+        while key not in self._closed:
+            try:
+                self._queues[key].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def _run(self, produce: Callable[[], Iterator[Dict]], route: Callable[[Dict], Iterable[str]]):
+        try:
+            for row in produce():
+                self.rows += 1
+                for key in route(row):
+                    self._put(key, row)
+        except Exception as e:
+            self._error = e
+        finally:
+            for key in self._queues:
+                self._put(key, self._DONE)
+    
+    def stream(self, key: str) -> Iterator[Dict]:
+        """Rows routed to key, raising the producer's error at the end if it failed"""
+        while True:
+            row = self._queues[key].get()
+            if row is self._DONE:
+                if self._error:
+                    raise self._error
+                return
+            yield row
+    
+    def close(self, key: str):
+        """Stop routing rows to key"""
+        self._closed.add(key)
@@ -0,0 +1,143 @@
+"""
+CyberCore Keycloak Integration - Setup Graph
+Dependency graph of setup steps, run concurrently where they allow
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, Optional, List
+
+logger = logging.getLogger(__name__)
+
+class SetupStep:
+    """One node of the setup graph: a callable returning bool plus the steps it requires"""
+    
+    def __init__(self, name: str, fn: Callable[[], bool], requires: Iterable[str] = (),
+                 failure_message: Optional[str] = None):
+        self.name = name
+        self.fn = fn
+        self.requires = list(requires)
+        self.failure_message = failure_message or f"Step {name} failed, continuing..."
+        self.status = 'pending'
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+    
+    @property
+    def seconds(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+class SetupGraph:
+    """Runs setup steps concurrently as soon as all of their prerequisites have succeeded
+    
+    A step whose prerequisite failed or was skipped is skipped itself; steps
+    that do not depend on it carry on.
+    """
+    
+    def __init__(self, steps: List[SetupStep]):
+        self.steps: Dict[str, SetupStep] = {step.name: step for step in steps}
+        for step in steps:
+            unknown = [name for name in step.requires if name not in self.steps]
+            if unknown:
+                raise ValueError(f"Step {step.name} requires unknown steps {unknown}")
+        self._check_acyclic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+    
+    def _check_acyclic(self):
+        visiting, done = set(), set()
+        
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Setup steps form a cycle through {name}")
+            visiting.add(name)
+            for required in self.steps[name].requires:
+                visit(required)
+            visiting.discard(name)
+            done.add(name)
+        
+        for name in self.steps:
+            visit(name)
+    
+    def _execute(self, step: SetupStep):
+        step.started = time.monotonic()
+        try:
+            ok = bool(step.fn())
+        except Exception as e:
+            ok = False
+            step.error = str(e)
+            logger.error(f"Step {step.name} raised: {e}")
+        step.finished = time.monotonic()
+        step.status = 'ok' if ok else 'failed'
+        if not ok:
+            logger.warning(step.failure_message)
+    
+    def run(self) -> Dict[str, SetupStep]:
+        """Execute every step, returning them keyed by name"""
+        self.started = time.monotonic()
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.steps)), thread_name_prefix='setup') as pool:
+            while True:
+                for step in self.steps.values():
+                    if step.status != 'pending':
+                        continue
+                    statuses = [self.steps[name].status for name in step.requires]
+                    if any(status in ('failed', 'skipped') for status in statuses):
+                        step.status = 'skipped'
+                        blocked = [name for name in step.requires if self.steps[name].status != 'ok']
+                        logger.warning(f"Skipping {step.name}: prerequisite {', '.join(blocked)} did not succeed")
+                    elif all(status == 'ok' for status in statuses):
+                        step.status = 'running'
+                        pending[pool.submit(self._execute, step)] = step
+                if not pending:
+                    if any(step.status == 'pending' for step in self.steps.values()):
+                        # Steps skipped in this pass may have dependents left to skip
+                        continue
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+        self.finished = time.monotonic()
+        return self.steps
+    
+    def critical_path(self) -> List[SetupStep]:
+        """Chain of steps that bounded the run: the last step to finish and, walking
+        back, the prerequisite that finished last before it"""
+        ran = [step for step in self.steps.values() if step.finished is not None]
+        if not ran:
+            return []
+        path = [max(ran, key=lambda step: step.finished)]
+        while True:
+            prerequisites = [self.steps[name] for name in path[-1].requires
+                             if self.steps[name].finished is not None]
+            if not prerequisites:
+                break
+            path.append(max(prerequisites, key=lambda step: step.finished))
+        return list(reversed(path))
+    
+    def report(self) -> Dict:
+        """Per-step status and timing plus the critical path, for the JSON run summary"""
+        steps = {}
+        for step in self.steps.values():
+            steps[step.name] = {'status': step.status, 'seconds': round(step.seconds, 3), 'requires': step.requires}
+            if step.error:
+                steps[step.name]['error'] = step.error
+        return {'steps': steps, 'critical_path': [step.name for step in self.critical_path()]}
+    
+    def summary(self) -> List[str]:
+        """Per-step status and timing followed by the critical path"""
+        lines = [f"{step.name:<10} {step.status:<8} {step.seconds:7.2f}s" for step in self.steps.values()]
+        path = self.critical_path()
+        if path and self.started is not None and self.finished is not None:
+            lines.append(
+                f"Critical path: {' -> '.join(step.name for step in path)} "
+                f"({sum(step.seconds for step in path):.2f}s of {self.finished - self.started:.2f}s)"
+            )
+        return lines
@@ -0,0 +1,252 @@
+"""
+CyberCore Keycloak Integration - Snapshots
+Export and import of a realm with its users and app_user links as compressed NDJSON
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import itertools
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List
+
+from ._lazy import gzip
+from .reconciler import RealmReconciler, _strip_ids, _strip_masked
+from .rows import _chunked
+
+logger = logging.getLogger(__name__)
+
+# Snapshot files: one JSON record per line, {"type": ..., "data": ...}, gzip or zstd compressed
+SNAPSHOT_VERSION = 1
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def _open_snapshot(path: str, mode: str):
+    """Text stream over a snapshot; written as zstd for .zst paths, read by content"""
+    if mode == 'w':
+        use_zstd = path.endswith('.zst')
+    else:
+        with open(path, 'rb') as f:
+            use_zstd = f.read(4) == ZSTD_MAGIC
+    if not use_zstd:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    try:
+        import zstandard
+    except ImportError:  # optional dependency
+        raise RuntimeError("zstd snapshots need the zstandard package; use a .gz path instead")
+    return zstandard.open(path, mode + 't', encoding='utf-8')
+
+class SnapshotMixin:
+    """Snapshot export and import of KeycloakIntegration (the snapshot command)"""
+    
+    def export_snapshot(self, path: str) -> bool:
+        """Stream the realm with its components, clients, roles, groups and users plus the
+        app_user links into one compressed NDJSON file
+        
+        Group memberships ride along in each user's groups so a restore needs no
+        per-membership calls. Keycloak masks stored secrets on read, so they are
+        left out; the storage, LDAP and webhook steps set them from the environment.
+        """
+        logger.info(f"Exporting realm {self.realm_name} to {path}...")
+        started = time.monotonic()
+        counts: Dict[str, int] = {}
+        tmp_path = f"{path}.tmp"
+        
+        try:
+            self.reconciler.load()
+            realm = self.reconciler.current_realm
+            if realm is None:
+                logger.error(f"Realm {self.realm_name} does not exist")
+                return False
+            base = f"/admin/realms/{self.realm_name}"
+            roles = self.client.get(f"{base}/roles", params={'briefRepresentation': 'false'})
+            roles.raise_for_status()
+            groups = self.client.get(f"{base}/groups", params={'briefRepresentation': 'false'})
+            groups.raise_for_status()
+            groups = groups.json()
+            
+            memberships: Dict[str, List[str]] = {}
+            for group in self._iter_group_tree(groups):
+                for member in self._iter_group_members(group['id']):
+                    memberships.setdefault(member['id'], []).append(group['path'])
+            
+            with _open_snapshot(tmp_path, 'w') as f:
+                def write(kind: str, data: Dict):
+                    f.write(json.dumps({'type': kind, 'data': data}, separators=(',', ':')) + '\n')
+                    counts[kind] = counts.get(kind, 0) + 1
+                
+                write('header', {'version': SNAPSHOT_VERSION, 'realm': self.realm_name,
+                                 'exported_at': datetime.now(timezone.utc).isoformat()})
+                write('realm', _strip_masked({key: value for key, value in realm.items()
+                                              if key not in RealmReconciler.REALM_COLLECTIONS}))
+                # Top-level components only: Keycloak recreates provider sub-components such as LDAP mappers
+                for component in self.reconciler.components:
+                    write('component', _strip_masked({key: value for key, value in component.items()
+                                                      if key != 'parentId'}))
+                for client in self.reconciler.clients:
+                    write('client', _strip_masked(client))
+                for role in roles.json():
+                    write('role', role)
+                for group in groups:
+                    write('group', group)
+                
+                for user in self._iter_keycloak_users({'pages': 0}):
+                    if user.get('federationLink'):
+                        # Lives in the federated store, not the realm
+                        continue
+                    user.pop('access', None)
+                    if user['id'] in memberships:
+                        user['groups'] = memberships[user['id']]
+                    write('user', user)
+                
+                conn = self._connect_db(readonly=True)
+                try:
+                    for row in self._iter_rows(conn, """
+                        SELECT user_id, username, keycloak_id FROM app_user
+                        WHERE keycloak_id IS NOT NULL
+                    """, name='kc_snapshot_links'):
+                        write('link', {'user_id': str(row['user_id']), 'username': row['username'],
+                                       'keycloak_id': row['keycloak_id']})
+                finally:
+                    conn.close()
+            os.replace(tmp_path, path)
+            
+        except Exception as e:
+            logger.error(f"Error exporting snapshot: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        
+        logger.info(
+            f"Exported {', '.join(f'{count} {kind}' for kind, count in counts.items() if kind != 'header')} "
+            f"({os.path.getsize(path) / 1024:.0f} KiB) in {time.monotonic() - started:.2f}s"
+        )
+        return True
+    
+    def import_snapshot(self, path: str) -> bool:
+        """Restore a snapshot through the bulk paths
+        
+        Realm settings, roles and groups go in one realm create (or one SKIP
+        partialImport into an existing realm), components and clients through
+        the reconciler, users with their IDs and memberships in concurrent
+        partialImport chunks, and links in batched app_user writes.
+        """
+        logger.info(f"Restoring {path} into realm {self.realm_name}...")
+        stats = {'components': 0, 'clients': 0, 'users': 0, 'added': 0, 'skipped': 0,
+                 'overwritten': 0, 'failed': 0, 'linked': 0, 'links_missing': 0}
+        started = time.monotonic()
+        
+        try:
+            records = self._read_snapshot(path)
+            header = next(records, {'type': None})
+            if header['type'] != 'header' or header['data'].get('version') != SNAPSHOT_VERSION:
+                logger.error(f"{path} is not a version {SNAPSHOT_VERSION} snapshot")
+                return False
+            
+            config = {'realm': [], 'component': [], 'client': [], 'role': [], 'group': []}
+            # Keycloak IDs of users that already existed under another ID, by lowercase username
+            renamed: Dict[str, str] = {}
+            configured = False
+            
+            # Records are grouped by type in the order written, so users and links
+            # stream through without being held in memory
+            for kind, group in itertools.groupby(records, key=lambda record: record['type']):
+                items = (record['data'] for record in group)
+                if kind in config:
+                    config[kind].extend(items)
+                    continue
+                if not configured:
+                    if not self._restore_realm_config(config, header['data']['realm'], stats):
+                        return False
+                    configured = True
+                if kind == 'user':
+                    self._restore_users(items, renamed, stats,
+                                        keep_ids=header['data']['realm'] == self.realm_name)
+                elif kind == 'link':
+                    self._restore_links(items, renamed, stats)
+            if not configured and not self._restore_realm_config(config, header['data']['realm'], stats):
+                return False
+            
+        except Exception as e:
+            logger.error(f"Error restoring snapshot: {e}")
+            return False
+        finally:
+            stats['seconds'] = round(time.monotonic() - started, 3)
+            self.last_sync_stats = stats
+        
+        logger.info(
+            f"Restored {stats['components']} components, {stats['clients']} clients and {stats['users']} users "
+            f"(added {stats['added']}, skipped {stats['skipped']}, failed {stats['failed']}), "
+            f"linked {stats['linked']} app_user rows ({stats['links_missing']} not in this database) "
+            f"in {stats['seconds']:.2f}s"
+        )
+        return stats['failed'] == 0
+    
+    def _read_snapshot(self, path: str) -> Iterator[Dict]:
+        with _open_snapshot(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    
+    def _restore_realm_config(self, config: Dict[str, List[Dict]], source_realm: str, stats: Dict) -> bool:
+        """Realm with roles and groups first, then components and clients"""
+        desired = dict(config['realm'][0] if config['realm'] else {}, realm=self.realm_name, enabled=True)
+        if source_realm != self.realm_name:
+            # Restoring under another name; the original realm may still exist on this
+            # server, so every ID (nested groups, role containers, client mappers) is left
+            # for Keycloak to assign
+            config = {kind: _strip_ids(items) for kind, items in config.items()}
+            desired = _strip_ids(desired)
+        desired['roles'] = {'realm': config['role']}
+        desired['groups'] = config['group']
+        if not self._apply_changes(self.reconciler.plan_realm(desired)):
+            return False
+        
+        changes = [self.reconciler.plan_component(component) for component in config['component']]
+        changes.extend(self.reconciler.plan_client(client) for client in config['client'])
+        stats['components'] = len(config['component'])
+        stats['clients'] = len(config['client'])
+        return self._apply_changes(changes)
+    
+    def _restore_users(self, users: Iterable[Dict], renamed: Dict[str, str], stats: Dict, keep_ids: bool = True):
+        """partialImport users in concurrent chunks, keeping their IDs unless restoring under another
+        realm name; users that end up with a new ID are recorded in renamed for the links"""
+        def import_chunk(chunk: List[Dict]) -> Dict:
+            response = self.client.post(
+                f"/admin/realms/{self.realm_name}/partialImport",
+                json={'ifResourceExists': self.sync_if_exists,
+                      'users': chunk if keep_ids else [_strip_ids(user) for user in chunk]},
+                timeout=(self.kc_timeout, self.kc_import_timeout)
+            )
+            response.raise_for_status()
+            return response.json()
+        
+        for chunk, result, error in self.client.map_concurrent(import_chunk, _chunked(users, self.sync_batch_size)):
+            stats['users'] += len(chunk)
+            if error:
+                logger.warning(f"partialImport failed for {len(chunk)} snapshot users: {error}")
+                stats['failed'] += len(chunk)
+                continue
+            for key in ('added', 'skipped', 'overwritten'):
+                stats[key] += result.get(key, 0)
+            snapshot_ids = {user['username'].lower(): user.get('id') for user in chunk}
+            for item in result.get('results', []):
+                username = (item.get('resourceName') or '').lower()
+                if item.get('resourceType') == 'USER' and item.get('id') and \
+                        snapshot_ids.get(username) not in (None, item['id']):
+                    renamed[username] = item['id']
+    
+    def _restore_links(self, links: Iterable[Dict], renamed: Dict[str, str], stats: Dict):
+        """Write app_user.keycloak_id for rows this database has"""
+        conn = self._connect_db()
+        try:
+            writer = self._id_writer(conn)
+            for link in links:
+                writer.add(link['user_id'], renamed.get(link['username'].lower(), link['keycloak_id']))
+            writer.close()
+            stats['linked'] += writer.written
+            stats['links_missing'] += len(writer.failed)
+        finally:
+            conn.close()
@@ -0,0 +1,120 @@
+"""
+CyberCore Keycloak Integration - Token Manager
+Admin token lifecycle shared by every concurrent worker
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from ._lazy import requests
+
+if TYPE_CHECKING:
+    from .client import KeycloakAdminClient
+
+logger = logging.getLogger(__name__)
+
+class TokenError(Exception):
+    """Raised when no admin token can be obtained"""
+
+class TokenManager:
+    """Central owner of the admin access token, shared by all concurrent workers
+    
+    Tokens are refreshed ahead of expiry. While the current token is still
+    valid exactly one caller performs the refresh and everyone else keeps
+    using the old token; only an expired (or rejected) token makes callers
+    wait for the refresh.
+    """
+    
+    def __init__(self, client: 'KeycloakAdminClient', realm: str = 'master',
+                 client_id: str = 'admin-cli', client_secret: str = '',
+                 username: str = '', password: str = '', refresh_skew: float = 30.0):
+        self.client = client
+        self.token_path = f"/realms/{realm}/protocol/openid-connect/token"
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.username = username
+        self.password = password
+        self.refresh_skew = refresh_skew
+        self.grant_type = 'client_credentials' if client_secret else 'password'
+        
+        self._lock = threading.Lock()
+        # (access_token, refresh_at, expires_at), replaced atomically
+        self._state: Tuple[Optional[str], float, float] = (None, 0.0, 0.0)
+        self._refresh_token: Optional[str] = None
+        self._refresh_expires_at = 0.0
+        self.refreshes = 0
+    
+    def token(self) -> str:
+        """Return a valid access token, refreshing centrally when needed"""
+        access_token, refresh_at, expires_at = self._state
+        now = time.monotonic()
+        if access_token and now < refresh_at:
+            return access_token
+        
+        if access_token and now < expires_at:
+            # Still usable: refresh only if nobody else is already doing it
+            if self._lock.acquire(blocking=False):
+                try:
+                    if self._state[0] == access_token:
+                        self._refresh()
+                except (TokenError, requests.exceptions.RequestException) as e:
+                    logger.warning(f"Proactive token refresh failed, keeping current token: {e}")
+                finally:
+                    self._lock.release()
+            return self._state[0]
+        
+        with self._lock:
+            # Another caller may have refreshed while we waited
+            if self._state[0] and self._state[0] != access_token and time.monotonic() < self._state[2]:
+                return self._state[0]
+            self._refresh()
+            return self._state[0]
+    
+    def invalidate(self, access_token: str):
+        """Mark a token the server rejected as expired so the next caller refreshes it"""
+        with self._lock:
+            if self._state[0] == access_token:
+                self._state = (access_token, 0.0, 0.0)
+    
+    def _refresh(self):
+        """Obtain a new token, using the refresh token while it is still valid"""
+        if self._refresh_token and time.monotonic() < self._refresh_expires_at:
+            data = {'grant_type': 'refresh_token', 'refresh_token': self._refresh_token}
+            if self._store(self._request_token(data)):
+                return
+            logger.info("Refresh token rejected, requesting a new token")
+        
+        if self.grant_type == 'client_credentials':
+            data = {'grant_type': 'client_credentials'}
+        else:
+            data = {'grant_type': 'password', 'username': self.username, 'password': self.password}
+        
+        response = self._request_token(data)
+        if not self._store(response):
+            raise TokenError(f"token request failed: {response.status_code}")
+    
+    def _request_token(self, data: Dict) -> requests.Response:
+        data = dict(data, client_id=self.client_id)
+        if self.client_secret:
+            data['client_secret'] = self.client_secret
+        return self.client.post(self.token_path, data=data, authenticate=False)
+    
+    def _store(self, response: requests.Response) -> bool:
+        if response.status_code != 200:
+            return False
+        
+        payload = response.json()
+        now = time.monotonic()
+        lifetime = float(payload.get('expires_in', 60))
+        # Refresh ahead of expiry, but never in the first half of a short-lived token
+        skew = min(self.refresh_skew, lifetime / 2)
+        self._state = (payload['access_token'], now + lifetime - skew, now + lifetime)
+        self._refresh_token = payload.get('refresh_token')
+        self._refresh_expires_at = now + float(payload.get('refresh_expires_in') or 0)
+        self.refreshes += 1
+        logger.debug(f"Obtained admin token valid for {lifetime:.0f}s ({self.grant_type})")
+        return True
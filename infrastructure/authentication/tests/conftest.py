@@ -0,0 +1,170 @@
+"""
+Shared fixtures: the keycloak_sync package, the bench's FakeKeycloak and,
+when TEST_DB_HOST is set, a throwaway PostgreSQL database with 001_init_db.sql applied
+"""
+
+import os
+import sys
+import json
+import threading
+import importlib.util
+
+import pytest
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+SCHEMA_FILE = os.path.abspath(os.path.join(
+    SCRIPTS_DIR, '..', '..', '..', 'cybercore', 'config', 'postgres', '001_init_db.sql'
+))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from keycloak_sync import KeycloakAdminClient, RetryPolicy, TokenManager  # noqa: E402
+
+def _load_script(module_name: str, filename: str):
+    """Import one of the hyphenated scripts next to the package"""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def bench():
+    return _load_script('keycloak_bench', 'keycloak-bench.py')
+
+@pytest.fixture(scope='session')
+def integration_module():
+    return _load_script('keycloak_integration', 'keycloak-integration.py')
+
+@pytest.fixture
+def fake_keycloak(bench):
+    """FakeKeycloak on a free port; its base URL is in .url"""
+    fake = bench.FakeKeycloak()
+    fake.url = fake.start()
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def inject_faults(fake_keycloak, monkeypatch):
+    """Answer chosen requests with scripted statuses before they reach the fake's routes
+    
+    inject_faults(method, route, statuses, when=None) adds a rule: requests for
+    method and route (with IDs as {id}) whose JSON body satisfies when take the
+    next entry of statuses, a status or (status, headers), until it runs out.
+    """
+    rules = []
+    lock = threading.Lock()
+    real_route = fake_keycloak._route
+    
+    def route(method, path, parsed, raw):
+        body = json.loads(raw) if raw[:1] in (b'{', b'[') else None
+        for rule_method, rule_route, statuses, when in rules:
+            if (rule_method, rule_route) != (method, path) or (when is not None and not when(body)):
+                continue
+            with lock:
+                answer = next(statuses, None)
+            if answer is not None:
+                status, headers = answer if isinstance(answer, tuple) else (answer, {})
+                return status, {'error': 'injected'}, headers
+        return real_route(method, path, parsed, raw)
+    
+    monkeypatch.setattr(fake_keycloak, '_route', route)
+    
+    def add(method, route, statuses, when=None):
+        rules.append((method, route, iter(statuses), when))
+    return add
+
+@pytest.fixture
+def fast_retries():
+    """Retry policy with millisecond backoff so retry tests stay quick"""
+    return RetryPolicy(max_attempts=4, base_delay=0.001, max_delay=0.01)
+
+@pytest.fixture
+def admin_client(fake_keycloak, fast_retries):
+    client = KeycloakAdminClient(fake_keycloak.url, concurrency=4, retry_policy=fast_retries)
+    client.token_manager = TokenManager(client, username='admin', password='admin')
+    yield client
+    client.close()
+
+@pytest.fixture
+def postgres_db():
+    """Connection parameters of a fresh database, or skip when TEST_DB_HOST is not set
+
+    TEST_DB_SCHEMA replaces 001_init_db.sql, e.g. with a copy that does not need
+    the pgcrypto extension on servers that lack it.
+    """
+    host = os.getenv('TEST_DB_HOST')
+    if not host:
+        pytest.skip('set TEST_DB_HOST (and TEST_DB_PORT/USER/PASS) to run PostgreSQL tests')
+    psycopg2 = pytest.importorskip('psycopg2')
+    params = {
+        'host': host,
+        'port': os.getenv('TEST_DB_PORT', '5432'),
+        'user': os.getenv('TEST_DB_USER', 'postgres'),
+        'password': os.getenv('TEST_DB_PASS', '')
+    }
+    name = f"keycloak_sync_test_{os.getpid()}"
+
+    admin = psycopg2.connect(dbname=os.getenv('TEST_DB_ADMIN_DB', 'postgres'), **params)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {name}")
+        cursor.execute(f"CREATE DATABASE {name}")
+    conn = psycopg2.connect(dbname=name, **params)
+    conn.autocommit = True
+    with conn.cursor() as cursor, open(os.getenv('TEST_DB_SCHEMA', SCHEMA_FILE)) as f:
+        cursor.execute(f.read())
+    conn.close()
+
+    yield dict(params, dbname=name)
+
+    with admin.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+    admin.close()
+
+@pytest.fixture
+def db_conn(postgres_db):
+    """Autocommit connection to the test database"""
+    import psycopg2
+    conn = psycopg2.connect(**postgres_db)
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def make_integration(integration_module, fake_keycloak, tmp_path, monkeypatch):
+    """Factory for KeycloakIntegration instances wired to the fake, holding an admin token
+    
+    Keyword arguments are extra environment settings; state files go to tmp_path.
+    """
+    created = []
+    
+    def make(**env):
+        monkeypatch.setenv('KC_SERVER', fake_keycloak.url)
+        monkeypatch.setenv('KC_HEALTH_URL', f"{fake_keycloak.url}/health/ready")
+        monkeypatch.setenv('KC_RATE_LIMIT', '100000')
+        monkeypatch.setenv('SYNC_STATE_DIR', str(tmp_path))
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        integration = integration_module.KeycloakIntegration()
+        created.append(integration)
+        assert integration.get_admin_token()
+        return integration
+    
+    yield make
+    for integration in created:
+        integration.client.close()
+        if integration.id_cache is not None:
+            integration.id_cache.close()
+
+@pytest.fixture
+def database_env(postgres_db, monkeypatch):
+    """Point the integration's DB_* settings at the test database"""
+    monkeypatch.setenv('DB_HOST', postgres_db['host'])
+    monkeypatch.setenv('DB_PORT', str(postgres_db['port']))
+    monkeypatch.setenv('DB_USER', postgres_db['user'])
+    monkeypatch.setenv('DB_PASS', postgres_db['password'])
+    monkeypatch.setenv('DB_NAME', postgres_db['dbname'])
+
+@pytest.fixture
+def integration(make_integration, database_env):
+    """KeycloakIntegration wired to the fake and the test database"""
+    return make_integration()
@@ -0,0 +1,80 @@
+"""KeycloakAdminClient and TokenManager against FakeKeycloak"""
+
+import pytest
+
+from keycloak_sync import KeycloakAdminClient, TokenError, TokenManager
+
+def test_request_sends_bearer_token(admin_client, fake_keycloak):
+    response = admin_client.get('/admin/realms/cybercore')
+    assert response.status_code == 200
+    assert response.request.headers['Authorization'].startswith('Bearer ')
+    assert fake_keycloak.requests['POST /realms/master/protocol/openid-connect/token'] == 1
+
+def test_transient_statuses_are_retried(admin_client, fake_keycloak, inject_faults):
+    inject_faults('GET', '/admin/realms/cybercore/users/count', [503, 502])
+    response = admin_client.get('/admin/realms/cybercore/users/count')
+    assert response.status_code == 200
+    assert admin_client.retries == 2
+    assert fake_keycloak.requests['GET /admin/realms/cybercore/users/count'] == 3
+
+def test_retries_stop_at_max_attempts(admin_client, fake_keycloak, inject_faults):
+    inject_faults('GET', '/admin/realms/cybercore/users/count', [503] * 10)
+    response = admin_client.get('/admin/realms/cybercore/users/count')
+    assert response.status_code == 503
+    assert fake_keycloak.requests['GET /admin/realms/cybercore/users/count'] == admin_client.retry_policy.max_attempts
+
+def test_client_errors_are_not_retried(admin_client, fake_keycloak, inject_faults):
+    inject_faults('GET', '/admin/realms/cybercore/users/count', [400])
+    assert admin_client.get('/admin/realms/cybercore/users/count').status_code == 400
+    assert admin_client.retries == 0
+
+def test_unauthorized_refreshes_the_token_once(admin_client, fake_keycloak, inject_faults):
+    inject_faults('GET', '/admin/realms/cybercore/users/count', [401, 401])
+    response = admin_client.get('/admin/realms/cybercore/users/count')
+    # The second 401 comes back to the caller rather than looping on refreshes
+    assert response.status_code == 401
+    assert admin_client.token_manager.refreshes == 2
+    assert fake_keycloak.requests['GET /admin/realms/cybercore/users/count'] == 2
+
+def test_map_concurrent_yields_every_item(admin_client):
+    def square(n):
+        if n == 3:
+            raise ValueError('three')
+        return n * n
+
+    results = {item: (result, error) for item, result, error in admin_client.map_concurrent(square, range(50))}
+    assert set(results) == set(range(50))
+    assert results[7] == (49, None)
+    assert isinstance(results[3][1], ValueError)
+
+def test_token_is_shared_until_it_needs_refreshing(admin_client, fake_keycloak):
+    manager = admin_client.token_manager
+    first = manager.token()
+    assert manager.token() == first
+    assert manager.grant_type == 'password'
+
+    # Past the refresh point but before expiry the refresh token grant is used
+    access_token, _, expires_at = manager._state
+    manager._state = (access_token, 0.0, expires_at)
+    second = manager.token()
+    assert second != first
+    assert manager.refreshes == 2
+    assert fake_keycloak.requests['POST /realms/master/protocol/openid-connect/token'] == 2
+
+def test_invalidated_token_is_replaced(admin_client):
+    manager = admin_client.token_manager
+    first = manager.token()
+    manager.invalidate(first)
+    assert manager.token() != first
+
+def test_client_credentials_grant(fake_keycloak):
+    client = KeycloakAdminClient(fake_keycloak.url)
+    manager = TokenManager(client, client_id='cybercore-sync', client_secret='s3cret')
+    assert manager.grant_type == 'client_credentials'
+    assert manager.token()
+    client.close()
+
+def test_rejected_credentials_raise(admin_client, fake_keycloak, inject_faults):
+    inject_faults('POST', '/realms/master/protocol/openid-connect/token', [401])
+    with pytest.raises(TokenError):
+        admin_client.token_manager.token()
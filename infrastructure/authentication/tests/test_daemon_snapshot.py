@@ -0,0 +1,133 @@
+"""Sync daemon and snapshot export/import; everything but the notify parsing and
+snapshot streams needs PostgreSQL (TEST_DB_HOST)"""
+
+import json
+import signal
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from keycloak_sync import DaemonMixin
+from keycloak_sync.snapshot import ZSTD_MAGIC, _open_snapshot
+
+def test_notifications_split_into_user_and_group_changes():
+    users, group_users = set(), set()
+    for payload in (
+        {'table': 'app_user', 'op': 'INSERT', 'user_id': 'a'},
+        {'table': 'user_group', 'op': 'DELETE', 'user_id': 'b'},
+        {'table': 'app_user', 'op': 'UPDATE', 'user_id': 'a'}
+    ):
+        DaemonMixin._collect_notify(None, SimpleNamespace(payload=json.dumps(payload)), users, group_users)
+    DaemonMixin._collect_notify(None, SimpleNamespace(payload='not json'), users, group_users)
+    assert users == {'a'}
+    assert group_users == {'b'}
+
+def test_snapshot_stream_round_trip(tmp_path):
+    path = str(tmp_path / 'realm.ndjson.gz')
+    with _open_snapshot(path, 'w') as f:
+        f.write('{"type":"header"}\n')
+    with open(path, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    with _open_snapshot(path, 'r') as f:
+        assert f.read() == '{"type":"header"}\n'
+
+def test_zstd_snapshot_needs_zstandard(tmp_path, monkeypatch):
+    path = tmp_path / 'realm.ndjson.zst'
+    path.write_bytes(ZSTD_MAGIC + b'\x00' * 8)
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(RuntimeError, match='zstandard'):
+        _open_snapshot(str(path), 'r')
+
+def seed(db_conn, bench, count):
+    with db_conn.cursor() as cursor:
+        cursor.execute(bench.SEED_USERS_SQL, (count,))
+        cursor.execute(bench.SEED_GROUPS_SQL)
+
+def links(db_conn):
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT username, keycloak_id FROM app_user ORDER BY username")
+        return dict(cursor.fetchall())
+
+def memberships(fake):
+    return {name: set(group['members']) for name, group in fake.groups.items()}
+
+def test_snapshot_export_import_restores_ids_groups_and_links(integration, fake_keycloak, db_conn, bench, tmp_path):
+    seed(db_conn, bench, 200)
+    assert integration.sync_postgres_users()
+    assert integration.sync_groups()
+    user_ids = {name: user['id'] for name, user in fake_keycloak.users.items()}
+    groups = memberships(fake_keycloak)
+    linked = links(db_conn)
+    assert len(user_ids) == 200 and all(linked.values())
+
+    path = str(tmp_path / 'cybercore.ndjson.gz')
+    assert integration.export_snapshot(path)
+
+    # Restore into an empty Keycloak and a database that lost its links
+    fake_keycloak.reset()
+    with db_conn.cursor() as cursor:
+        cursor.execute("UPDATE app_user SET keycloak_id = NULL")
+    integration.reconciler = type(integration.reconciler)(integration.client, integration.realm_name)
+    assert integration.import_snapshot(path)
+
+    assert integration.last_sync_stats['users'] == 200
+    assert integration.last_sync_stats['linked'] == 200
+    assert {name: user['id'] for name, user in fake_keycloak.users.items()} == user_ids
+    assert memberships(fake_keycloak) == groups
+    assert links(db_conn) == linked
+
+    # A second import skips every user and changes nothing
+    fake_keycloak.reset_counters()
+    assert integration.import_snapshot(path)
+    assert integration.last_sync_stats['skipped'] == 200
+    assert fake_keycloak.requests['POST /admin/realms'] == 0
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_daemon_pushes_new_users_and_groups(integration, fake_keycloak, db_conn):
+    integration.daemon_debounce = 0.05
+    fake_keycloak.groups['forge'] = {'id': str(uuid.uuid4()), 'name': 'forge', 'members': set()}
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    errors = []
+
+    def drive():
+        try:
+            # The catch-up push after LISTEN is the first batch; changes after it arrive as notifications
+            assert wait_for(lambda: integration.daemon_stats['batches'] >= 1)
+            with db_conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO app_user (username, email) VALUES ('daemon_user', 'daemon_user@cybercore.local') "
+                    "RETURNING user_id"
+                )
+                user_id = cursor.fetchone()[0]
+                cursor.execute("INSERT INTO user_group VALUES (%s, 'forge')", (user_id,))
+            assert wait_for(lambda: 'daemon_user' in fake_keycloak.users and
+                            fake_keycloak.users['daemon_user']['id'] in fake_keycloak.groups['forge']['members'])
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            integration._stopping.set()
+
+    threading.Thread(target=drive, daemon=True).start()
+    try:
+        integration.run_daemon()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert not errors, errors
+    assert integration.daemon_stats['events'] >= 2
+    assert integration.daemon_stats['failed_batches'] == 0
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT keycloak_id FROM app_user WHERE username = 'daemon_user'")
+        assert cursor.fetchone()[0] == fake_keycloak.users['daemon_user']['id']
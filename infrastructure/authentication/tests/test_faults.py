@@ -0,0 +1,154 @@
+"""Fault injection: 5xx, 429 with Retry-After and timeouts against FakeKeycloak, checking
+the retries made, the delays waited and what ends up in the dead-letter file"""
+
+import itertools
+import time
+
+import pytest
+
+USERS_ROUTE = '/admin/realms/cybercore/users'
+
+# Millisecond backoff so the tests are quick; max_delay only caps Retry-After (at six times it)
+FAST_RETRIES = {'KC_RETRY_ATTEMPTS': 4, 'KC_RETRY_BASE_DELAY': 0.001, 'KC_RETRY_MAX_DELAY': 1.0}
+
+def record_delays(integration, monkeypatch):
+    """List of (attempt, status, seconds) for every backoff the client waits"""
+    delays = []
+    policy_delay = integration.retry_policy.delay
+
+    def delay(attempt, response=None):
+        seconds = policy_delay(attempt, response)
+        delays.append((attempt, response.status_code if response is not None else None, seconds))
+        return seconds
+
+    monkeypatch.setattr(integration.retry_policy, 'delay', delay)
+    return delays
+
+def create_users(integration, users):
+    """Create users one request each, dead-lettering failures, as the bench faults mode does"""
+    created = []
+    for user, response, error in integration.client.map_concurrent(integration._create_keycloak_user, users):
+        if error or response.status_code != 201:
+            integration.dead_letters.add(integration.realm_name, user, error or response.status_code)
+        else:
+            created.append(user['username'])
+    return created
+
+def test_transient_5xx_is_retried_without_dead_letters(make_integration, fake_keycloak, inject_faults, bench):
+    integration = make_integration(**FAST_RETRIES)
+    inject_faults('POST', USERS_ROUTE, [503, 502, 504] * 4)
+    users = bench.synthetic_users(20)
+
+    assert len(create_users(integration, users)) == 20
+    assert integration.client.retries == 12
+    assert fake_keycloak.statuses[503] + fake_keycloak.statuses[502] + fake_keycloak.statuses[504] == 12
+    assert fake_keycloak.requests[f'POST {USERS_ROUTE}'] == 32
+    assert set(fake_keycloak.users) == {user['username'] for user in users}
+    assert integration.dead_letters.read() == []
+    assert integration.metrics.summary()['endpoints'][f'POST {USERS_ROUTE}']['retries'] == 12
+
+def test_persistent_5xx_is_dead_lettered(make_integration, fake_keycloak, bench):
+    integration = make_integration(**FAST_RETRIES)
+    fake_keycloak.error_rate, fake_keycloak.error_status = 1.0, 502
+    users = bench.synthetic_users(5)
+
+    assert create_users(integration, users) == []
+    # Every user is tried max_attempts times before it is given up on
+    assert fake_keycloak.requests[f'POST {USERS_ROUTE}'] == 5 * 4
+    assert integration.client.retries == 5 * 3
+    # 502 is retried but, unlike 429/503, is not an overload signal
+    assert integration.limiter.decreases == 0
+
+    entries = integration.dead_letters.read()
+    assert sorted((e['realm'], e['action'], e['user_id'], e['username'], e['reason']) for e in entries) == \
+        sorted(('cybercore', 'create', user['user_id'], user['username'], '502') for user in users)
+    assert integration.dead_letters.count == 5
+
+def test_retry_after_is_honoured(make_integration, fake_keycloak, inject_faults, bench, monkeypatch):
+    integration = make_integration(KC_CONCURRENCY=1, **FAST_RETRIES)
+    delays = record_delays(integration, monkeypatch)
+    inject_faults('POST', USERS_ROUTE, [(429, {'Retry-After': '0.2'})] * 3)
+
+    started = time.monotonic()
+    assert len(create_users(integration, bench.synthetic_users(1))) == 1
+    elapsed = time.monotonic() - started
+
+    assert delays == [(1, 429, 0.2), (2, 429, 0.2), (3, 429, 0.2)]
+    assert elapsed >= 0.6
+    assert integration.client.retries == 3
+    # Three 429s within one latency window back off once
+    assert integration.limiter.decreases == 1
+    assert integration.dead_letters.read() == []
+
+def test_retry_after_beyond_the_cap_is_shortened(make_integration, inject_faults, bench, monkeypatch):
+    integration = make_integration(KC_CONCURRENCY=1, **dict(FAST_RETRIES, KC_RETRY_MAX_DELAY=0.05))
+    delays = record_delays(integration, monkeypatch)
+    inject_faults('POST', USERS_ROUTE, [(503, {'Retry-After': '120'})])
+
+    assert len(create_users(integration, bench.synthetic_users(1))) == 1
+    assert delays == [(1, 503, pytest.approx(0.3))]
+
+def test_shed_requests_back_off_and_wait_as_told(make_integration, fake_keycloak, bench, monkeypatch):
+    integration = make_integration(KC_CONCURRENCY=8, **dict(FAST_RETRIES, KC_RETRY_ATTEMPTS=10))
+    delays = record_delays(integration, monkeypatch)
+    fake_keycloak.capacity, fake_keycloak.retry_after, fake_keycloak.latency = 2, 0.05, 0.02
+    users = bench.synthetic_users(40)
+
+    created = create_users(integration, users)
+    entries = integration.dead_letters.read()
+
+    assert fake_keycloak.statuses[429] > 0
+    # Every 429 is retried except the last one of each user given up on
+    assert integration.client.retries == fake_keycloak.statuses[429] - len(entries)
+    assert all(seconds == 0.05 for _, status, seconds in delays if status == 429)
+    assert integration.limiter.decreases >= 1
+    assert len(created) + len(entries) == 40
+    assert all(entry['reason'] == '429' for entry in entries)
+
+def test_timeouts_are_retried_then_dead_lettered(make_integration, fake_keycloak, bench, monkeypatch):
+    integration = make_integration(KC_TIMEOUT=0.1, **FAST_RETRIES)
+    delays = record_delays(integration, monkeypatch)
+    # The admin token is already held; from here every response takes longer than the timeout
+    fake_keycloak.latency = 0.3
+    users = bench.synthetic_users(3)
+
+    assert create_users(integration, users) == []
+    assert fake_keycloak.requests[f'POST {USERS_ROUTE}'] == 3 * 4
+    assert integration.client.retries == 3 * 3
+    assert [status for _, status, _ in delays] == [None] * 9
+    assert integration.limiter.decreases >= 1
+
+    entries = integration.dead_letters.read()
+    assert sorted(e['username'] for e in entries) == sorted(user['username'] for user in users)
+    assert all('timed out' in entry['reason'] for entry in entries)
+    endpoint = integration.metrics.summary()['endpoints'][f'POST {USERS_ROUTE}']
+    assert endpoint['status'] == {'error': 12}
+
+def test_sync_dead_letters_failing_users_and_replay_recovers(make_integration, database_env, fake_keycloak,
+                                                            inject_faults, db_conn, bench):
+    with db_conn.cursor() as cursor:
+        cursor.execute(bench.SEED_USERS_SQL, (30,))
+        cursor.execute("SELECT username, user_id::text FROM app_user")
+        user_ids = dict(cursor.fetchall())
+    failing = {'bench_user_3', 'bench_user_17', 'bench_user_29'}
+    integration = make_integration(SYNC_MODE='single', SYNC_ID_CACHE_FILE='', **FAST_RETRIES)
+    inject_faults('POST', USERS_ROUTE, itertools.repeat(503), when=lambda body: body['username'] in failing)
+
+    assert integration.sync_postgres_users()
+
+    entries = integration.dead_letters.read()
+    assert sorted((e['realm'], e['user_id'], e['username'], e['reason']) for e in entries) == \
+        sorted(('cybercore', user_ids[name], name, '503') for name in failing)
+    # 27 created at the first attempt, the failing three tried max_attempts times each
+    assert fake_keycloak.requests[f'POST {USERS_ROUTE}'] == 27 + 3 * 4
+    assert integration.client.retries == 3 * 3
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT username FROM app_user WHERE keycloak_id IS NULL")
+        assert {row[0] for row in cursor.fetchall()} == failing
+
+    # Replay goes through partialImport, which the injected fault does not cover
+    assert integration.replay_dead_letters()
+    assert integration.dead_letters.read() == []
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT username, keycloak_id FROM app_user WHERE username = ANY(%s)", (sorted(failing),))
+        assert {name: fake_keycloak.users[name]['id'] for name in failing} == dict(cursor.fetchall())
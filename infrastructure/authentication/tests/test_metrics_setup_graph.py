@@ -0,0 +1,99 @@
+"""Metrics and SetupGraph"""
+
+import time
+import threading
+
+import pytest
+
+from keycloak_sync import Metrics, SetupGraph, SetupStep
+
+def test_endpoint_folds_ids_and_query():
+    assert Metrics.endpoint(
+        'http://kc:8080/admin/realms/cybercore/users/0f8fad5b-d9cb-469f-a165-70867728950e/groups?max=5'
+    ) == '/admin/realms/cybercore/users/{id}/groups'
+    assert Metrics.endpoint('http://kc:8080/admin/realms/cybercore/groups/42') == '/admin/realms/cybercore/groups/{id}'
+
+def test_client_requests_are_recorded(admin_client, tmp_path):
+    admin_client.get('/admin/realms/cybercore/users/count')
+    admin_client.get('/admin/realms/cybercore/users/count')
+    with admin_client.metrics.phase('sync'):
+        pass
+    admin_client.metrics.set_gauge('dead_letters', 3, realm='cybercore')
+
+    summary = admin_client.metrics.summary()
+    assert summary['endpoints']['GET /admin/realms/cybercore/users/count']['requests'] == 2
+    assert summary['endpoints']['GET /admin/realms/cybercore/users/count']['status'] == {'2xx': 2}
+    assert summary['endpoints']['POST /realms/master/protocol/openid-connect/token']['requests'] == 1
+    assert summary['phases']['sync']['count'] == 1
+
+    path = tmp_path / 'keycloak.prom'
+    admin_client.metrics.write_prometheus(str(path))
+    text = path.read_text()
+    assert 'keycloak_integration_requests_total{method="GET",path="/admin/realms/cybercore/users/count",status="2xx"} 2' in text
+    assert 'keycloak_integration_dead_letters{realm="cybercore"} 3' in text
+    assert 'keycloak_integration_request_duration_seconds_count{method="GET",path="/admin/realms/cybercore/users/count"} 2' in text
+
+def test_failed_requests_count_as_errors():
+    metrics = Metrics()
+    metrics.record_request('GET', 'http://kc/x', None, 0.5)
+    metrics.record_retry('GET', 'http://kc/x')
+    assert metrics.summary()['endpoints']['GET /x'] == {
+        'requests': 1, 'retries': 1, 'status': {'error': 1}, 'bytes_sent': 0, 'bytes_received': 0,
+        'seconds': 0.5, 'mean_ms': 500.0, 'max_ms': 500.0
+    }
+
+def step(name, log, ok=True, requires=(), delay=0.0):
+    def run():
+        time.sleep(delay)
+        log.append(name)
+        return ok
+    return SetupStep(name, run, requires)
+
+def test_steps_run_after_their_prerequisites():
+    log = []
+    graph = SetupGraph([
+        step('realm', log, delay=0.05),
+        step('ldap', log, requires=['realm']),
+        step('groups', log, requires=['realm']),
+        step('users', log, requires=['ldap', 'groups'])
+    ])
+    steps = graph.run()
+    assert all(s.status == 'ok' for s in steps.values())
+    assert log[0] == 'realm' and log[-1] == 'users'
+    assert [s.name for s in graph.critical_path()][0] == 'realm'
+    assert graph.critical_path()[-1].name == 'users'
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(2, timeout=2)
+    graph = SetupGraph([
+        SetupStep('a', lambda: barrier.wait() is not None),
+        SetupStep('b', lambda: barrier.wait() is not None)
+    ])
+    graph.run()
+    assert graph.steps['a'].status == graph.steps['b'].status == 'ok'
+
+def test_failure_skips_dependents_only():
+    log = []
+
+    def broken():
+        raise RuntimeError('LDAP unreachable')
+
+    graph = SetupGraph([
+        step('realm', log),
+        SetupStep('ldap', broken, requires=['realm']),
+        step('sync', log, requires=['ldap']),
+        step('groups', log, requires=['sync']),
+        step('smtp', log, requires=['realm'])
+    ])
+    graph.run()
+    statuses = {name: s.status for name, s in graph.steps.items()}
+    assert statuses == {'realm': 'ok', 'ldap': 'failed', 'sync': 'skipped', 'groups': 'skipped', 'smtp': 'ok'}
+    report = graph.report()
+    assert report['steps']['ldap']['error'] == 'LDAP unreachable'
+    assert report['steps']['sync']['seconds'] == 0.0
+
+def test_graph_rejects_unknown_requirements_and_cycles():
+    with pytest.raises(ValueError, match='unknown'):
+        SetupGraph([SetupStep('a', lambda: True, requires=['b'])])
+    with pytest.raises(ValueError, match='cycle'):
+        SetupGraph([SetupStep('a', lambda: True, requires=['b']), SetupStep('b', lambda: True, requires=['a'])])
@@ -0,0 +1,109 @@
+"""_structural_diff and RealmReconciler plan/apply against FakeKeycloak"""
+
+from keycloak_sync import RealmReconciler
+from keycloak_sync.reconciler import MASKED_SECRET, _structural_diff
+
+DESIRED_REALM = {
+    'realm': 'cybercore',
+    'displayName': 'CyberCore',
+    'bruteForceProtected': True,
+    'clients': [{
+        'clientId': 'cybercore-web',
+        'redirectUris': ['https://cybercore.local/*', 'http://localhost:3000/*'],
+        'protocolMappers': [{
+            'name': 'groups',
+            'protocol': 'openid-connect',
+            'protocolMapper': 'oidc-group-membership-mapper',
+            'config': {'claim.name': 'groups', 'full.path': 'false'}
+        }]
+    }],
+    'groups': [{'name': 'forge'}, {'name': 'crucible'}]
+}
+
+LDAP_COMPONENT = {
+    'name': 'ldap',
+    'providerId': 'ldap',
+    'providerType': 'org.keycloak.storage.UserStorageProvider',
+    'config': {'connectionUrl': ['ldap://ldap:389'], 'bindCredential': ['s3cret']}
+}
+
+def test_diff_ignores_extra_keys_order_and_masked_secrets():
+    assert _structural_diff({'a': 1, 'tags': ['x', 'y']}, {'a': 1, 'b': 2, 'tags': ['y', 'x']}) == []
+    assert _structural_diff({'config': {'password': ['pw']}}, {'config': {'password': [MASKED_SECRET]}}) == []
+    assert _structural_diff({'a': {'b': 1}}, {'a': {'b': 2}}) == [('a.b', 2, 1)]
+    # Empty desired values do not count as missing
+    assert _structural_diff({'attributes': {}}, {}) == []
+
+def test_diff_matches_named_lists_by_name_without_server_ids():
+    desired = [{'name': 'groups', 'config': {'claim.name': 'groups'}}, {'name': 'email'}]
+    current = [{'id': 'abc', 'name': 'email'}, {'id': 'def', 'name': 'groups', 'config': {'claim.name': 'groups'}}]
+    assert _structural_diff({'protocolMappers': desired}, {'protocolMappers': current}) == []
+
+    current[1]['config']['claim.name'] = 'roles'
+    assert _structural_diff({'protocolMappers': desired}, {'protocolMappers': current}) == [
+        ('protocolMappers[groups].config.claim.name', 'roles', 'groups')
+    ]
+    assert _structural_diff({'protocolMappers': desired}, {'protocolMappers': current[:1]})[0][0] == \
+        'protocolMappers[groups]'
+
+def apply_all(reconciler, changes):
+    for change in changes:
+        if change['action'] != 'noop':
+            assert reconciler.apply(change).status_code in (200, 201, 204)
+
+def test_plan_apply_converges(admin_client, fake_keycloak):
+    reconciler = RealmReconciler(admin_client, 'cybercore')
+    changes = reconciler.plan_realm(DESIRED_REALM)
+    actions = {(c['resource'], c['name']): c['action'] for c in changes}
+    assert actions == {
+        ('realm', 'cybercore'): 'update',
+        ('client', 'cybercore-web'): 'create',
+        ('realm', 'cybercore entries'): 'create'
+    }
+    # Only the drifted settings are sent
+    assert changes[0]['payload'] == {'bruteForceProtected': True, 'displayName': 'CyberCore'}
+
+    fake_keycloak.reset_counters()
+    apply_all(reconciler, changes)
+    # Neither the realm update nor the entries partialImport refetches the realm
+    assert fake_keycloak.requests['GET /admin/realms/cybercore'] == 0
+    assert reconciler.writes == 3
+    assert set(fake_keycloak.groups) == {'forge', 'crucible'}
+
+    # Keycloak assigns IDs to protocol mappers; that is not drift
+    for client in fake_keycloak.clients.values():
+        for index, mapper in enumerate(client['protocolMappers']):
+            mapper['id'] = f"00000000-0000-0000-0000-{index:012d}"
+
+    again = RealmReconciler(admin_client, 'cybercore').plan_realm(DESIRED_REALM)
+    assert [c['action'] for c in again] == ['noop', 'noop', 'noop']
+
+def test_component_secrets_are_not_drift(admin_client, fake_keycloak):
+    reconciler = RealmReconciler(admin_client, 'cybercore')
+    change = reconciler.plan_component(LDAP_COMPONENT)
+    assert change['action'] == 'create'
+    reconciler.apply(change)
+    stored = next(iter(fake_keycloak.components.values()))
+    assert stored['parentId'] == reconciler.current_realm['id']
+
+    fresh = RealmReconciler(admin_client, 'cybercore')
+    assert fresh.plan_component(LDAP_COMPONENT)['action'] == 'noop'
+
+    moved = dict(LDAP_COMPONENT, config=dict(LDAP_COMPONENT['config'], connectionUrl=['ldaps://ldap:636']))
+    update = fresh.plan_component(moved)
+    assert update['action'] == 'update'
+    assert [path for path, _, _ in update['diff']] == ['config.connectionUrl']
+    assert fresh.apply(update).status_code == 204
+    assert stored['id'] in fake_keycloak.components
+    assert fake_keycloak.components[stored['id']]['config']['bindCredential'] == ['s3cret']
+
+def test_format_plan_redacts_secrets():
+    changes = [{
+        'resource': 'component', 'name': 'ldap', 'action': 'update',
+        'diff': [('config.bindCredential', None, ['s3cret']), ('config.connectionUrl', ['a'], ['b'])],
+        'method': 'PUT', 'path': '/x', 'payload': {}
+    }]
+    plan = RealmReconciler.format_plan(changes)
+    assert 's3cret' not in plan
+    assert 'config.bindCredential: null -> "<secret>"' in plan
+    assert plan.endswith('1 change(s), 0 resource(s) up to date')
@@ -0,0 +1,85 @@
+"""RetryPolicy backoff and AdaptiveLimiter AIMD behaviour"""
+
+import time
+import threading
+from email.utils import formatdate
+
+import requests
+
+from keycloak_sync import AdaptiveLimiter, RetryPolicy
+
+def response_with(headers):
+    response = requests.Response()
+    response.status_code = 429
+    response.headers.update(headers)
+    return response
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=0.5, max_delay=2.0)
+    for attempt in range(1, 8):
+        delays = [policy.delay(attempt) for _ in range(200)]
+        assert all(0 <= d <= min(2.0, 0.5 * 2 ** attempt) for d in delays)
+        assert len(set(delays)) > 1
+
+def test_retry_after_seconds_are_honoured():
+    policy = RetryPolicy(max_delay=10.0)
+    assert policy.delay(1, response_with({'Retry-After': '7'})) == 7.0
+    # A server asking for longer than six max_delays is capped
+    assert policy.delay(1, response_with({'Retry-After': '3600'})) == 60.0
+
+def test_retry_after_http_date_is_honoured():
+    policy = RetryPolicy(max_delay=10.0)
+    delay = policy.delay(1, response_with({'Retry-After': formatdate(time.time() + 20, usegmt=True)}))
+    assert 18 <= delay <= 20
+    assert policy.delay(1, response_with({'Retry-After': formatdate(time.time() - 20, usegmt=True)})) == 0.0
+
+def test_unparseable_retry_after_falls_back_to_backoff():
+    policy = RetryPolicy(base_delay=0.1, max_delay=1.0)
+    assert 0 <= policy.delay(1, response_with({'Retry-After': 'soon'})) <= 0.2
+
+def test_overload_cuts_limit_and_rate_once_per_window():
+    limiter = AdaptiveLimiter(max_concurrency=10, max_rate=100.0, target_latency=5.0)
+    limiter.acquire()
+    limiter.release(0.01, overloaded=True)
+    assert limiter.limit == 10 * AdaptiveLimiter.DECREASE_FACTOR
+    assert limiter.rate == 100 * AdaptiveLimiter.DECREASE_FACTOR
+
+    # Further overload signals inside the same latency window are one event
+    limiter.acquire()
+    limiter.release(0.01, overloaded=True)
+    assert limiter.decreases == 1
+
+def test_healthy_responses_grow_back_to_the_ceiling():
+    limiter = AdaptiveLimiter(max_concurrency=4, max_rate=50.0, target_latency=0.0)
+    limiter.acquire()
+    limiter.release(0.01, overloaded=True)
+    assert limiter.limit < 4
+    for _ in range(200):
+        limiter.acquire()
+        limiter.release(0.01, overloaded=False)
+    assert limiter.limit == 4
+    assert limiter.rate == 50.0
+
+def test_latency_spike_counts_as_overload():
+    limiter = AdaptiveLimiter(max_concurrency=8, max_rate=1000.0, target_latency=0.05)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01, overloaded=False)
+    limiter.acquire()
+    limiter.release(0.5, overloaded=False)
+    assert limiter.decreases == 1
+
+def test_acquire_blocks_at_the_concurrency_limit():
+    limiter = AdaptiveLimiter(max_concurrency=2, max_rate=1000.0)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def third():
+        limiter.acquire()
+        acquired.set()
+
+    threading.Thread(target=third, daemon=True).start()
+    assert not acquired.wait(0.2)
+    limiter.release(0.01, overloaded=False)
+    assert acquired.wait(1.0)
@@ -0,0 +1,128 @@
+"""SyncJournal, DeadLetterQueue, KeycloakIdCache and KeycloakIdWriter"""
+
+import uuid
+
+from keycloak_sync import DeadLetterQueue, KeycloakIdCache, KeycloakIdWriter, SyncJournal
+
+def test_journal_round_trip(tmp_path):
+    journal = SyncJournal(str(tmp_path / 'journal.jsonl'))
+    journal.start('cybercore')
+    chunks = [(0, [{'user_id': 'a'}, {'user_id': 'b'}]), (1, [{'user_id': 'c'}])]
+    assert list(journal.attempts(chunks)) == chunks
+    journal.append('confirm', chunk=0, links=[['a', 'kc-a'], ['b', 'kc-b']])
+    journal.append('written', chunks=[0])
+    journal.close()
+
+    state = journal.load()
+    assert state['realm'] == 'cybercore'
+    assert state['attempted'] == {0: ['a', 'b'], 1: ['c']}
+    assert state['confirmed'] == {0: [['a', 'kc-a'], ['b', 'kc-b']]}
+    assert state['written'] == {0}
+
+def test_journal_ignores_a_torn_last_line(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    journal = SyncJournal(str(path))
+    journal.start('cybercore')
+    journal.append('attempt', chunk=0, users=['a'])
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"op": "confirm", "chunk": 0, "li')
+
+    state = journal.load()
+    assert state['attempted'] == {0: ['a']}
+    assert state['confirmed'] == {}
+
+    journal.clear()
+    assert journal.load() is None
+
+def test_dead_letters_append_and_replace(tmp_path):
+    queue = DeadLetterQueue(str(tmp_path / 'dead.jsonl'))
+    assert queue.read() == []
+    queue.add('cybercore', {'user_id': 1, 'username': 'alice'}, 409)
+    queue.add('cyberlabs', {'user_id': 2, 'username': 'bob'}, ValueError('bad email'), action='update')
+
+    entries = queue.read()
+    assert queue.count == 2
+    assert [(e['realm'], e['user_id'], e['username'], e['reason'], e['action']) for e in entries] == [
+        ('cybercore', '1', 'alice', '409', 'create'),
+        ('cyberlabs', '2', 'bob', 'bad email', 'update')
+    ]
+
+    queue.replace(entries[1:])
+    assert [e['username'] for e in queue.read()] == ['bob']
+    queue.replace([])
+    assert not (tmp_path / 'dead.jsonl').exists()
+
+def test_id_cache_lookup_requires_the_username(tmp_path):
+    cache = KeycloakIdCache(str(tmp_path / 'ids.sqlite'), 'cybercore', ttl=60)
+    assert not cache.fresh()
+    assert cache.refresh([
+        {'username': 'Alice', 'email': 'alice@cybercore.local', 'id': 'kc-alice'},
+        {'username': 'bob', 'id': 'kc-bob'}
+    ]) == 2
+    assert cache.fresh()
+
+    assert cache.lookup('alice') == 'kc-alice'
+    assert cache.lookup('ALICE', 'Alice@CyberCore.local') == 'kc-alice'
+    # An email that disagrees, or a username that is not there, is a miss
+    assert cache.lookup('alice', 'mallory@cybercore.local') is None
+    assert cache.lookup('carol', 'alice@cybercore.local') is None
+    # Either side without an email matches on the username alone
+    assert cache.lookup('bob', 'bob@cybercore.local') == 'kc-bob'
+    assert cache.hits == 3
+
+    cache.put_many([('carol', None, 'kc-carol')])
+    assert cache.lookup('carol') == 'kc-carol'
+    cache.close()
+
+def test_id_cache_is_per_realm_and_expires(tmp_path):
+    path = str(tmp_path / 'ids.sqlite')
+    cybercore = KeycloakIdCache(path, 'cybercore', ttl=0)
+    cyberlabs = KeycloakIdCache(path, 'cyberlabs', ttl=60)
+    cybercore.refresh([{'username': 'alice', 'id': 'kc-alice'}])
+    assert not cybercore.fresh()
+    assert not cyberlabs.fresh()
+    assert cyberlabs.lookup('alice') is None
+    cybercore.close()
+    cyberlabs.close()
+
+def insert_user(db_conn, username):
+    user_id = str(uuid.uuid4())
+    with db_conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO app_user (user_id, username, email, first_name, last_name, auth_provider) "
+            "VALUES (%s, %s, %s, 'Test', 'User', 'keycloak')",
+            (user_id, username, f"{username}@cybercore.local")
+        )
+    return user_id
+
+def test_id_writer_links_users_in_batches(postgres_db, db_conn):
+    import psycopg2
+    conn = psycopg2.connect(**postgres_db)
+    users = [insert_user(db_conn, f"writer_{i}") for i in range(5)]
+    missing = str(uuid.uuid4())
+
+    writer = KeycloakIdWriter(conn, batch_size=2, flush_interval=60)
+    for user_id in users + [missing]:
+        writer.add(user_id, f"kc-{user_id}")
+    writer.close()
+    conn.close()
+
+    assert writer.written == 5
+    assert writer.failed == {missing: 'user not found'}
+    with db_conn.cursor() as cursor:
+        cursor.execute("SELECT user_id::text, keycloak_id FROM app_user WHERE username LIKE 'writer_%%'")
+        assert dict(cursor.fetchall()) == {user_id: f"kc-{user_id}" for user_id in users}
+
+def test_id_writer_falls_back_to_rows(postgres_db, db_conn):
+    import psycopg2
+    conn = psycopg2.connect(**postgres_db)
+    good = insert_user(db_conn, 'writer_good')
+
+    writer = KeycloakIdWriter(conn, batch_size=10)
+    writer.pending = [(good, 'kc-good'), ('not-a-uuid', 'kc-bad')]
+    writer.flush()
+    conn.close()
+
+    assert writer.written == 1
+    assert 'not-a-uuid' in writer.failed